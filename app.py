@@ -1,8 +1,11 @@
 import os
-from flask import Flask, request, abort, jsonify, redirect
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, request, abort, redirect
 from flask_cors import CORS
-from models import setup_db, Movie
+from models import setup_db, db, Movie
+from json_provider import setup_json_provider
+from compress import setup_compression
+from metrics import setup_metrics
+from profiler import SQL_PROFILE, setup_profiler
 
 from routes_movies import *
 from routes_actors import *
@@ -16,9 +19,12 @@ def create_app(test_config=None):
         setup_db(app, test_config['database_path'])
     else:
         setup_db(app)
+    setup_metrics(app)
+    if SQL_PROFILE:
+        setup_profiler(app)
     CORS(app)
-
-    db = SQLAlchemy(app)
+    setup_json_provider(app)
+    setup_compression(app)
 
     # setup routes
     setup_movie_routes(app, db)
@@ -0,0 +1,126 @@
+# ASGI entry point serving the movie and actor routes with asyncio
+# Requests are handled as coroutines on one event loop per process and the
+# database is reached through the asyncpg driver, so a single process can
+# have many requests waiting on the database at once instead of one per
+# thread. Run with:
+#   uvicorn asgi:app
+# Routes, permissions and error responses match the Flask app in app.py
+
+from contextlib import asynccontextmanager
+from functools import wraps
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
+from werkzeug.exceptions import HTTPException as WerkzeugHTTPException
+
+import auth
+from auth import AuthError, check_permissions, get_token_auth_header, \
+    get_verified_payload, token_cache
+from error_handling import ERROR_MESSAGES, error_body
+from json_provider import json_provider
+from models import DB_MAX_OVERFLOW, DB_PGBOUNCER, DB_POOL_PRE_PING, \
+    DB_POOL_RECYCLE, DB_POOL_SIZE, DB_POOL_TIMEOUT, database_path
+
+
+# JSON responses encoded by the same provider as in the Flask app,
+# so that dates are sent in the same format
+class FlaskJSONResponse(JSONResponse):
+    def render(self, content):
+        return json_provider.dumps(content) + b'\n'
+
+
+def error_response(status_code, message=None):
+    return FlaskJSONResponse(error_body(status_code, message),
+                             status_code=status_code)
+
+
+# Async version of auth.requires_auth. Tokens that have been seen before
+# are checked against the token cache without blocking; new tokens are
+# verified in a worker thread, as that may need to fetch Auth0's keys
+def requires_auth(permission=''):
+    def requires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(request, *args, **kwargs):
+            if auth.auth_master:
+                token = get_token_auth_header(request.headers)
+                payload = token_cache.get(token)
+                if payload is None:
+                    payload = await run_in_threadpool(get_verified_payload,
+                                                      token)
+                check_permissions(permission, payload)
+            return await f(request, *args, **kwargs)
+        wrapper.required_permission = permission
+        return wrapper
+    return requires_auth_decorator
+
+
+# The Flask app's URL has the psycopg2 scheme, which is swapped for asyncpg
+def async_database_url(url):
+    return url.replace('postgresql://', 'postgresql+asyncpg://', 1)
+
+
+# Engine options from the same connection pool settings as the Flask app
+def async_engine_options():
+    if DB_PGBOUNCER:
+        # asyncpg prepares every statement, so PgBouncer must be set up to
+        # support prepared statements (max_prepared_statements) as well
+        return {'poolclass': NullPool, 'pool_pre_ping': DB_POOL_PRE_PING}
+    return {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
+
+
+def setup_error_handlers(app):
+    async def error_handler_http(request, exc):
+        return error_response(exc.status_code,
+                              ERROR_MESSAGES.get(exc.status_code, exc.detail))
+
+    # abort() is used by the helpers shared with the Flask app
+    async def error_handler_abort(request, exc):
+        return error_response(exc.code, ERROR_MESSAGES.get(exc.code, exc.name))
+
+    async def error_handler_auth(request, exc):
+        return error_response(exc.status_code, exc.error)
+
+    async def error_handler_500(request, exc):
+        return error_response(500)
+
+    app.add_exception_handler(HTTPException, error_handler_http)
+    app.add_exception_handler(WerkzeugHTTPException, error_handler_abort)
+    app.add_exception_handler(AuthError, error_handler_auth)
+    app.add_exception_handler(500, error_handler_500)
+
+
+def create_app(test_config=None):
+    # imported here as the routes use the decorator above
+    from asgi_routes import movie_routes, actor_routes
+
+    url = database_path
+    if test_config is not None and 'database_path' in test_config:
+        url = test_config['database_path']
+    engine = create_async_engine(async_database_url(url),
+                                 **async_engine_options())
+
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        await engine.dispose()
+
+    app = Starlette(routes=movie_routes() + actor_routes(),
+                    lifespan=lifespan)
+    app.state.engine = engine
+    app.state.sessions = sessionmaker(engine, class_=AsyncSession,
+                                      expire_on_commit=False)
+    setup_error_handlers(app)
+    return app
+
+
+app = create_app()
@@ -0,0 +1,302 @@
+# Movie and actor routes for the ASGI entry point (asgi.py)
+# These behave as the Flask routes in routes_movies.py and routes_actors.py,
+# sharing their validation, paging, search, caching and ETag helpers, but
+# await the database instead of blocking on it
+# Importing records from NDJSON or CSV is only available through the Flask
+# app, as it streams data into psycopg2's COPY support, and so are casting
+# and embedding casts and filmographies (see casting.py)
+
+import zlib
+from sqlalchemy import DateTime, String, cast, delete, insert, literal, \
+    select, update
+from sqlalchemy.exc import DBAPIError
+from starlette.exceptions import HTTPException
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+
+from asgi import FlaskJSONResponse, requires_auth
+from batch import BulkRecords, get_requested_ids
+from cache import entity_cache
+from etags import collection_etag, entity_etag, matching_etag, \
+    wants_representation
+from exporter import EXPORT_BATCH_ROWS, EXPORT_CHUNK_BYTES, ndjson_line
+from models import Actor, Movie
+from pagination import get_page_params, page_by_name, split_page
+from routes_actors import ACTOR_COLUMNS, get_actor_fields
+from routes_movies import MOVIE_COLUMNS, get_movie_fields
+from search import name_contains, ranked_matches
+
+
+# Return the request's JSON body, or None if it doesn't have one,
+# as Flask's get_json does
+async def get_json(request):
+    mimetype = request.headers.get('Content-Type', '').split(';')[0].strip()
+    if mimetype != 'application/json' and not (
+            mimetype.startswith('application/') and
+            mimetype.endswith('+json')):
+        return None
+    try:
+        return await request.json()
+    except ValueError:
+        raise HTTPException(400)
+
+
+# Return a 304 response if the client already holds the version of the
+# response with this tag, or None if the full response must be sent
+def not_modified(request, etag):
+    if_none_match = parse_etags(request.headers.get('If-None-Match'))
+    held = matching_etag(if_none_match, etag)
+    if held is None:
+        return None
+    return Response(status_code=304, headers={
+        'ETag': quote_etag(held, if_none_match.is_weak(held))})
+
+
+def tagged_response(content, etag):
+    return FlaskJSONResponse(content, headers={'ETag': quote_etag(etag)})
+
+
+# Values to store for a record. asyncpg only accepts datetime objects for
+# timestamp parameters, so date strings are sent as text and cast by the
+# database, which then understands the same formats as with psycopg2
+def column_values(model, fields):
+    values = {}
+    for name, value in fields.items():
+        column_type = model.__table__.c[name].type
+        if isinstance(column_type, DateTime) and isinstance(value, str):
+            value = cast(literal(value, String()), column_type)
+        values[name] = value
+    return values
+
+
+# Whether the database rejected a value it can't store
+# (such as a malformed date)
+def is_data_error(error):
+    return str(getattr(error.orig, 'pgcode', None) or '').startswith('22')
+
+
+async def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+# Routes for one kind of record, e.g. with table 'movies', data_key
+# 'movie_data' and columns the fields set when creating a record
+def resource_routes(model, table, data_key, columns, get_fields):
+    table_obj = model.__table__
+    # columns in the same order as the record's format()
+    format_columns = [table_obj.c.id] + [table_obj.c[name]
+                                         for name in columns]
+
+    @requires_auth(f'get:{table}')
+    async def show(request):
+        record_id = request.path_params['id']
+        cached = entity_cache.get(table, record_id)
+        if cached is None:
+            async with request.app.state.sessions() as session:
+                record = await session.get(model, record_id)
+            if record is None:
+                raise HTTPException(404)
+            cached = (record.format(), record.version)
+            entity_cache.set(table, record_id, cached)
+        data, version = cached
+        etag = entity_etag(table, record_id, version)
+        unchanged = not_modified(request, etag)
+        if unchanged is not None:
+            return unchanged
+        return tagged_response({
+            'success': True,
+            data_key: data
+        }, etag)
+
+    @requires_auth(f'get:{table}')
+    async def show_many(request):
+        ids = get_requested_ids(request.query_params.get('ids', ''))
+        async with request.app.state.sessions() as session:
+            records = (await session.execute(
+                select(model).filter(model.id.in_(ids)))).scalars().all()
+        found = {record.id: record for record in records}
+        return FlaskJSONResponse({
+            'success': True,
+            data_key: {
+                'data': {str(id): found[id].format()
+                         for id in ids if id in found},
+                'missing': [id for id in ids if id not in found]
+            }
+        })
+
+    @requires_auth(f'get:{table}')
+    async def export(request):
+        async def generate_ndjson():
+            async with request.app.state.sessions() as session:
+                result = await session.stream(
+                    select(model).order_by(model.id).
+                    execution_options(yield_per=EXPORT_BATCH_ROWS))
+                lines = []
+                size = 0
+                async for record in result.scalars():
+                    line = ndjson_line(record)
+                    lines.append(line)
+                    size += len(line)
+                    if size >= EXPORT_CHUNK_BYTES:
+                        yield ''.join(lines).encode('utf-8')
+                        lines = []
+                        size = 0
+                if lines:
+                    yield ''.join(lines).encode('utf-8')
+
+        chunks = generate_ndjson()
+        headers = {}
+        accept_encoding = request.headers.get('Accept-Encoding')
+        if parse_accept_header(accept_encoding).quality('gzip') > 0:
+            chunks = gzip_chunks(chunks)
+            headers['Content-Encoding'] = 'gzip'
+            headers['Vary'] = 'Accept-Encoding'
+        return StreamingResponse(chunks, media_type='application/x-ndjson',
+                                 headers=headers)
+
+    @requires_auth(f'get:{table}')
+    async def search(request):
+        body = await get_json(request)
+        if not isinstance(body, dict) or 'search_term' not in body:
+            raise HTTPException(400)
+        search_term = body['search_term']
+        if not isinstance(search_term, str):
+            raise HTTPException(400)
+        limit, after = get_page_params(body)
+        mode = body.get('mode', 'substring')
+        async with request.app.state.sessions() as session:
+            if mode == 'substring':
+                statement = page_by_name(
+                    select(model).filter(name_contains(model, search_term)),
+                    model, limit, after)
+                records, next_cursor = split_page(
+                    (await session.execute(statement)).scalars().all(),
+                    limit)
+            elif mode == 'fulltext' and after is None:
+                statement = ranked_matches(select(model), model,
+                                           search_term, limit)
+                records = (await session.execute(statement)).scalars().all()
+                next_cursor = None
+            else:
+                raise HTTPException(400)
+        etag = collection_etag(table, body, records, next_cursor)
+        unchanged = not_modified(request, etag)
+        if unchanged is not None:
+            return unchanged
+        return tagged_response({
+            'success': True,
+            data_key: {
+                'count': len(records),
+                'data': [record.format() for record in records],
+                'next_cursor': next_cursor
+            }
+        }, etag)
+
+    @requires_auth(f'post:{table}')
+    async def add(request):
+        fields = get_fields(await get_json(request))
+        if fields is None:
+            raise HTTPException(400)
+        async with request.app.state.sessions() as session:
+            new_id = (await session.execute(
+                insert(table_obj).values(**column_values(model, fields)).
+                returning(table_obj.c.id))).scalar_one()
+            await session.commit()
+        return FlaskJSONResponse({
+            'success': True,
+            'id': new_id
+        })
+
+    @requires_auth(f'post:{table}')
+    async def add_many(request):
+        batch = BulkRecords(await get_json(request), table, get_fields)
+        if batch.rejected:
+            return FlaskJSONResponse(batch.rejection(), status_code=422)
+        new_ids = []
+        if batch.rows:
+            rows = [column_values(model, row) for row in batch.rows]
+            async with request.app.state.sessions() as session:
+                try:
+                    result = await session.execute(
+                        insert(table_obj).values(rows).
+                        returning(table_obj.c.id))
+                    new_ids = result.scalars().all()
+                    await session.commit()
+                except DBAPIError as e:
+                    if not is_data_error(e):
+                        raise
+                    raise HTTPException(422)
+        return FlaskJSONResponse(batch.result(new_ids))
+
+    @requires_auth(f'patch:{table}')
+    async def edit(request):
+        record_id = request.path_params['id']
+        fields = get_fields(await get_json(request))
+        if fields is None:
+            raise HTTPException(400)
+        async with request.app.state.sessions() as session:
+            # Update and check the record exists in one statement
+            record = (await session.execute(
+                update(table_obj).
+                where(table_obj.c.id == record_id).
+                values(version=table_obj.c.version + 1,
+                       **column_values(model, fields)).
+                returning(*format_columns, table_obj.c.version))).first()
+            if record is None:
+                raise HTTPException(404)
+            await session.commit()
+        entity_cache.invalidate(table, record_id)
+        if not wants_representation(request.headers.get('Prefer', '')):
+            return FlaskJSONResponse({
+                'success': True
+            })
+        data = dict(record._mapping)
+        etag = entity_etag(table, record_id, data.pop('version'))
+        return tagged_response({
+            'success': True,
+            data_key: data
+        }, etag)
+
+    @requires_auth(f'delete:{table}')
+    async def remove(request):
+        record_id = request.path_params['id']
+        async with request.app.state.sessions() as session:
+            # Delete and check the record exists in one statement
+            record = (await session.execute(
+                delete(table_obj).
+                where(table_obj.c.id == record_id).
+                returning(table_obj.c.id))).first()
+            if record is None:
+                raise HTTPException(404)
+            await session.commit()
+        entity_cache.invalidate(table, record_id)
+        return FlaskJSONResponse({
+            'success': True
+        })
+
+    return [
+        Route(f'/{table}/{{id:int}}', show),
+        Route(f'/{table}', show_many),
+        Route(f'/{table}/export', export),
+        Route(f'/{table}/search', search, methods=['POST']),
+        Route(f'/{table}', add, methods=['POST']),
+        Route(f'/{table}/bulk', add_many, methods=['POST']),
+        Route(f'/{table}/{{id:int}}', edit, methods=['PATCH']),
+        Route(f'/{table}/{{id:int}}', remove, methods=['DELETE'])
+    ]
+
+
+def movie_routes():
+    return resource_routes(Movie, 'movies', 'movie_data', MOVIE_COLUMNS,
+                           get_movie_fields)
+
+
+def actor_routes():
+    return resource_routes(Actor, 'actors', 'actor_data', ACTOR_COLUMNS,
+                           get_actor_fields)
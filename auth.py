@@ -1,8 +1,13 @@
+import hashlib
 import json
+import logging
 import os
-from flask import request, abort
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request, abort
 from functools import wraps
-from jose import jwt
+from jose import jwk, jwt
 from urllib.request import urlopen
 
 # *** IMPORTANT ***
@@ -15,6 +20,36 @@ AUTH0_DOMAIN = 'fsnd-djh.au.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'capstone'
 
+# Public keys fetched from Auth0 are kept in memory rather than being
+# requested for every call. Keys are considered stale after JWKS_TTL
+# seconds, a background thread refreshes them every
+# JWKS_REFRESH_INTERVAL seconds so requests never have to wait for Auth0,
+# and tokens signed with an unknown key can only trigger a refetch once
+# every JWKS_MIN_REFETCH_INTERVAL seconds
+JWKS_TTL = int(os.environ.get('CAPSTONE_JWKS_TTL', 3600))
+JWKS_REFRESH_INTERVAL = \
+    int(os.environ.get('CAPSTONE_JWKS_REFRESH_INTERVAL', 600))
+JWKS_MIN_REFETCH_INTERVAL = \
+    int(os.environ.get('CAPSTONE_JWKS_MIN_REFETCH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = 10
+
+# Offline mode: instead of fetching keys from Auth0, public keys can be
+# pinned with CAPSTONE_JWKS_FILE (path to a JWKS document or PEM public key)
+# or CAPSTONE_JWKS (the document or PEM key itself). When the file is used,
+# setting CAPSTONE_JWKS_RELOAD to a number of seconds makes the file get
+# checked for changes that often. A PEM key is given the key id
+# CAPSTONE_JWT_KID, which tokens signed with it must carry in their header
+LOCAL_JWKS_FILE = os.environ.get('CAPSTONE_JWKS_FILE')
+LOCAL_JWKS = os.environ.get('CAPSTONE_JWKS')
+LOCAL_JWKS_RELOAD = int(os.environ.get('CAPSTONE_JWKS_RELOAD', 0))
+LOCAL_JWT_KID = os.environ.get('CAPSTONE_JWT_KID', 'local')
+
+# Maximum number of verified tokens remembered so that repeated use of the
+# same token skips signature verification. Set to 0 to disable the cache
+TOKEN_CACHE_SIZE = int(os.environ.get('CAPSTONE_TOKEN_CACHE_SIZE', 1024))
+
+logger = logging.getLogger(__name__)
+
 
 # AuthError Exception
 # A standardized way to communicate auth failure modes
@@ -25,18 +60,23 @@ class AuthError(Exception):
 
 
 # Retrieve the authentication header from the request
-def get_token_auth_header():
-    if len(request.headers) == 0:
+# (or from the given headers when called outside a Flask request)
+def get_token_auth_header(headers=None):
+    if headers is None:
+        headers = request.headers
+    auth_header = headers.get('Authorization')
+    # counting a request's headers means reading its whole WSGI
+    # environment, so it is only done when there's no Authorization header
+    if auth_header is None and len(headers) == 0:
         raise AuthError({
             'code': 'missing_header',
             'description': 'Request lacks headers.'
         }, 401)
-    if 'Authorization' not in request.headers:
+    if auth_header is None:
         raise AuthError({
             'code': 'missing_header',
             'description': 'Request does not contain authorization header'
         }, 401)
-    auth_header = request.headers['Authorization']
     header_parts = auth_header.split(' ')
 
     if len(header_parts) != 2:
@@ -62,8 +102,8 @@ def check_permissions(permission, payload):
             'description': 'No permissions found in authentication token'
         }, 400)
     if permission not in payload['permissions']:
-        print(permission)
-        print(payload['permissions'])
+        logger.debug('Permission %s not in %s', permission,
+                     sorted(payload['permissions']))
         raise AuthError({
             'code': 'invalid_permission',
             'description':
@@ -72,33 +112,198 @@ def check_permissions(permission, payload):
     return True
 
 
+# Request the public keys from Auth0
+def fetch_auth0_jwks():
+    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json',
+                      timeout=JWKS_FETCH_TIMEOUT)
+    return json.loads(jsonurl.read())
+
+
+# In-memory store of public keys, indexed by key id ("kid")
+# fetch_jwks is called with no arguments and returns a JWKS document
+class JWKSKeyStore:
+    def __init__(self, fetch_jwks, ttl=JWKS_TTL,
+                 refresh_interval=JWKS_REFRESH_INTERVAL,
+                 min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL,
+                 background=True, clock=time.monotonic):
+        self.fetch_jwks = fetch_jwks
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.min_refetch_interval = min_refetch_interval
+        self.background = background
+        self.clock = clock
+        self._keys = None
+        self._expires_at = None
+        self._generation = 0
+        self._last_refetch = None
+        self._retry_at = None
+        self._lock = threading.Lock()
+        self._refresher_pid = None
+
+    # Return the public key with the given key id, or None if there is none
+    # With a refresher running, requests only fetch the keys themselves
+    # while there are none yet: keys that have expired (because fetching
+    # them again keeps failing) are still used while the refresher retries
+    def get_key(self, kid):
+        if self.background and self._refresher_pid != os.getpid():
+            self.start_refresher()
+        if self._keys is None or \
+                (not self.background and self._is_expired()):
+            self._try_refresh()
+        if self._keys is None:
+            raise AuthError({
+                'code': 'keys_unavailable',
+                'description': 'Unable to fetch the keys to verify tokens.'
+            }, 503)
+        key = self._keys.get(kid)
+        if key is None and self._may_refetch():
+            self._last_refetch = self.clock()
+            self._try_refresh()
+            key = self._keys.get(kid)
+        return key
+
+    # Fetch the keys again, replacing the stored keys
+    # If fetching fails the previous keys are kept (if there are any),
+    # along with their expiry, and the next attempt is delayed by the
+    # minimum refetch interval
+    def refresh(self):
+        generation = self._generation
+        with self._lock:
+            # another thread may have refreshed the keys while we waited
+            if self._generation != generation:
+                return
+            self._generation += 1
+            try:
+                jwks = self.fetch_jwks()
+            except Exception:
+                self._retry_at = self.clock() + self.min_refetch_interval
+                if self._keys is None:
+                    raise
+                logger.exception('Unable to refresh JWKS, keeping old keys')
+                return
+            self._keys = {
+                key['kid']: {
+                    'kty': key['kty'],
+                    'kid': key['kid'],
+                    'use': key.get('use', 'sig'),
+                    'n': key['n'],
+                    'e': key['e']
+                } for key in jwks['keys']}
+            self._expires_at = self.clock() + self.ttl
+            self._retry_at = None
+
+    # Refresh the keys from a request, unless an earlier attempt failed
+    # less than the minimum refetch interval ago
+    def _try_refresh(self):
+        if self._retry_at is not None and self.clock() < self._retry_at:
+            return
+        try:
+            self.refresh()
+        except Exception:
+            logger.exception('Unable to fetch JWKS')
+
+    # Start a daemon thread that keeps the keys fresh in this process
+    # (a forked worker process starts its own thread on first use)
+    def start_refresher(self):
+        with self._lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+        thread = threading.Thread(target=self._refresh_forever,
+                                  name='jwks-refresher', daemon=True)
+        thread.start()
+
+    # Failed fetches are retried after the minimum refetch interval
+    # rather than the full refresh interval
+    def _refresh_forever(self):
+        pid = os.getpid()
+        while self._refresher_pid == pid:
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Unable to fetch JWKS')
+            if self._retry_at is None:
+                time.sleep(self.refresh_interval)
+            else:
+                time.sleep(self.min_refetch_interval)
+
+    def _is_expired(self):
+        return self.clock() >= self._expires_at
+
+    def _may_refetch(self):
+        return self._last_refetch is None or \
+            self.clock() - self._last_refetch >= self.min_refetch_interval
+
+
+# Convert the text of a JWKS document or PEM public key to a JWKS document
+def parse_local_jwks(text, kid=LOCAL_JWT_KID):
+    text = text.strip()
+    if text.startswith('-----BEGIN'):
+        key = jwk.construct(text, ALGORITHMS[0]).to_dict()
+        return {'keys': [{
+            'kty': key['kty'],
+            'kid': kid,
+            'use': 'sig',
+            'n': key['n'],
+            'e': key['e']
+        }]}
+    return json.loads(text)
+
+
+# Loads keys from a local file, only re-reading it when it has changed
+class LocalJWKSFile:
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+        self._jwks = None
+
+    def __call__(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self._mtime:
+            with open(self.path) as jwks_file:
+                self._jwks = parse_local_jwks(jwks_file.read())
+            self._mtime = mtime
+        return self._jwks
+
+
+# Build the key store for the configured mode. Pinned keys never expire
+# and are loaded straight away, so configuration mistakes are found
+# at startup rather than on the first request
+def create_key_store():
+    if LOCAL_JWKS_FILE:
+        store = JWKSKeyStore(LocalJWKSFile(LOCAL_JWKS_FILE),
+                             ttl=float('inf'),
+                             refresh_interval=LOCAL_JWKS_RELOAD,
+                             background=LOCAL_JWKS_RELOAD > 0)
+    elif LOCAL_JWKS:
+        jwks = parse_local_jwks(LOCAL_JWKS)
+        store = JWKSKeyStore(lambda: jwks, ttl=float('inf'),
+                             background=False)
+    else:
+        return JWKSKeyStore(fetch_auth0_jwks)
+    store.refresh()
+    return store
+
+
+jwks_store = create_key_store()
+
+
 # Verify that the JWT matches the public key
 # and then decode it to extract the payload
-def verify_decode_jwt(token):
-    # Request public key from Auth0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-
+def verify_decode_jwt(token, key_store=None):
     # Extract the header from the JWT - we need to verify it
     unverified_header = jwt.get_unverified_header(token)
 
     # Choose the public key that matches the JWT
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    if key_store is None:
+        key_store = jwks_store
+    rsa_key = key_store.get_key(unverified_header['kid'])
 
     # Use the public key to verify that the JWT is valid
     if rsa_key:
@@ -139,6 +344,65 @@ def verify_decode_jwt(token):
             }, 400)
 
 
+# Bounded LRU cache of the payloads of tokens that have already been
+# verified, keyed by a hash of the token so raw tokens aren't kept in memory
+# Entries are dropped once the token's "exp" claim has passed, using the
+# same whole-second comparison as jwt.decode, so expiry behaves exactly
+# as if the token had been verified again
+class VerifiedTokenCache:
+    def __init__(self, max_size=TOKEN_CACHE_SIZE, clock=time.time):
+        self.max_size = max_size
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Return the cached payload for this token, or None if there is none
+    def get(self, token):
+        key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            payload, expires = entry
+            if int(self.clock()) > expires:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    # Store the payload of a verified token and return the stored version,
+    # which has its permissions converted to a frozenset for quick checks
+    def put(self, token, payload):
+        payload = dict(payload)
+        if 'permissions' in payload:
+            payload['permissions'] = frozenset(payload['permissions'])
+        expires = payload.get('exp')
+        if self.max_size <= 0 or not isinstance(expires, (int, float)):
+            return payload
+        key = hashlib.sha256(token.encode()).digest()
+        with self._lock:
+            self._entries[key] = (payload, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return payload
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = VerifiedTokenCache()
+
+
+# Return the payload for a token, only verifying it if it isn't cached
+def get_verified_payload(token):
+    payload = token_cache.get(token)
+    if payload is None:
+        payload = token_cache.put(token, verify_decode_jwt(token))
+    return payload
+
+
 # Decorator for ensuring that a function can only be called
 # if the user has specific permissions
 # Wrapped function should have variable "request" in its scope
@@ -147,11 +411,18 @@ def requires_auth(permission=''):
         @wraps(f)
         def wrapper(*args, **kwargs):
             if auth_master:
-                token = get_token_auth_header()
-                payload = verify_decode_jwt(token)
-                check_permissions(permission, payload)
+                started = time.perf_counter()
+                try:
+                    token = get_token_auth_header()
+                    payload = get_verified_payload(token)
+                    check_permissions(permission, payload)
+                finally:
+                    # recorded with the request's metrics (see metrics.py)
+                    g.auth_seconds = time.perf_counter() - started
                 return f(*args, **kwargs)
             else:
                 return f(*args, **kwargs)
+        # used to tell which routes only read from the database
+        wrapper.required_permission = permission
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,102 @@
+from flask import abort, request
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError
+from json_provider import jsonify
+
+# Largest number of records that may be requested in one batch lookup
+MAX_BATCH_IDS = 100
+
+# Largest number of records that may be created in one bulk request
+MAX_BULK_RECORDS = 1000
+
+
+# Retrieve the comma-separated "ids" query parameter as a list of unique ids
+# in the order given, aborting with a 400 error if it is missing, malformed
+# or asks for too many records
+def get_requested_ids(ids_param=None):
+    if ids_param is None:
+        ids_param = request.args.get('ids')
+    if ids_param is None:
+        abort(400)
+    try:
+        ids = [int(id) for id in ids_param.split(',')]
+    except ValueError:
+        abort(400)
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > MAX_BATCH_IDS:
+        abort(400)
+    return ids
+
+
+# Insert the records described in the request body under "key" in a single
+# transaction, using one multi-row INSERT ... RETURNING for the valid ones
+# get_fields returns the columns to insert for a record, or None if the
+# record is invalid. Invalid records are reported by their position and
+# skipped, unless the body sets "atomic" in which case nothing is inserted
+def bulk_insert(db, model, key, get_fields):
+    batch = BulkRecords(request.get_json(), key, get_fields)
+    if batch.rejected:
+        return jsonify(batch.rejection()), 422
+
+    new_ids = []
+    if batch.rows:
+        table = model.__table__
+        try:
+            result = db.session.execute(
+                insert(table).values(batch.rows).returning(table.c.id))
+            new_ids = result.scalars().all()
+            db.session.commit()
+        except DataError:
+            # values the database can't store (such as malformed dates)
+            db.session.rollback()
+            abort(422)
+    return jsonify(batch.result(new_ids))
+
+
+# The records of a bulk request, split into the rows to insert and errors
+# describing the invalid ones. Aborts with a 400 error if the body is
+# malformed or holds too many records
+class BulkRecords:
+    def __init__(self, body, key, get_fields):
+        if not isinstance(body, dict) or \
+                not isinstance(body.get(key), list):
+            abort(400)
+        records = body[key]
+        atomic = body.get('atomic', False)
+        if not isinstance(atomic, bool) or len(records) > MAX_BULK_RECORDS:
+            abort(400)
+        self.count = len(records)
+        self.rows = []
+        self.positions = []
+        self.errors = []
+        for index, record in enumerate(records):
+            fields = get_fields(record)
+            if fields is None:
+                self.errors.append({'index': index, 'error': 400,
+                                    'message': 'Bad Request'})
+            else:
+                self.rows.append(fields)
+                self.positions.append(index)
+        # nothing is inserted if any record of an atomic request is invalid
+        self.rejected = atomic and bool(self.errors)
+
+    def rejection(self):
+        return {
+            'success': False,
+            'error': 422,
+            'message': 'Unprocessable Entity',
+            'errors': self.errors
+        }
+
+    # Response body, given the ids returned when inserting the rows
+    def result(self, new_ids):
+        ids = [None] * self.count
+        # PostgreSQL returns the rows of a multi-row VALUES insert in order
+        for index, new_id in zip(self.positions, new_ids):
+            ids[index] = new_id
+        return {
+            'success': True,
+            'ids': ids,
+            'created': len(self.rows),
+            'errors': self.errors
+        }
@@ -0,0 +1,487 @@
+# Load testing of a running server, using the requests of the bundled
+# Postman collections
+# Each request in a role's folder (e.g. "Executive Producer") becomes a
+# scenario, chosen at random in proportion to its weight by each of a
+# number of concurrent clients for the length of the run. The throughput
+# and latency percentiles of each endpoint are printed, and can be saved
+# as a JSON baseline to compare later runs against:
+#   python benchmark.py --duration 30 --output baseline.json
+#   python benchmark.py --duration 30 --compare baseline.json
+# Without --key-file, the server should run with CAPSTONE_RBAC_SKIP=1 and
+# only the Executive Producer's requests are sent, as every request is
+# then allowed. With --key-file, tokens for each role are minted with the
+# local private key (see "Running without Auth0" in the README), and the
+# server should use the matching CAPSTONE_JWKS_FILE
+
+import argparse
+import datetime
+import http.client
+import json
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+DEFAULT_COLLECTION = 'udacity-fsnd-capstone-local.postman_collection.json'
+
+# Roles of the collections' folders, as named in local_auth. The
+# Public folder's requests are sent without a token
+ROLE_FOLDERS = {
+    'Executive Producer': 'producer',
+    'Casting Director': 'director',
+    'Casting Assistant': 'assistant',
+    'Public': None
+}
+
+# Relative weights of the kinds of requests, by the first word of the
+# request's name in the collection (e.g. "search-movie")
+DEFAULT_WEIGHTS = {'get': 40, 'search': 30, 'patch': 10, 'post': 10,
+                   'delete': 10}
+
+PERCENTILES = (50, 95, 99)
+
+# Width of the endpoint column of printed results
+ENDPOINT_WIDTH = 44
+
+
+class Scenario:
+    def __init__(self, role, name, method, path, body, expected_status,
+                 weight):
+        self.role = role
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.expected_status = expected_status
+        self.weight = weight
+        # IDs in paths are replaced, so that requests for different
+        # records are reported as one endpoint. Each role's requests are
+        # reported separately, as those refused by permission checks
+        # take far less time than the same requests allowed
+        self.endpoint = f'{role}: {method} ' + re.sub(
+            r'/(\d+|\{\{[^}]*\}\})(?=/|$)', '/<id>', path)
+
+    # Deletions that are expected to succeed delete records created
+    # by the benchmark rather than those in the collection
+    @property
+    def deletes_created(self):
+        return self.method == 'DELETE' and 200 <= self.expected_status < 300
+
+    @property
+    def collection_path(self):
+        return self.path.rsplit('/', 1)[0]
+
+
+def substitute(text, variables):
+    return re.sub(r'\{\{([^}]*)\}\}',
+                  lambda match: variables.get(match.group(1), match.group(0)),
+                  text)
+
+
+def expected_status(item):
+    for item_event in item.get('event', []):
+        if item_event.get('listen') != 'test':
+            continue
+        script = ''.join(item_event['script'].get('exec', []))
+        match = re.search(r'have\.status\((\d+)\)', script)
+        if match:
+            return int(match.group(1))
+    return 200
+
+
+# Read the scenarios of the given roles' folders from a Postman
+# collection, leaving out those whose weight is 0
+def load_scenarios(path, roles, weights=DEFAULT_WEIGHTS):
+    with open(path) as collection_file:
+        collection = json.load(collection_file)
+    variables = {variable['key']: variable['value']
+                 for variable in collection.get('variable', [])
+                 if variable['value']}
+    scenarios = []
+
+    def walk(items, role):
+        for item in items:
+            if 'item' in item:
+                walk(item['item'], item['name']
+                     if item['name'] in ROLE_FOLDERS else role)
+                continue
+            if role not in roles:
+                continue
+            weight = weights.get(item['name'].split('-')[0], 0)
+            if weight <= 0:
+                continue
+            request = item['request']
+            url = request['url']
+            raw = url['raw'] if isinstance(url, dict) else url
+            # the host is given separately, so only the path is kept
+            path = '/' + '/'.join(url['path']) if isinstance(url, dict) \
+                else raw.replace('{{host}}', '')
+            body = request.get('body', {}).get('raw') or None
+            scenarios.append(Scenario(
+                role, item['name'], request['method'],
+                substitute(path, variables).replace('//', '/'),
+                body, expected_status(item), weight))
+
+    walk(collection['item'], None)
+    return scenarios
+
+
+def parse_weights(text):
+    weights = dict(DEFAULT_WEIGHTS)
+    for pair in text.split(','):
+        if pair.strip():
+            name, weight = pair.split('=')
+            weights[name.strip()] = float(weight)
+    return weights
+
+
+# Sends requests over one kept-alive connection
+class HTTPClient:
+    def __init__(self, base_url, timeout=30):
+        parts = urlsplit(base_url if '://' in base_url
+                         else f'http://{base_url}')
+        connection_class = http.client.HTTPSConnection \
+            if parts.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection_class(parts.netloc, timeout=timeout)
+        self.prefix = parts.path.rstrip('/')
+
+    def request(self, method, path, body=None, headers=None):
+        try:
+            self.connection.request(method, self.prefix + path, body,
+                                    headers or {})
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            # reconnect on the next request
+            self.connection.close()
+            raise
+
+    def close(self):
+        self.connection.close()
+
+
+# Latencies and statuses of the responses to one endpoint
+class EndpointStats:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+
+    def add(self, latency, status, expected):
+        self.latencies.append(latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status != expected:
+            self.errors += 1
+
+    def merge(self, other):
+        self.latencies.extend(other.latencies)
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.errors += other.errors
+
+    def summary(self, elapsed):
+        latencies = sorted(self.latencies)
+        summary = {
+            'requests': len(latencies),
+            'errors': self.errors,
+            'throughput': round(len(latencies) / elapsed, 2),
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3)
+            if latencies else None,
+            'max_ms': round(latencies[-1] * 1000, 3) if latencies else None,
+            'statuses': {str(status): count for status, count
+                         in sorted(self.statuses.items(),
+                                   key=lambda item: str(item[0]))}
+        }
+        for percentile in PERCENTILES:
+            summary[f'p{percentile}_ms'] = round(
+                nearest_rank(latencies, percentile) * 1000, 3) \
+                if latencies else None
+        return summary
+
+
+def nearest_rank(ordered, percentile):
+    index = max(0, -(-len(ordered) * percentile // 100) - 1)
+    return ordered[index]
+
+
+class Benchmark:
+    def __init__(self, scenarios, connect, tokens=None, concurrency=10,
+                 seed=None):
+        self.scenarios = scenarios
+        self.connect = connect
+        self.tokens = tokens or {}
+        self.concurrency = concurrency
+        self.seed = seed
+        self.weights = [scenario.weight for scenario in scenarios]
+        # IDs of records created by the benchmark, by collection path,
+        # which successful deletions use up
+        self.created = {}
+        self._created_lock = threading.Lock()
+        # scenarios creating records, to make records to delete with
+        self.creators = {(scenario.role, scenario.path): scenario
+                         for scenario in scenarios
+                         if scenario.method == 'POST' and
+                         200 <= scenario.expected_status < 300}
+
+    def headers(self, scenario):
+        headers = {'Content-Type': 'application/json'}
+        token = self.tokens.get(scenario.role)
+        if token is not None:
+            headers['Authorization'] = f'Bearer {token}'
+        return headers
+
+    def send(self, client, scenario, path=None):
+        body = scenario.body.encode('utf-8') if scenario.body else None
+        started = time.perf_counter()
+        status, data = client.request(scenario.method, path or scenario.path,
+                                      body, self.headers(scenario))
+        latency = time.perf_counter() - started
+        if scenario.method == 'POST' and 200 <= status < 300:
+            self.remember_created(scenario.path, data)
+        return latency, status
+
+    def remember_created(self, path, data):
+        try:
+            record_id = json.loads(data).get('id')
+        except (ValueError, AttributeError):
+            return
+        if isinstance(record_id, int):
+            with self._created_lock:
+                self.created.setdefault(path, []).append(record_id)
+
+    # Path of a record created by the benchmark for a deletion to use,
+    # creating one first (untimed) if there are none
+    def deletable_path(self, client, scenario):
+        collection_path = scenario.collection_path
+        with self._created_lock:
+            ids = self.created.get(collection_path)
+            if ids:
+                return f'{collection_path}/{ids.pop()}'
+        creator = self.creators.get((scenario.role, collection_path))
+        if creator is None:
+            return scenario.path
+        self.send(client, creator)
+        with self._created_lock:
+            ids = self.created.get(collection_path)
+            if ids:
+                return f'{collection_path}/{ids.pop()}'
+        return scenario.path
+
+    def worker(self, index, stop_at, measure_from, results):
+        rng = random.Random(None if self.seed is None
+                            else self.seed + index)
+        client = self.connect()
+        stats = {}
+        try:
+            while time.perf_counter() < stop_at:
+                scenario = rng.choices(self.scenarios, self.weights)[0]
+                try:
+                    path = self.deletable_path(client, scenario) \
+                        if scenario.deletes_created else None
+                    latency, status = self.send(client, scenario, path)
+                except (OSError, http.client.HTTPException):
+                    latency, status = None, 'error'
+                if time.perf_counter() < measure_from:
+                    continue
+                endpoint_stats = stats.setdefault(scenario.endpoint,
+                                                  EndpointStats())
+                if latency is None:
+                    endpoint_stats.statuses['error'] = \
+                        endpoint_stats.statuses.get('error', 0) + 1
+                    endpoint_stats.errors += 1
+                else:
+                    endpoint_stats.add(latency, status,
+                                       scenario.expected_status)
+        finally:
+            client.close()
+            results[index] = stats
+
+    # Run for the given number of seconds, after an unmeasured warm-up,
+    # and return the results by endpoint
+    def run(self, duration, warmup=0):
+        started = time.perf_counter()
+        measure_from = started + warmup
+        stop_at = measure_from + duration
+        results = [None] * self.concurrency
+        threads = [threading.Thread(target=self.worker,
+                                    args=(index, stop_at, measure_from,
+                                          results))
+                   for index in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - measure_from
+
+        endpoints = {}
+        total = EndpointStats()
+        for stats in results:
+            for endpoint, endpoint_stats in (stats or {}).items():
+                endpoints.setdefault(endpoint, EndpointStats()).merge(
+                    endpoint_stats)
+                total.merge(endpoint_stats)
+        return {
+            'duration': round(elapsed, 3),
+            'concurrency': self.concurrency,
+            'total': total.summary(elapsed),
+            'endpoints': {endpoint: endpoint_stats.summary(elapsed)
+                          for endpoint, endpoint_stats
+                          in sorted(endpoints.items())}
+        }
+
+
+def mint_role_tokens(key_file, kid, roles):
+    # imported here as importing auth sets up its key store, which the
+    # benchmark only needs when minting tokens
+    from local_auth import ROLE_PERMISSIONS, mint_token
+    with open(key_file) as private_file:
+        private_pem = private_file.read()
+    return {role: mint_token(private_pem, ROLE_PERMISSIONS[ROLE_FOLDERS[role]],
+                             kid)
+            for role in roles if ROLE_FOLDERS[role] is not None}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_ms(value):
+    return '-' if value is None else f'{value:.1f}'
+
+
+def print_results(results, out=sys.stdout):
+    print(f'{"endpoint":<{ENDPOINT_WIDTH}}{"requests":>9}{"errors":>8}'
+          f'{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}', file=out)
+    rows = list(results['endpoints'].items()) + [('total', results['total'])]
+    for endpoint, summary in rows:
+        print(f'{endpoint:<{ENDPOINT_WIDTH}}{summary["requests"]:>9}'
+              f'{summary["errors"]:>8}{summary["throughput"]:>9.1f}'
+              f'{format_ms(summary["p50_ms"]):>9}'
+              f'{format_ms(summary["p95_ms"]):>9}'
+              f'{format_ms(summary["p99_ms"]):>9}', file=out)
+
+
+def percent_change(old, new):
+    if old is None or new is None or old == 0:
+        return None
+    return (new - old) / old * 100
+
+
+# Compare results with a baseline, returning the changes in throughput
+# and latency by endpoint, and the endpoints whose p95 latency rose by
+# more than max_regression percent
+def compare(baseline, results, max_regression=None):
+    changes = {}
+    regressions = []
+    for endpoint, summary in results['endpoints'].items():
+        old = baseline['endpoints'].get(endpoint)
+        if old is None:
+            continue
+        changes[endpoint] = {
+            key: percent_change(old.get(key), summary.get(key))
+            for key in ['throughput'] + [f'p{p}_ms' for p in PERCENTILES]}
+        p95_change = changes[endpoint]['p95_ms']
+        if max_regression is not None and p95_change is not None and \
+                p95_change > max_regression:
+            regressions.append(endpoint)
+    return changes, regressions
+
+
+def print_comparison(changes, out=sys.stdout):
+    def signed(value):
+        return '-' if value is None else f'{value:+.1f}%'
+    print(f'{"endpoint":<{ENDPOINT_WIDTH}}{"req/s":>9}{"p50":>9}'
+          f'{"p95":>9}{"p99":>9}', file=out)
+    for endpoint, change in changes.items():
+        print(f'{endpoint:<{ENDPOINT_WIDTH}}{signed(change["throughput"]):>9}'
+              f'{signed(change["p50_ms"]):>9}{signed(change["p95_ms"]):>9}'
+              f'{signed(change["p99_ms"]):>9}', file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Load test a running server with the requests of a '
+                    'Postman collection')
+    parser.add_argument('--collection', default=DEFAULT_COLLECTION)
+    parser.add_argument('--host', default='localhost:5000',
+                        help='address of the server, optionally with '
+                             'http:// or https://')
+    parser.add_argument('--roles', default=None,
+                        help='comma separated folders to send the requests '
+                             'of (default all with --key-file, otherwise '
+                             'Executive Producer)')
+    parser.add_argument('--weights', default='',
+                        help='comma separated changes to the weights of '
+                             'kinds of requests, e.g. get=50,delete=0')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to measure for')
+    parser.add_argument('--warmup', type=float, default=5,
+                        help='seconds to send requests for before measuring')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--key-file', default=None,
+                        help='local private key to mint role tokens with')
+    parser.add_argument('--kid', default='local')
+    parser.add_argument('--output', default=None,
+                        help='file to save the results to as JSON')
+    parser.add_argument('--compare', default=None,
+                        help='JSON results of an earlier run to compare with')
+    parser.add_argument('--max-regression', type=float, default=None,
+                        help='exit with status 1 if the p95 latency of any '
+                             'endpoint rose by more than this percentage')
+    args = parser.parse_args(argv)
+
+    if args.roles is not None:
+        roles = [role.strip() for role in args.roles.split(',')]
+        unknown = set(roles) - set(ROLE_FOLDERS)
+        if unknown:
+            parser.error(f'unknown roles: {", ".join(sorted(unknown))}')
+    elif args.key_file is not None:
+        roles = list(ROLE_FOLDERS)
+    else:
+        roles = ['Executive Producer']
+    scenarios = load_scenarios(args.collection, roles,
+                               parse_weights(args.weights))
+    if not scenarios:
+        parser.error('no requests to send')
+    tokens = mint_role_tokens(args.key_file, args.kid, roles) \
+        if args.key_file is not None else {}
+
+    benchmark = Benchmark(scenarios, lambda: HTTPClient(args.host), tokens,
+                          args.concurrency, args.seed)
+    results = benchmark.run(args.duration, args.warmup)
+    results.update({
+        'host': args.host,
+        'roles': roles,
+        'commit': git_commit(),
+        'finished_at': datetime.datetime.now(
+            datetime.timezone.utc).isoformat(timespec='seconds')
+    })
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        changes, regressions = compare(baseline, results,
+                                       args.max_regression)
+        print(f'\nChanges since {baseline.get("commit") or args.compare}:')
+        print_comparison(changes)
+        if regressions:
+            print(f'\np95 latency regressed by more than '
+                  f'{args.max_regression}%: {", ".join(regressions)}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
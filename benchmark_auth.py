@@ -0,0 +1,177 @@
+# Microbenchmarks of the authentication that every route goes through
+# Each case times one step of requires_auth (reading the header, verifying
+# the token, checking permissions) or the whole decorator, in microseconds
+# per call, using a locally generated key pair rather than Auth0:
+#   python benchmark_auth.py
+#   python benchmark_auth.py --filter decorator --output auth.json
+# "cold" cases verify the token's signature each time, as for the first
+# request with a token, and "warm" cases find it in the verified token
+# cache, as for the requests after that. Before timing, each case is run
+# once to check that it succeeds or fails as its name says
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+# auth reads this when imported; permissions are checked regardless,
+# as the benchmark turns checking on while it runs
+os.environ.setdefault('CAPSTONE_RBAC_SKIP', '1')
+
+from flask import Flask
+import auth
+from auth import AuthError, JWKSKeyStore, check_permissions, \
+    get_token_auth_header, get_verified_payload, requires_auth, \
+    verify_decode_jwt
+from local_auth import ROLE_PERMISSIONS, generate_key_pair, mint_token
+
+
+class Case:
+    def __init__(self, name, func, error_code=None, setup=None):
+        self.name = name
+        self.func = func
+        # code of the AuthError the case should raise, if any
+        self.error_code = error_code
+        # called before each call, untimed
+        self.setup = setup
+
+    def call(self):
+        try:
+            self.func()
+        except AuthError as e:
+            if e.error['code'] != self.error_code:
+                raise
+            return
+        if self.error_code is not None:
+            raise RuntimeError(f'{self.name}: expected {self.error_code}')
+
+    # Microseconds per call, the fastest of several repeats
+    def time(self, repeat=5, number=None):
+        if self.setup is not None:
+            self.setup()
+        self.call()
+        if self.setup is not None:
+            # setup has to run between calls, so calls are timed singly
+            timer = timeit.Timer(self.call, setup=self.setup)
+            number = 1
+            repeat = max(repeat, 200)
+        else:
+            timer = timeit.Timer(self.call)
+            if number is None:
+                number = timer.autorange()[0]
+        return min(timer.repeat(repeat, number)) / number * 1e6
+
+
+def make_key_store(jwks):
+    return JWKSKeyStore(lambda: jwks, ttl=float('inf'), background=False)
+
+
+# Build the cases, using the given key pair. The key store and token
+# cache they use are installed as auth's own while the cases run
+def build_cases(private_pem, jwks):
+    key_store = make_key_store(jwks)
+    key_store.refresh()
+    permissions = ROLE_PERMISSIONS['producer']
+    token = mint_token(private_pem, permissions)
+    expired = mint_token(private_pem, permissions, expires_in=-60)
+    wrong_kid = mint_token(private_pem, permissions, kid='unknown')
+    headers = {'Authorization': f'Bearer {token}'}
+    payload = verify_decode_jwt(token, key_store)
+    cached_payload = auth.token_cache.put(token, payload)
+
+    @requires_auth('get:movies')
+    def route():
+        return 'ok'
+
+    @requires_auth('post:unknown')
+    def forbidden_route():
+        return 'ok'
+
+    def new_key_store():
+        return make_key_store(jwks)
+
+    return [
+        Case('header: valid', lambda: get_token_auth_header(headers)),
+        Case('header: missing', lambda: get_token_auth_header(
+            {'Accept': '*/*'}), 'missing_header'),
+        Case('header: malformed', lambda: get_token_auth_header(
+            {'Authorization': token}), 'malformed_header'),
+        Case('verify: valid', lambda: verify_decode_jwt(token, key_store)),
+        Case('verify: valid, keys not yet loaded', lambda: verify_decode_jwt(
+            token, new_key_store())),
+        Case('verify: expired', lambda: verify_decode_jwt(
+            expired, key_store), 'token_expired'),
+        Case('verify: wrong kid', lambda: verify_decode_jwt(
+            wrong_kid, key_store), 'invalid_header'),
+        Case('permissions: list', lambda: check_permissions(
+            'delete:actors', payload)),
+        Case('permissions: frozenset', lambda: check_permissions(
+            'delete:actors', cached_payload)),
+        Case('permissions: missing', lambda: check_permissions(
+            'post:unknown', cached_payload), 'invalid_permission'),
+        Case('token cache: cold', lambda: get_verified_payload(token),
+             setup=auth.token_cache.clear),
+        Case('token cache: warm', lambda: get_verified_payload(token)),
+        Case('decorator: cold', route, setup=auth.token_cache.clear),
+        Case('decorator: warm', route),
+        Case('decorator: warm, forbidden', forbidden_route,
+             'invalid_permission'),
+        Case('decorator: expired', route, 'token_expired',
+             setup=lambda: set_token(expired)),
+        Case('decorator: wrong kid', route, 'invalid_header',
+             setup=lambda: set_token(wrong_kid))
+    ], key_store, headers
+
+
+def set_token(token):
+    from flask import request
+    request.environ['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+
+
+# Time the cases whose names contain filter_text, returning
+# microseconds per call by name
+def run(private_pem, jwks, filter_text='', repeat=5, number=None):
+    app = Flask(__name__)
+    saved = auth.auth_master, auth.jwks_store
+    auth.auth_master = True
+    try:
+        cases, auth.jwks_store, headers = build_cases(private_pem, jwks)
+        results = {}
+        for case in cases:
+            if filter_text not in case.name:
+                continue
+            # the decorator reads the request's headers, which
+            # the expired and wrong kid cases replace
+            with app.test_request_context(headers=headers):
+                results[case.name] = case.time(repeat, number)
+        return results
+    finally:
+        auth.auth_master, auth.jwks_store = saved
+        auth.token_cache.clear()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time the steps of authenticating a request')
+    parser.add_argument('--filter', default='',
+                        help='only run cases whose names contain this')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--bits', type=int, default=2048,
+                        help='size of the RSA key to sign tokens with')
+    parser.add_argument('--output', default=None,
+                        help='file to save the results to as JSON')
+    args = parser.parse_args(argv)
+
+    private_pem, jwks = generate_key_pair(bits=args.bits)
+    results = run(private_pem, jwks, args.filter, args.repeat)
+    for name, microseconds in results.items():
+        print(f'{name:<40}{microseconds:>12.2f} us')
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+# Read-through cache for single records, used by the show routes so that
+# frequently viewed movies and actors don't need a database query
+# Writes invalidate the cached record after they are committed
+
+import os
+import pickle
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+# Which backend to use: 'local' (in-process LRU), 'shared' (the stand-in
+# for a cache shared between processes) or 'none' to disable caching
+ENTITY_CACHE_BACKEND = os.environ.get('CAPSTONE_ENTITY_CACHE', 'local')
+ENTITY_CACHE_SIZE = int(os.environ.get('CAPSTONE_ENTITY_CACHE_SIZE', 10000))
+# Seconds before a cached record must be read from the database again
+# With the local backend, this also bounds how long other worker processes
+# can serve a record after it has been changed
+ENTITY_CACHE_TTL = float(os.environ.get('CAPSTONE_ENTITY_CACHE_TTL', 60))
+
+
+# Interface for cache backends. A backend shared between processes (such
+# as Redis or Memcached) only needs to provide these three operations
+class CacheBackend(ABC):
+    # Return the value stored under key, or None if there isn't one
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    # Store value under key for ttl seconds
+    @abstractmethod
+    def set(self, key, value, ttl):
+        pass
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+
+# Bounded in-process cache that evicts the least recently used entries
+class LocalLRUBackend(CacheBackend):
+    def __init__(self, max_size=ENTITY_CACHE_SIZE, clock=time.monotonic):
+        self.max_size = max_size
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if self.clock() >= expires:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, self.clock() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+# Local stand-in for a shared cache: values are serialized on the way in
+# and out, as they would be when sent to a cache server, so code using it
+# can't come to rely on getting the same objects back
+class LocalSharedBackend(LocalLRUBackend):
+    def get(self, key):
+        value = super().get(key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value, ttl):
+        super().set(key, pickle.dumps(value), ttl)
+
+
+# A backend that stores nothing, for when caching is disabled
+class NullBackend(CacheBackend):
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def delete(self, key):
+        pass
+
+
+# Cache of formatted records, keyed by table name and id,
+# counting hits and misses (under a lock, as the threads of a gthread
+# worker share the cache)
+class EntityCache:
+    def __init__(self, backend, ttl=ENTITY_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, table, id):
+        value = self.backend.get(f'{table}:{id}')
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, table, id, value):
+        self.backend.set(f'{table}:{id}', value, self.ttl)
+
+    def invalidate(self, table, id):
+        self.backend.delete(f'{table}:{id}')
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+def create_backend(name=ENTITY_CACHE_BACKEND):
+    if name == 'none':
+        return NullBackend()
+    if name == 'shared':
+        return LocalSharedBackend()
+    if name == 'local':
+        return LocalLRUBackend()
+    raise ValueError(f'Unknown entity cache backend: {name}')
+
+
+entity_cache = EntityCache(create_backend())
@@ -0,0 +1,94 @@
+# Casting of actors in movies
+# A movie can be read with its cast embedded (GET /movies/1?embed=cast), and
+# an actor with their movies (GET /actors/1?embed=movies), as can batches of
+# them. The related records of every record in a response are loaded with
+# one query, as SQLAlchemy's selectinload does, but only the first
+# "embed_limit" of each record's (by name) are kept, along with how many
+# there are in all. So the number of queries, and the size of a response,
+# are the same however large a cast is
+
+import os
+from flask import abort, request
+from sqlalchemy import func, select
+from sqlalchemy.orm import aliased
+from batch import MAX_BULK_RECORDS
+from models import Actor, Movie, casting
+
+# Number of related records embedded for each record when no limit is
+# given, and the largest number that can be asked for
+DEFAULT_EMBED_LIMIT = int(os.environ.get('CAPSTONE_EMBED_LIMIT', 20))
+MAX_EMBED_LIMIT = 200
+
+# What can be embedded in each table's records, by name: the model of the
+# related records, and the casting columns holding the ids of the records
+# and of the related records
+EMBEDS = {
+    'movies': {'cast': (Actor, casting.c.movie_id, casting.c.actor_id)},
+    'actors': {'movies': (Movie, casting.c.actor_id, casting.c.movie_id)}
+}
+
+
+# Retrieve what to embed in records of the table, and how many of them,
+# from the "embed" and "embed_limit" query parameters, aborting with a
+# 400 error if either is invalid. The name is None if nothing is embedded
+def get_embed_params(table):
+    embed = request.args.get('embed')
+    if embed is None:
+        return None, 0
+    if embed not in EMBEDS[table]:
+        abort(400)
+    try:
+        limit = int(request.args.get('embed_limit', DEFAULT_EMBED_LIMIT))
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    return embed, min(limit, MAX_EMBED_LIMIT)
+
+
+# Load the first "limit" related records (by name) of each of the records
+# with the given ids, in a single query. Returns the related records and
+# their total number by record id; ids with none are left out
+def load_embedded(session, table, embed, ids, limit):
+    model, own_column, related_column = EMBEDS[table][embed]
+    ranked = select(
+        model,
+        own_column.label('owner_id'),
+        func.row_number().over(partition_by=own_column,
+                               order_by=(model.name, model.id)).
+        label('position'),
+        func.count().over(partition_by=own_column).label('total')
+    ).join(casting, related_column == model.id).\
+        where(own_column.in_(ids)).subquery()
+    related = aliased(model, ranked)
+    rows = session.execute(
+        select(related, ranked.c.owner_id, ranked.c.total).
+        where(ranked.c.position <= limit).
+        order_by(ranked.c.owner_id, ranked.c.position))
+    embedded = {}
+    for record, owner_id, total in rows:
+        embedded.setdefault(owner_id, ([], total))[0].append(record)
+    return embedded
+
+
+# Representation of the related records embedded in a record
+def format_embedded(records, total):
+    return {
+        'count': len(records),
+        'total': total,
+        'data': [record.format() for record in records]
+    }
+
+
+# Retrieve the "actor_ids" list from a request body as unique ids in the
+# order given, aborting with a 400 error if it is missing or malformed
+def get_actor_ids(body):
+    if not isinstance(body, dict):
+        abort(400)
+    ids = body.get('actor_ids')
+    if not isinstance(ids, list) or not ids or len(ids) > MAX_BULK_RECORDS:
+        abort(400)
+    if not all(isinstance(id, int) and not isinstance(id, bool)
+               for id in ids):
+        abort(400)
+    return list(dict.fromkeys(ids))
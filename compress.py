@@ -0,0 +1,182 @@
+# Compression of responses, negotiated with the client's Accept-Encoding
+# Responses too small to benefit are sent as they are. Streamed responses
+# (such as exports) are compressed as they are sent, and compressed copies
+# of responses with an ETag are remembered, so that popular records and
+# searches are only compressed once
+
+import os
+import zlib
+from flask import request
+from cache import EntityCache, LocalLRUBackend
+from etags import encoded_etag
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# zstd is in the standard library from Python 3.14, and available
+# from the backports.zstd or zstandard packages before that
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        from backports import zstd
+    except ImportError:
+        zstd = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Encodings to offer, most preferred first. Those whose libraries aren't
+# installed are left out, and an empty list turns compression off
+COMPRESS_ENCODINGS = [
+    name.strip() for name in
+    os.environ.get('CAPSTONE_COMPRESS_ENCODINGS', 'br,zstd,gzip').split(',')
+    if name.strip()]
+# Responses smaller than this many bytes are not compressed, as the
+# saving would be outweighed by the time taken to compress them
+COMPRESS_MIN_SIZE = int(os.environ.get('CAPSTONE_COMPRESS_MIN_SIZE', 1024))
+# Number of compressed responses remembered, and for how many seconds
+COMPRESS_CACHE_SIZE = int(
+    os.environ.get('CAPSTONE_COMPRESS_CACHE_SIZE', 1000))
+COMPRESS_CACHE_TTL = float(os.environ.get('CAPSTONE_COMPRESS_CACHE_TTL', 300))
+
+# Compression levels, chosen for speed as responses are compressed
+# while the client waits
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson',
+                          'application/javascript', 'application/xml')
+
+
+# Streaming brotli compressor with the same methods as zlib's
+class BrotliCompressor:
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+def gzip_compressor():
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+
+def zstd_compressor():
+    if zstd is not None:
+        return zstd.ZstdCompressor(level=ZSTD_LEVEL)
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+
+# Return a dict of the usable encodings, in order of preference, with the
+# functions creating their compressors. Each compressor has compress(data)
+# and flush() methods, like the compressors of zlib
+def available_encodings(names=COMPRESS_ENCODINGS):
+    compressors = {'gzip': gzip_compressor}
+    if brotli is not None:
+        compressors['br'] = BrotliCompressor
+    if zstd is not None or zstandard is not None:
+        compressors['zstd'] = zstd_compressor
+    return {name: compressors[name] for name in names if name in compressors}
+
+
+encodings = available_encodings()
+
+# Compressed bodies of responses with an ETag, keyed by the encoding
+# and the request's method, path with query string, and ETag
+compressed_cache = EntityCache(LocalLRUBackend(COMPRESS_CACHE_SIZE),
+                               COMPRESS_CACHE_TTL)
+
+
+# The encoding the client most prefers, using the server's order of
+# preference between those it likes equally, or None if there isn't one
+def choose_encoding(accept_encodings):
+    best = None
+    best_quality = 0
+    for name in encodings:
+        quality = accept_encodings.quality(name)
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+def is_compressible(response):
+    mimetype = response.mimetype or ''
+    return mimetype.startswith('text/') or \
+        mimetype.endswith('+json') or mimetype in COMPRESSIBLE_MIMETYPES
+
+
+def compress(encoding, data):
+    compressor = encodings[encoding]()
+    return compressor.compress(data) + compressor.flush()
+
+
+# Compress the chunks of a streamed response as they are produced
+# "original" is the response's iterable, which is closed at the end
+def compress_chunks(encoding, chunks, original):
+    compressor = encodings[encoding]()
+    try:
+        for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+    finally:
+        # let the original response clean up (e.g. end its database
+        # transaction) if the client goes away part way through
+        close = getattr(original, 'close', None)
+        if close is not None:
+            close()
+
+
+# Called after each request to compress the response if worthwhile
+def compress_response(response):
+    if not encodings or not is_compressible(response) or \
+            response.direct_passthrough or \
+            'Content-Encoding' in response.headers or \
+            'no-transform' in response.headers.get('Cache-Control', ''):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return response
+    etag, weak = response.get_etag()
+
+    if response.is_streamed:
+        response.response = compress_chunks(
+            encoding, response.iter_encoded(), response.response)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        # the whole URL, as a route's tag needn't cover every
+        # query parameter that changes the body
+        key = f'{request.method} {request.full_path} {etag}'
+        compressed = None
+        if etag is not None:
+            compressed = compressed_cache.get(encoding, key)
+        if compressed is None:
+            compressed = compress(encoding, data)
+            if etag is not None:
+                compressed_cache.set(encoding, key, compressed)
+        response.set_data(compressed)
+    if etag is not None:
+        # a compressed body differs byte for byte from the uncompressed
+        # one, so it has a tag of its own for each encoding
+        response.set_etag(encoded_etag(etag, encoding), weak=weak)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def setup_compression(app):
+    app.after_request(compress_response)
@@ -0,0 +1,307 @@
+# Generation of large synthetic datasets, and snapshots to restore them from
+# Rows are generated in chunks, each from its own random seed and with its
+# own range of ids, so the same seed always produces the same rows whatever
+# the number of processes loading them. Chunks are loaded in parallel with
+# COPY, one connection per process. Secondary indexes are dropped while
+# loading and rebuilt afterwards, which is much faster than updating them
+# row by row, and ANALYZE is run so that the planner knows the new sizes.
+# Snapshots hold every table in PostgreSQL's binary COPY format, and
+# restoring one replaces the tables' contents in a single transaction
+
+import datetime
+import io
+import json
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+import psycopg2
+
+# Number of rows generated and loaded at a time
+GENERATE_CHUNK_ROWS = int(
+    os.environ.get('CAPSTONE_GENERATE_CHUNK_ROWS', 50000))
+
+SNAPSHOT_MANIFEST = 'manifest.json'
+
+# Words that names are made of, most common first. Words are chosen with
+# Zipf-like weights (the nth word is 1/n times as likely as the first), so
+# a few names are very common and most are rare, as in real data
+FIRST_NAMES = (
+    'James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael',
+    'Linda', 'William', 'Elizabeth', 'David', 'Barbara', 'Richard', 'Susan',
+    'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Charles', 'Karen', 'Daniel',
+    'Nancy', 'Matthew', 'Lisa', 'Anthony', 'Margaret', 'Mark', 'Sandra',
+    'Steven', 'Ashley', 'Andrew', 'Emily', 'Kenneth', 'Donna', 'Paul',
+    'Michelle', 'Joshua', 'Carol', 'Kevin', 'Amanda', 'Brian', 'Melissa',
+    'George', 'Deborah', 'Timothy', 'Stephanie', 'Ronald', 'Rebecca',
+    'Jason', 'Laura', 'Ryan', 'Helen', 'Jacob', 'Sharon', 'Gary', 'Cynthia',
+    'Nicholas', 'Kathleen', 'Eric', 'Amy', 'Jonathan', 'Angela', 'Priya',
+    'Wei', 'Aiko', 'Mateo', 'Sofia', 'Omar', 'Fatima', 'Ivan', 'Olga',
+    'Kwame', 'Amara', 'Luca', 'Chiara', 'Hiroshi', 'Yuki', 'Diego', 'Lucia')
+LAST_NAMES = (
+    'Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller',
+    'Davis', 'Rodriguez', 'Martinez', 'Hernandez', 'Lopez', 'Gonzalez',
+    'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin',
+    'Lee', 'Perez', 'Thompson', 'White', 'Harris', 'Sanchez', 'Clark',
+    'Ramirez', 'Lewis', 'Robinson', 'Walker', 'Young', 'Allen', 'King',
+    'Wright', 'Scott', 'Torres', 'Nguyen', 'Hill', 'Flores', 'Green',
+    'Adams', 'Nelson', 'Baker', 'Hall', 'Rivera', 'Campbell', 'Mitchell',
+    'Carter', 'Roberts', 'Kim', 'Patel', 'Chen', 'Singh', 'Tanaka', 'Rossi',
+    'Muller', 'Ivanova', 'Okafor', 'Mensah', 'Silva', 'Santos', 'Novak',
+    "O'Brien", 'Kowalski', 'Haddad', 'Cohen', 'Yamamoto', 'Dubois', 'Larsen')
+TITLE_ADJECTIVES = (
+    'Last', 'Dark', 'Lost', 'Great', 'Silent', 'Secret', 'Final', 'Broken',
+    'Golden', 'Hidden', 'Red', 'Wild', 'Long', 'Little', 'Cold', 'Black',
+    'Forgotten', 'Endless', 'Burning', 'Midnight', 'Savage', 'Crimson',
+    'Hollow', 'Distant', 'Electric', 'Fallen', 'Sweet', 'Bitter', 'Quiet',
+    'Infinite', 'Restless', 'Wicked', 'Velvet', 'Iron', 'Paper', 'Glass')
+TITLE_NOUNS = (
+    'Night', 'Love', 'Man', 'City', 'House', 'Road', 'Day', 'Heart', 'Life',
+    'World', 'King', 'Girl', 'River', 'Dream', 'War', 'Story', 'Game',
+    'Summer', 'Star', 'Sea', 'Shadow', 'Island', 'Storm', 'Garden',
+    'Kingdom', 'Mountain', 'Promise', 'Secret', 'Empire', 'Stranger',
+    'Journey', 'Winter', 'Mirror', 'Moon', 'Fire', 'Ghost', 'Hunter', 'Town',
+    'Queen', 'Voyage', 'Harbor', 'Detective', 'Machine', 'Desert', 'Letter')
+SEQUELS = ('2', '3', 'II', 'III', 'Part Two', 'Returns', 'Reloaded')
+GENDERS = ('female', 'male', 'non-binary')
+
+# Earliest year that release dates are generated for. More films are
+# released each year than the last, so later years are more likely
+FIRST_RELEASE_YEAR = 1920
+
+
+def zipf_cum_weights(words):
+    total = 0
+    cum_weights = []
+    for rank in range(1, len(words) + 1):
+        total += 1 / rank
+        cum_weights.append(total)
+    return cum_weights
+
+
+FIRST_NAME_WEIGHTS = zipf_cum_weights(FIRST_NAMES)
+LAST_NAME_WEIGHTS = zipf_cum_weights(LAST_NAMES)
+ADJECTIVE_WEIGHTS = zipf_cum_weights(TITLE_ADJECTIVES)
+NOUN_WEIGHTS = zipf_cum_weights(TITLE_NOUNS)
+
+
+def actor_name(rng):
+    first = rng.choices(FIRST_NAMES, cum_weights=FIRST_NAME_WEIGHTS)[0]
+    last = rng.choices(LAST_NAMES, cum_weights=LAST_NAME_WEIGHTS)[0]
+    if rng.random() < 0.1:
+        return f'{first} {chr(rng.randrange(65, 91))}. {last}'
+    return f'{first} {last}'
+
+
+def movie_name(rng):
+    adjective = rng.choices(TITLE_ADJECTIVES,
+                            cum_weights=ADJECTIVE_WEIGHTS)[0]
+    noun, other = rng.choices(TITLE_NOUNS, cum_weights=NOUN_WEIGHTS, k=2)
+    pattern = rng.random()
+    if pattern < 0.35:
+        title = f'The {adjective} {noun}'
+    elif pattern < 0.55:
+        title = f'{noun} of the {adjective} {other}'
+    elif pattern < 0.7:
+        title = f'{adjective} {noun}'
+    elif pattern < 0.85:
+        title = f'The {noun} and the {other}'
+    else:
+        title = f'A {noun} in {rng.choice(LAST_NAMES)}ville'
+    if rng.random() < 0.05:
+        title = f'{title} {rng.choice(SEQUELS)}'
+    return title
+
+
+def release_date(rng, last_year):
+    span = last_year - FIRST_RELEASE_YEAR + 1
+    # the square root of a uniform number favours values near 1
+    year = FIRST_RELEASE_YEAR + int(span * rng.random() ** 0.5)
+    day = datetime.date(year, 1, 1) + \
+        datetime.timedelta(days=rng.randrange(365))
+    return day.isoformat()
+
+
+def actor_age(rng):
+    return min(95, max(18, round(rng.gauss(40, 14))))
+
+
+# Lines of COPY's text format for the rows of one chunk. None of the
+# generated values contain tabs, newlines or backslashes, so none need
+# escaping
+def movie_rows(rng, start_id, rows, last_year):
+    for record_id in range(start_id, start_id + rows):
+        yield f'{record_id}\t{movie_name(rng)}\t' \
+            f'{release_date(rng, last_year)}\n'
+
+
+def actor_rows(rng, start_id, rows, last_year):
+    for record_id in range(start_id, start_id + rows):
+        gender = rng.choices(GENDERS, cum_weights=(48, 96, 100))[0]
+        yield f'{record_id}\t{actor_name(rng)}\t{actor_age(rng)}\t{gender}\n'
+
+
+# Columns filled by each table's generator, which is called with a
+# random number generator, the first id, the number of rows and the
+# latest year for release dates
+GENERATORS = {
+    'movies': (('id', 'name', 'release_date'), movie_rows),
+    'actors': (('id', 'name', 'age', 'gender'), actor_rows)
+}
+
+
+# libpq connection string for a SQLAlchemy engine's database
+def engine_dsn(engine):
+    return engine.url.set(drivername='postgresql').render_as_string(
+        hide_password=False)
+
+
+# Generate and copy the rows of one chunk in its own transaction
+def load_chunk(dsn, table, seed, chunk, start_id, rows, last_year):
+    columns, generate = GENERATORS[table]
+    rng = random.Random(f'{seed}:{table}:{chunk}')
+    data = io.StringIO(''.join(generate(rng, start_id, rows, last_year)))
+    connection = psycopg2.connect(dsn)
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.copy_expert(
+                f'COPY {table} ({", ".join(columns)}) FROM STDIN', data)
+    finally:
+        connection.close()
+    return rows
+
+
+# Names and definitions of a table's indexes, other than those
+# belonging to constraints such as its primary key
+def secondary_indexes(cursor, table):
+    cursor.execute(
+        'SELECT indexname, indexdef FROM pg_indexes '
+        'WHERE schemaname = current_schema() AND tablename = %s '
+        'AND indexname NOT IN (SELECT conname FROM pg_constraint '
+        'WHERE conrelid = %s::regclass) ORDER BY indexname',
+        (table, table))
+    return cursor.fetchall()
+
+
+def drop_indexes(cursor, indexes):
+    for name, definition in indexes:
+        cursor.execute(f'DROP INDEX IF EXISTS "{name}"')
+
+
+def create_indexes(cursor, indexes):
+    for name, definition in indexes:
+        cursor.execute(definition)
+
+
+# Set the table's id sequence to follow on from its highest id
+def reset_sequence(cursor, table):
+    cursor.execute(
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+        f"coalesce(max(id), 0) + 1, false) FROM {table}")
+
+
+# Add the given number of generated rows to a table, after its existing
+# rows, returning the number added. The rows depend only on the seed,
+# the ids they start from and the chunk size
+def generate_table(dsn, table, count, seed=0, chunk_rows=GENERATE_CHUNK_ROWS,
+                   workers=None, defer_indexes=True, last_year=None):
+    if last_year is None:
+        last_year = datetime.date.today().year
+    connection = psycopg2.connect(dsn)
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute(f'SELECT coalesce(max(id), 0) + 1 FROM {table}')
+            first_id = cursor.fetchone()[0]
+            indexes = secondary_indexes(cursor, table) \
+                if defer_indexes else []
+            drop_indexes(cursor, indexes)
+        try:
+            chunks = [(dsn, table, seed, chunk, first_id + offset,
+                       min(chunk_rows, count - offset), last_year)
+                      for chunk, offset in
+                      enumerate(range(0, count, chunk_rows))]
+            if workers == 1 or len(chunks) <= 1:
+                loaded = sum(load_chunk(*chunk) for chunk in chunks)
+            else:
+                with ProcessPoolExecutor(workers) as executor:
+                    loaded = sum(executor.map(load_chunk, *zip(*chunks)))
+        finally:
+            # rebuild the indexes even if loading failed, as the
+            # chunks that were loaded have been committed
+            with connection, connection.cursor() as cursor:
+                create_indexes(cursor, indexes)
+                reset_sequence(cursor, table)
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {table}')
+    finally:
+        connection.close()
+    return loaded
+
+
+# Columns of a table that hold data, leaving out generated ones
+def stored_columns(table):
+    return [column.name for column in table.columns
+            if column.computed is None]
+
+
+# Write every table to files in the directory, as they were at one moment
+def snapshot(dsn, tables, directory):
+    os.makedirs(directory, exist_ok=True)
+    manifest = {'tables': []}
+    connection = psycopg2.connect(dsn)
+    try:
+        connection.set_session(isolation_level='REPEATABLE READ',
+                               readonly=True)
+        with connection, connection.cursor() as cursor:
+            for table in tables:
+                columns = stored_columns(table)
+                path = os.path.join(directory, f'{table.name}.copy')
+                with open(path, 'wb') as data_file:
+                    cursor.copy_expert(
+                        f'COPY {table.name} ({", ".join(columns)}) '
+                        'TO STDOUT WITH (FORMAT binary)', data_file)
+                cursor.execute(f'SELECT count(*) FROM {table.name}')
+                manifest['tables'].append({
+                    'name': table.name,
+                    'columns': columns,
+                    'rows': cursor.fetchone()[0]
+                })
+    finally:
+        connection.close()
+    with open(os.path.join(directory, SNAPSHOT_MANIFEST), 'w') as \
+            manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
+
+
+# Replace the contents of the snapshot's tables with the snapshot.
+# Everything happens in one transaction, so if anything fails the
+# tables are left as they were
+def restore(dsn, directory, defer_indexes=True):
+    with open(os.path.join(directory, SNAPSHOT_MANIFEST)) as manifest_file:
+        manifest = json.load(manifest_file)
+    names = [table['name'] for table in manifest['tables']]
+    connection = psycopg2.connect(dsn)
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute(f'TRUNCATE {", ".join(names)} CASCADE')
+            for table in manifest['tables']:
+                indexes = secondary_indexes(cursor, table['name']) \
+                    if defer_indexes else []
+                drop_indexes(cursor, indexes)
+                path = os.path.join(directory, f'{table["name"]}.copy')
+                with open(path, 'rb') as data_file:
+                    cursor.copy_expert(
+                        f'COPY {table["name"]} '
+                        f'({", ".join(table["columns"])}) '
+                        'FROM STDIN WITH (FORMAT binary)', data_file)
+                create_indexes(cursor, indexes)
+                if 'id' in table['columns']:
+                    reset_sequence(cursor, table['name'])
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            for name in names:
+                cursor.execute(f'ANALYZE {name}')
+    finally:
+        connection.close()
+    return manifest
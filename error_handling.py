@@ -1,45 +1,42 @@
-from flask import jsonify
 from auth import AuthError
+from json_provider import jsonify
 
+ERROR_MESSAGES = {
+    400: 'Bad Request',
+    404: 'Not Found',
+    422: 'Unprocessable Entity',
+    500: 'Internal Server Error'
+}
 
-def error_400():
-    return jsonify({
+
+# Body of every error response, shared with the ASGI entry point (asgi.py)
+def error_body(status_code, message=None):
+    return {
         'success': False,
-        'error': 400,
-        'message': 'Bad Request'
-    }), 400
+        'error': status_code,
+        'message': ERROR_MESSAGES.get(status_code) if message is None
+        else message
+    }
+
+
+def error_400():
+    return jsonify(error_body(400)), 400
 
 
 def error_404():
-    return jsonify({
-        'success': False,
-        'error': 404,
-        'message': 'Not Found'
-    }), 404
+    return jsonify(error_body(404)), 404
 
 
 def error_422():
-    return jsonify({
-        'success': False,
-        'error': 422,
-        'message': 'Unprocessable Entity'
-    }), 422
+    return jsonify(error_body(422)), 422
 
 
 def error_500():
-    return jsonify({
-        'success': False,
-        'error': 500,
-        'message': 'Internal Server Error'
-    }), 500
+    return jsonify(error_body(500)), 500
 
 
 def error_auth(e):
-    return jsonify({
-        "success": False,
-        "error": e.status_code,
-        "message": e.error
-    }), e.status_code
+    return jsonify(error_body(e.status_code, e.error)), e.status_code
 
 
 def setup_error_handlers(app):
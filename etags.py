@@ -0,0 +1,83 @@
+# Entity tags let clients that already hold a response ask for it again
+# with If-None-Match, and get an empty 304 response if it hasn't changed
+# Every movie and actor carries a version number that is increased each
+# time it is edited, so tags can be worked out without serialising anything
+
+import hashlib
+import json
+from flask import current_app, request
+
+# Encodings that responses may be compressed with, which tags of
+# compressed bodies end with
+CONTENT_CODINGS = ('br', 'zstd', 'gzip')
+
+
+# Tag for a single record
+def entity_etag(table, id, version):
+    return f'{table}-{id}-{version}'
+
+
+# Tag for a list of records, which changes if the request changes, if
+# any record in the list is added, removed, reordered or edited, or if
+# the cursor to the next page changes (such as when a record is added
+# after a full last page)
+def collection_etag(table, params, records, next_cursor=None):
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8'))
+    for record in records:
+        digest.update(f'{record.id}:{record.version};'.encode('ascii'))
+    digest.update(f'next:{next_cursor}'.encode('utf-8'))
+    return f'{table}-{digest.hexdigest()}'
+
+
+# Tag for a record with related records embedded (see casting.py), which
+# also changes if any of those is added, removed or edited
+def embedded_etag(etag, embed, records, total):
+    return collection_etag(etag, {'embed': embed, 'total': total}, records)
+
+
+# Tag for a response body compressed with the encoding (see compress.py),
+# which differs byte for byte from the uncompressed body so has its own
+# strong tag, e.g. movies-1-3-gzip
+def encoded_etag(etag, encoding):
+    return f'{etag}-{encoding}'
+
+
+# Tag of the uncompressed body, given the tag of any of its encodings
+def decoded_etag(etag):
+    base, _, suffix = etag.rpartition('-')
+    if base and suffix in CONTENT_CODINGS:
+        return base
+    return etag
+
+
+# The tag in If-None-Match (a werkzeug ETags) held by a client with the
+# response with this tag, in any encoding, or None if there isn't one
+def matching_etag(if_none_match, etag):
+    if if_none_match.star_tag:
+        return etag
+    for tag in if_none_match.as_set(include_weak=True):
+        if decoded_etag(tag) == etag:
+            return tag
+    return None
+
+
+# Return a 304 response if the client already holds the version of the
+# response with this tag, or None if the full response must be sent
+# The 304 carries the tag the client holds, which may be of a compressed body
+def not_modified(etag):
+    if_none_match = request.if_none_match
+    held = matching_etag(if_none_match, etag)
+    if held is None:
+        return None
+    response = current_app.response_class(status=304)
+    response.set_etag(held, weak=if_none_match.is_weak(held))
+    return response
+
+
+# Whether the client asked, with "Prefer: return=representation",
+# for the changed record to be included in the response to a write
+def wants_representation(prefer=None):
+    if prefer is None:
+        prefer = request.headers.get('Prefer', '')
+    return 'return=representation' in \
+        [part.strip() for part in prefer.replace(';', ',').split(',')]
@@ -0,0 +1,51 @@
+# Streaming export of whole tables as NDJSON
+# Rows are read through a server-side cursor a batch at a time and written
+# out as they arrive, so neither the app nor the database holds the whole
+# table in memory
+
+import datetime
+import json
+import os
+from flask import Response, stream_with_context
+
+# Number of rows fetched from the server-side cursor at a time
+EXPORT_BATCH_ROWS = int(os.environ.get('CAPSTONE_EXPORT_BATCH_ROWS', 1000))
+
+# Output is sent in pieces of roughly this many bytes
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+
+# Dates are exported in ISO format so the output can be imported again
+def export_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def ndjson_line(record):
+    return json.dumps(record.format(), default=export_default) + '\n'
+
+
+# Yield the records of the model as NDJSON, in order of id
+def generate_ndjson(db, model):
+    query = db.session.query(model).order_by(model.id).\
+        execution_options(stream_results=True).yield_per(EXPORT_BATCH_ROWS)
+    lines = []
+    size = 0
+    for record in query:
+        line = ndjson_line(record)
+        lines.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield ''.join(lines).encode('utf-8')
+            lines = []
+            size = 0
+    if lines:
+        yield ''.join(lines).encode('utf-8')
+
+
+# Build a streamed response containing every record of the model
+# (compressed as it is sent if the client accepts it, see compress.py)
+def export_response(db, model):
+    return Response(stream_with_context(generate_ndjson(db, model)),
+                    mimetype='application/x-ndjson')
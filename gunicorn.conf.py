@@ -0,0 +1,112 @@
+# Gunicorn settings, used by the Procfile
+# CAPSTONE_WORKER_CLASS chooses how each worker process handles requests:
+#  sync    - one request at a time (the default)
+#  gthread - up to CAPSTONE_WORKER_THREADS requests at a time, in threads
+#  gevent  - up to CAPSTONE_WORKER_CONNECTIONS requests at a time, as
+#            greenlets that give way to each other whenever they wait on
+#            the database or the network
+# With gthread or gevent, each worker can have more requests waiting on
+# the database than it has pooled connections, so CAPSTONE_DB_POOL_SIZE
+# and CAPSTONE_DB_MAX_OVERFLOW (or PgBouncer) should be sized to match
+
+import os
+import shutil
+import tempfile
+
+WORKER_CLASSES = ('sync', 'gthread', 'gevent')
+
+worker_class = os.environ.get('CAPSTONE_WORKER_CLASS', 'sync')
+if worker_class not in WORKER_CLASSES:
+    raise ValueError(f'Unknown worker class: {worker_class}')
+
+if worker_class == 'gevent':
+    # Patch the standard library and psycopg2 before the app is imported
+    # (by preload_app or by each worker), so that queries, JWKS fetches
+    # and locks give way to other greenlets rather than block the worker
+    from gevent import monkey
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+# The workers share a directory in which each writes its request metrics,
+# so that /metrics reports the whole server's (see metrics.py). It must
+# be set before the app is imported. A directory created here is removed
+# when the server stops
+metrics_dir_created = 'CAPSTONE_METRICS_DIR' not in os.environ
+if metrics_dir_created:
+    os.environ['CAPSTONE_METRICS_DIR'] = tempfile.mkdtemp(
+        prefix='capstone-metrics-')
+
+
+# Number of CPUs this process may run on
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# Heroku sets WEB_CONCURRENCY to suit the memory of the dyno. Otherwise,
+# sync workers spend much of their time waiting on the database, so more
+# processes than CPUs are run; the other classes overlap that waiting
+# within each process, so one per CPU is enough
+if 'WEB_CONCURRENCY' in os.environ:
+    workers = int(os.environ['WEB_CONCURRENCY'])
+elif worker_class == 'sync':
+    workers = cpu_count() * 2 + 1
+else:
+    workers = cpu_count()
+
+if worker_class == 'gthread':
+    threads = int(os.environ.get('CAPSTONE_WORKER_THREADS', 4))
+worker_connections = int(os.environ.get('CAPSTONE_WORKER_CONNECTIONS', 1000))
+timeout = int(os.environ.get('CAPSTONE_WORKER_TIMEOUT', 30))
+
+# Load the app once in the master process before forking the workers,
+# so that they share its memory and start faster
+preload_app = int(os.environ.get('CAPSTONE_PRELOAD_APP', 1)) == 1
+
+
+# Close the database connections the master opened while loading the app,
+# so that they aren't left idle for as long as the server runs
+def when_ready(server):
+    if server.cfg.preload_app:
+        from models import db
+        db.engine.dispose()
+
+
+# Give each worker a connection pool of its own, rather than a copy of the
+# master's whose connections and locks belong to the master
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from models import reset_pool_after_fork
+        reset_pool_after_fork()
+
+
+# Write the metrics of a worker that is stopping, so that those of the
+# requests it handled since it last wrote them aren't lost
+def worker_exit(server, worker):
+    from metrics import registry
+    try:
+        with worker.wsgi.app_context():
+            registry.flush()
+    except Exception:
+        server.log.exception('Unable to write metrics of worker %s',
+                             worker.pid)
+
+
+# Add the metrics of a worker that has exited (such as one replaced after
+# max_requests, or one that crashed) to those of the other exited workers,
+# so that files of workers that are gone don't pile up
+def child_exit(server, worker):
+    from metrics import fold_exited
+    try:
+        fold_exited(os.environ['CAPSTONE_METRICS_DIR'], worker.pid)
+    except OSError:
+        server.log.exception('Unable to fold metrics of worker %s',
+                             worker.pid)
+
+
+def on_exit(server):
+    if metrics_dir_created:
+        shutil.rmtree(os.environ['CAPSTONE_METRICS_DIR'], ignore_errors=True)
@@ -0,0 +1,141 @@
+# Streaming import of NDJSON or CSV data using PostgreSQL's COPY
+# Records are read one line at a time, validated, and sent to the database
+# in chunks, so memory use stays flat however large the input is
+
+import csv
+import io
+import json
+import os
+import re
+
+# Number of valid rows gathered before they are sent with one COPY
+IMPORT_CHUNK_ROWS = int(os.environ.get('CAPSTONE_IMPORT_CHUNK_ROWS', 10000))
+
+# Number of skipped records described individually in the result
+MAX_REPORTED_ERRORS = 100
+
+FORMATS = ('ndjson', 'csv')
+
+# Types that CSV values (which are always read as strings)
+# are converted to before validation
+CSV_COLUMN_TYPES = {'age': int}
+
+
+# Raised when the data can't be imported at all
+class ImportFailed(Exception):
+    pass
+
+
+# Return the import format matching a request's Content-Type,
+# or None if it isn't one that can be imported
+def format_for_mimetype(mimetype):
+    if mimetype in ('application/x-ndjson', 'application/ndjson',
+                    'application/jsonlines'):
+        return 'ndjson'
+    if mimetype == 'text/csv':
+        return 'csv'
+    return None
+
+
+# Yield (line number, record) for every line of the input, where the record
+# is a dict of field values, or None if the line couldn't be parsed
+# "lines" may be any iterable of bytes or str lines, such as a file object
+# or a request stream
+def read_records(lines, data_format):
+    lines = (line.decode('utf-8') if isinstance(line, bytes) else line
+             for line in lines)
+    if data_format == 'ndjson':
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                yield number, json.loads(line)
+            except ValueError:
+                yield number, None
+    else:
+        reader = csv.DictReader(lines)
+        for row in reader:
+            try:
+                record = {key: CSV_COLUMN_TYPES.get(key, str)(value)
+                          for key, value in row.items()
+                          if key is not None and value is not None}
+            except ValueError:
+                record = None
+            yield reader.line_num, record
+
+
+# Copy the buffered CSV rows into the table, on the session's connection
+def copy_chunk(db, table, columns, buffer):
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f'COPY {table} ({", ".join(columns)}) '
+            'FROM STDIN WITH (FORMAT csv)', buffer)
+    finally:
+        cursor.close()
+
+
+# Import records into the table within the current transaction
+# get_fields validates a record as for the single-item routes, returning
+# the columns to store or None. It checks values such as dates and ages
+# as the database would, so invalid records are skipped and reported by
+# line rather than failing the whole import.
+# Raises ImportFailed if the database rejects the data anyway, in which
+# case the transaction has been rolled back; otherwise the caller commits
+def import_records(db, table, columns, get_fields, lines, data_format,
+                   chunk_rows=IMPORT_CHUNK_ROWS):
+    imported = 0
+    skipped = 0
+    errors = []
+    buffer = io.StringIO()
+    # Strings are always quoted so that empty strings aren't stored as NULL
+    writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+    # input line of each line of the buffer, as COPY reports errors by
+    # the line of its own input
+    buffered_lines = []
+    buffered = 0
+    try:
+        for line, record in read_records(lines, data_format):
+            fields = get_fields(record)
+            if fields is None:
+                skipped += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append({'line': line, 'error': 400,
+                                   'message': 'Bad Request'})
+                continue
+            values = [fields[column] for column in columns]
+            writer.writerow(values)
+            # quoted values may span several lines
+            buffered_lines.extend([line] * (1 + sum(
+                value.count('\n') for value in values
+                if isinstance(value, str))))
+            buffered += 1
+            if buffered >= chunk_rows:
+                copy_chunk(db, table, columns, buffer)
+                imported += buffered
+                buffered = 0
+                buffered_lines = []
+                buffer.seek(0)
+                buffer.truncate()
+        if buffered:
+            copy_chunk(db, table, columns, buffer)
+            imported += buffered
+    except Exception as e:
+        db.session.rollback()
+        if isinstance(e, (UnicodeDecodeError, csv.Error)):
+            raise ImportFailed(str(e)) from e
+        if getattr(e, 'pgcode', None) is not None:
+            raise ImportFailed(copy_error(e, buffered_lines)) from e
+        raise
+    return {'imported': imported, 'skipped': skipped, 'errors': errors}
+
+
+# Describe an error raised by COPY, giving the input line of the row
+# it rejected when it names one
+def copy_error(e, buffered_lines):
+    match = re.search(r'\bline (\d+)', e.diag.context or '')
+    if match is None or int(match.group(1)) > len(buffered_lines):
+        return str(e)
+    line = buffered_lines[int(match.group(1)) - 1]
+    return f'line {line}: {e.diag.message_primary}'
@@ -0,0 +1,98 @@
+# Helpers for generating a local RSA key pair and minting tokens with it,
+# so that full role-based access control can be used in testing and
+# benchmarking without contacting Auth0. The public half of the key pair is
+# given to the backend through CAPSTONE_JWKS_FILE (see auth.py)
+
+import base64
+import json
+import os
+import time
+from jose import jwt
+
+from auth import AUTH0_DOMAIN, API_AUDIENCE, LOCAL_JWT_KID
+
+# cryptography generates keys much faster, but the pure-python rsa package
+# (already required by python-jose) is used if it isn't installed
+try:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa as crypto_rsa
+except ImportError:
+    crypto_rsa = None
+    import rsa
+
+PRIVATE_KEY_FILENAME = 'private_key.pem'
+JWKS_FILENAME = 'jwks.json'
+
+# Permissions held by each of the roles described in the README
+ROLE_PERMISSIONS = {
+    'assistant': ['get:movies', 'get:actors'],
+    'director': ['get:movies', 'get:actors', 'patch:movies',
+                 'post:actors', 'patch:actors', 'delete:actors'],
+    'producer': ['get:movies', 'get:actors', 'post:movies', 'patch:movies',
+                 'delete:movies', 'post:actors', 'patch:actors',
+                 'delete:actors']
+}
+
+
+def base64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+# Generate a new key pair, returning the private key as PEM text
+# and a JWKS document containing the public key
+def generate_key_pair(kid=LOCAL_JWT_KID, bits=2048):
+    if crypto_rsa is not None:
+        private_key = crypto_rsa.generate_private_key(public_exponent=65537,
+                                                      key_size=bits)
+        numbers = private_key.public_key().public_numbers()
+        modulus, exponent = numbers.n, numbers.e
+        private_pem = private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption()).decode('ascii')
+    else:
+        public_key, private_key = rsa.newkeys(bits)
+        modulus, exponent = public_key.n, public_key.e
+        private_pem = private_key.save_pkcs1().decode('ascii')
+    jwks = {'keys': [{
+        'kty': 'RSA',
+        'kid': kid,
+        'use': 'sig',
+        'alg': 'RS256',
+        'n': base64url_uint(modulus),
+        'e': base64url_uint(exponent)
+    }]}
+    return private_pem, jwks
+
+
+# Generate a key pair and write it to the given directory,
+# returning the paths of the private key and public JWKS files
+def write_key_pair(directory, kid=LOCAL_JWT_KID, bits=2048):
+    private_pem, jwks = generate_key_pair(kid, bits)
+    os.makedirs(directory, exist_ok=True)
+    private_path = os.path.join(directory, PRIVATE_KEY_FILENAME)
+    jwks_path = os.path.join(directory, JWKS_FILENAME)
+    with open(private_path, 'w') as private_file:
+        private_file.write(private_pem)
+    os.chmod(private_path, 0o600)
+    with open(jwks_path, 'w') as jwks_file:
+        json.dump(jwks, jwks_file, indent=2)
+    return private_path, jwks_path
+
+
+# Create a signed token that the backend will accept
+# when it is configured with the matching public key
+def mint_token(private_pem, permissions, kid=LOCAL_JWT_KID,
+               expires_in=3600, subject='local|tester'):
+    now = int(time.time())
+    claims = {
+        'iss': f'https://{AUTH0_DOMAIN}/',
+        'sub': subject,
+        'aud': API_AUDIENCE,
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': list(permissions)
+    }
+    return jwt.encode(claims, private_pem, algorithm='RS256',
+                      headers={'kid': kid})
@@ -1,14 +1,124 @@
+import time
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
 from models import db
+from local_auth import ROLE_PERMISSIONS, write_key_pair, mint_token
+from importer import FORMATS, ImportFailed, import_records
+from datagen import GENERATE_CHUNK_ROWS, engine_dsn, generate_table, \
+    restore, snapshot
+from routes_movies import MOVIE_COLUMNS, get_movie_fields
+from routes_actors import ACTOR_COLUMNS, get_actor_fields
 
 migrate = Migrate(app, db)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
+# Tables that can be imported into, with their columns and validation
+IMPORT_TABLES = {
+    'movies': (MOVIE_COLUMNS, get_movie_fields),
+    'actors': (ACTOR_COLUMNS, get_actor_fields)
+}
+
+
+# Generate a local key pair for use with CAPSTONE_JWKS_FILE
+@manager.option('-d', '--directory', dest='directory', default='local_keys')
+@manager.option('-k', '--kid', dest='kid', default='local')
+def generate_keys(directory, kid):
+    private_path, jwks_path = write_key_pair(directory, kid)
+    print(f'Private key written to {private_path}')
+    print(f'Public keys written to {jwks_path}')
+    print(f'Run the server with CAPSTONE_JWKS_FILE={jwks_path}')
+
+
+# Print a token signed with a local private key
+# Either a role (assistant, director, producer) or a comma-separated
+# list of permissions may be given
+@manager.option('-r', '--role', dest='role', default=None)
+@manager.option('-p', '--permissions', dest='permissions', default='')
+@manager.option('-f', '--key-file', dest='key_file',
+                default='local_keys/private_key.pem')
+@manager.option('-k', '--kid', dest='kid', default='local')
+@manager.option('-e', '--expires-in', dest='expires_in', type=int,
+                default=3600)
+def mint(role, permissions, key_file, kid, expires_in):
+    if role is not None:
+        permissions = ROLE_PERMISSIONS[role]
+    else:
+        permissions = [p for p in permissions.split(',') if p]
+    with open(key_file) as private_file:
+        private_pem = private_file.read()
+    print(mint_token(private_pem, permissions, kid, expires_in))
+
+
+# Stream an NDJSON or CSV file into the movies or actors table using COPY
+# The format is taken from the file extension unless it is given
+@manager.option('-t', '--table', dest='table', required=True,
+                choices=list(IMPORT_TABLES))
+@manager.option('-f', '--file', dest='path', required=True)
+@manager.option('--format', dest='data_format', default=None,
+                choices=list(FORMATS))
+def import_data(table, path, data_format):
+    if data_format is None:
+        data_format = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+    columns, get_fields = IMPORT_TABLES[table]
+    with open(path, 'rb') as data_file:
+        try:
+            result = import_records(db, table, columns, get_fields,
+                                    data_file, data_format)
+        except ImportFailed as e:
+            print(f'Import failed, nothing was imported: {e}')
+            return
+    db.session.commit()
+    print(f'Imported {result["imported"]} {table}, '
+          f'skipped {result["skipped"]} invalid records')
+    for error in result['errors']:
+        print(f'  line {error["line"]}: {error["message"]}')
+
+
+# Add generated movies and actors to the database, for benchmarking and
+# index work at realistic sizes. The same seed always gives the same rows
+@manager.option('-m', '--movies', dest='movies', type=int, default=1000000)
+@manager.option('-a', '--actors', dest='actors', type=int, default=1000000)
+@manager.option('-s', '--seed', dest='seed', type=int, default=0)
+@manager.option('-c', '--chunk-rows', dest='chunk_rows', type=int,
+                default=GENERATE_CHUNK_ROWS)
+@manager.option('-w', '--workers', dest='workers', type=int, default=None)
+@manager.option('--keep-indexes', dest='keep_indexes', action='store_true')
+def generate_data(movies, actors, seed, chunk_rows, workers, keep_indexes):
+    dsn = engine_dsn(db.engine)
+    # let the tables be altered without waiting on the app's connections
+    db.session.remove()
+    db.engine.dispose()
+    for table, count in (('movies', movies), ('actors', actors)):
+        started = time.perf_counter()
+        loaded = generate_table(dsn, table, count, seed, chunk_rows,
+                                workers, not keep_indexes)
+        print(f'Generated {loaded} {table} in '
+              f'{time.perf_counter() - started:.1f}s')
+
+
+# Save every table to a directory, to be restored with restore_data
+@manager.option('-d', '--directory', dest='directory', required=True)
+def snapshot_data(directory):
+    manifest = snapshot(engine_dsn(db.engine), db.metadata.sorted_tables,
+                        directory)
+    for table in manifest['tables']:
+        print(f'Saved {table["rows"]} {table["name"]}')
+
+
+# Replace the contents of the tables with a snapshot
+@manager.option('-d', '--directory', dest='directory', required=True)
+def restore_data(directory):
+    dsn = engine_dsn(db.engine)
+    db.session.remove()
+    db.engine.dispose()
+    manifest = restore(dsn, directory)
+    for table in manifest['tables']:
+        print(f'Restored {table["rows"]} {table["name"]}')
+
 
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    manager.run()
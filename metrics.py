@@ -0,0 +1,386 @@
+# Request metrics, served in Prometheus' text format at /metrics
+# Every request records its latency, status code, time spent verifying
+# tokens and time spent waiting on the database, labelled by endpoint.
+# Each worker process keeps its own metrics and writes them to a file in
+# CAPSTONE_METRICS_DIR every so often; /metrics combines the files of all
+# the workers, so whichever worker answers, the totals are the server's
+
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from cache import entity_cache
+from compress import compressed_cache
+from models import pool_stats
+
+logger = logging.getLogger(__name__)
+
+# Directory shared by the worker processes (gunicorn.conf.py creates one
+# for each server). Without it, /metrics only covers the process serving it
+METRICS_DIR = os.environ.get('CAPSTONE_METRICS_DIR')
+# Seconds between writes of each process's metrics to its file, which is
+# how far behind /metrics can be on the requests of other workers
+METRICS_FLUSH_INTERVAL = float(
+    os.environ.get('CAPSTONE_METRICS_FLUSH_INTERVAL', 1))
+
+# File in the directory to which the metrics of worker processes that have
+# exited are added (see fold_exited), so that their files don't pile up
+EXITED_FILE = 'metrics-exited.json'
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Type and description of every metric
+# Gauges describe processes as they are now, so only those of processes
+# that are still running are added up
+METRICS = {
+    'capstone_http_requests_total':
+        ('counter', 'Requests handled, by endpoint, method and status'),
+    'capstone_http_request_duration_seconds':
+        ('histogram', 'Time taken to handle requests'),
+    'capstone_http_requests_in_flight':
+        ('gauge', 'Requests being handled'),
+    'capstone_auth_duration_seconds':
+        ('histogram', 'Time taken to verify tokens and permissions'),
+    'capstone_db_duration_seconds':
+        ('histogram', 'Time each request spent waiting on the database'),
+    'capstone_db_pool_connections':
+        ('gauge', 'Connections in the pools, by state'),
+    'capstone_db_pool_events_total':
+        ('counter', 'Connection pool events, by kind'),
+    'capstone_db_pool_wait_seconds_total':
+        ('counter', 'Time spent waiting for pooled connections'),
+    'capstone_cache_requests_total':
+        ('counter', 'Cache lookups, by cache and result')
+}
+
+
+def format_labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').\
+            replace('\n', '\\n')
+    return ','.join(f'{name}="{escape(value)}"'
+                    for name, value in sorted(labels.items()))
+
+
+# Metrics of this process. Values are kept by metric name and then by
+# label text (e.g. 'endpoint="show_movie",method="GET"'), and histograms
+# as a list of bucket counts followed by the sum and count of the values
+class MetricsRegistry:
+    def __init__(self, directory=METRICS_DIR,
+                 flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._flusher_pid = None
+
+    def inc(self, name, labels='', amount=1):
+        with self._lock:
+            values = self.counters.setdefault(name, {})
+            values[labels] = values.get(labels, 0) + amount
+
+    def add_gauge(self, name, labels='', amount=1):
+        with self._lock:
+            values = self.gauges.setdefault(name, {})
+            values[labels] = values.get(labels, 0) + amount
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            values = self.histograms.setdefault(name, {})
+            counts = values.get(labels)
+            if counts is None:
+                counts = values[labels] = [0] * (len(BUCKETS) + 2)
+            for index, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    # Current metrics of this process, including those read from the
+    # connection pool and caches
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                'pid': os.getpid(),
+                'counters': {name: dict(values)
+                             for name, values in self.counters.items()},
+                'gauges': {name: dict(values)
+                           for name, values in self.gauges.items()},
+                'histograms': {name: {labels: list(counts)
+                                      for labels, counts in values.items()}
+                               for name, values in self.histograms.items()}
+            }
+        if has_app_context():
+            add_pool_metrics(snapshot)
+        add_cache_metrics(snapshot)
+        return snapshot
+
+    # Write this process's metrics to its file. The file is replaced in
+    # one step, so that readers never see it half written
+    def flush(self):
+        if self.directory is None:
+            return
+        write_snapshot(snapshot_path(self.directory, os.getpid()),
+                       self.snapshot())
+
+    # Start a daemon thread that writes the metrics of this process every
+    # flush interval, so that they stay current while it is idle
+    # (a forked worker process starts its own thread on its first request)
+    def start_flusher(self, app):
+        if self.directory is None or self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        thread = threading.Thread(target=self._flush_forever, args=(app,),
+                                  name='metrics-flusher', daemon=True)
+        thread.start()
+
+    def _flush_forever(self, app):
+        pid = os.getpid()
+        while self._flusher_pid == pid:
+            time.sleep(self.flush_interval)
+            try:
+                with app.app_context():
+                    self.flush()
+            except Exception:
+                logger.exception('Unable to write metrics')
+
+
+def add_pool_metrics(snapshot):
+    stats = pool_stats()
+    if 'size' in stats:
+        # the pool counts its overflow down from zero while it has fewer
+        # connections than its size
+        snapshot['gauges']['capstone_db_pool_connections'] = {
+            format_labels(state='size'): stats['size'],
+            format_labels(state='checked_out'): stats['checked_out'],
+            format_labels(state='overflow'): max(stats['overflow'], 0)}
+    snapshot['counters']['capstone_db_pool_events_total'] = {
+        format_labels(event=name): stats[name]
+        for name in ('connects', 'checkouts', 'checkins', 'timeouts')}
+    snapshot['counters']['capstone_db_pool_wait_seconds_total'] = {
+        '': stats['wait_seconds_total']}
+
+
+def add_cache_metrics(snapshot):
+    counters = snapshot['counters'].setdefault(
+        'capstone_cache_requests_total', {})
+    for name, cache in (('entity', entity_cache),
+                        ('compressed', compressed_cache)):
+        counters[format_labels(cache=name, result='hit')] = cache.hits
+        counters[format_labels(cache=name, result='miss')] = cache.misses
+
+
+registry = MetricsRegistry()
+
+
+def snapshot_path(directory, pid):
+    return os.path.join(directory, f'metrics-{pid}.json')
+
+
+# Replace a file with a snapshot in one step, so that readers
+# never see it half written
+def write_snapshot(path, snapshot):
+    with open(f'{path}.tmp', 'w') as metrics_file:
+        json.dump(snapshot, metrics_file)
+    os.replace(f'{path}.tmp', path)
+
+
+def load_snapshot(path):
+    try:
+        with open(path) as metrics_file:
+            return json.load(metrics_file)
+    except (OSError, ValueError):
+        # a file may disappear between listing and reading it
+        return None
+
+
+# Add the counters and histograms of a worker process that has exited to
+# the directory's EXITED_FILE, and remove its own file. Called by the
+# gunicorn master (see gunicorn.conf.py), the only writer of EXITED_FILE
+# While the worker's file is being removed, EXITED_FILE lists it as
+# "folded", so that readers don't count it twice
+def fold_exited(directory, pid):
+    path = snapshot_path(directory, pid)
+    snapshot = load_snapshot(path)
+    if snapshot is None:
+        return
+    exited_path = os.path.join(directory, EXITED_FILE)
+    exited = load_snapshot(exited_path) or \
+        {'pid': None, 'counters': {}, 'gauges': {}, 'histograms': {}}
+    folded = dict(merge_snapshots([exited, dict(snapshot, gauges={})]),
+                  pid=None, folded=[pid])
+    write_snapshot(exited_path, folded)
+    os.remove(path)
+    folded['folded'] = []
+    write_snapshot(exited_path, folded)
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Add up the snapshots of several processes
+def merge_snapshots(snapshots):
+    merged = {'counters': {}, 'gauges': {}, 'histograms': {}}
+    for snapshot in snapshots:
+        pid = snapshot['pid']
+        live = pid is not None and (pid == os.getpid() or is_running(pid))
+        for kind in ('counters', 'gauges'):
+            if kind == 'gauges' and not live:
+                continue
+            for name, values in snapshot[kind].items():
+                totals = merged[kind].setdefault(name, {})
+                for labels, value in values.items():
+                    totals[labels] = totals.get(labels, 0) + value
+        for name, values in snapshot['histograms'].items():
+            totals = merged['histograms'].setdefault(name, {})
+            for labels, counts in values.items():
+                if labels in totals:
+                    totals[labels] = [total + count for total, count
+                                      in zip(totals[labels], counts)]
+                else:
+                    totals[labels] = list(counts)
+    return merged
+
+
+# Snapshots of every process writing to the directory, with this
+# process's own snapshot taken now rather than read from its file
+def read_snapshots(registry=registry):
+    snapshots = [registry.snapshot()]
+    if registry.directory is None:
+        return snapshots
+    # read before the workers' files, as a worker's file is only removed
+    # once it has been added to this one
+    exited_path = os.path.join(registry.directory, EXITED_FILE)
+    exited = load_snapshot(exited_path)
+    skipped = {exited_path, snapshot_path(registry.directory, os.getpid())}
+    if exited is not None:
+        snapshots.append(exited)
+        skipped.update(snapshot_path(registry.directory, pid)
+                       for pid in exited.get('folded', []))
+    for path in glob.glob(os.path.join(registry.directory, 'metrics-*.json')):
+        if path in skipped:
+            continue
+        snapshot = load_snapshot(path)
+        if snapshot is not None:
+            snapshots.append(snapshot)
+    return snapshots
+
+
+# The metrics in Prometheus' text format
+def render(merged):
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        values = merged[kind + 's'].get(name)
+        if not values:
+            continue
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(values.items()):
+            if kind != 'histogram':
+                lines.append(f'{name}{{{labels}}} {value}' if labels
+                             else f'{name} {value}')
+                continue
+            separator = ',' if labels else ''
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), value[:-2] +
+                                    [value[-1] - sum(value[:-2])]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels}{separator}'
+                             f'le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{labels}}} {value[-2]}')
+            lines.append(f'{name}_count{{{labels}}} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+# Functions called after each statement with the arguments of SQLAlchemy's
+# after_cursor_execute event and the seconds it took, such as the
+# profiler's (see profiler.py), so that statements are only timed once
+query_observers = []
+
+
+# Time spent on the database is added up per request. The start time is
+# kept on the statement's execution context, which is discarded along
+# with it if the statement fails (when after_cursor_execute isn't called)
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    if context is not None:
+        context.query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context,
+                     executemany):
+    started = getattr(context, 'query_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    if has_app_context() and 'db_seconds' in g:
+        g.db_seconds += elapsed
+    for observer in query_observers:
+        observer(conn, cursor, statement, parameters, context, executemany,
+                 elapsed)
+
+
+def start_request():
+    g.request_started = time.perf_counter()
+    g.db_seconds = 0.0
+    registry.add_gauge('capstone_http_requests_in_flight')
+
+
+def record_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+# Recorded when the request ends, which for streamed responses
+# (such as exports) is once the whole response has been sent
+def finish_request(exc):
+    if 'request_started' not in g:
+        return
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'none'
+    labels = format_labels(endpoint=endpoint, method=request.method)
+    status = g.get('response_status', 500)
+    registry.inc('capstone_http_requests_total',
+                 format_labels(endpoint=endpoint, method=request.method,
+                               status=status))
+    registry.observe('capstone_http_request_duration_seconds', labels,
+                     elapsed)
+    registry.observe('capstone_db_duration_seconds', labels, g.db_seconds)
+    if 'auth_seconds' in g:
+        registry.observe('capstone_auth_duration_seconds', labels,
+                         g.auth_seconds)
+    registry.add_gauge('capstone_http_requests_in_flight', amount=-1)
+    registry.start_flusher(current_app._get_current_object())
+
+
+def setup_metrics(app):
+    app.before_request(start_request)
+    app.after_request(record_status)
+    app.teardown_request(finish_request)
+
+    @app.route('/metrics')
+    def show_metrics():
+        return render(merge_snapshots(read_snapshots())), 200, \
+            {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
@@ -0,0 +1,48 @@
+"""Indexes for searching movies and actors by name
+
+Revision ID: 3f1c2a7d9b10
+Revises:
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a7d9b10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # B-tree indexes serve the (name, id) ordering of paginated searches.
+    # IF NOT EXISTS is used throughout as db.create_all() may already
+    # have created the indexes declared on the models
+    op.execute('CREATE INDEX IF NOT EXISTS ix_movies_name_id '
+               'ON movies (name, id)')
+    op.execute('CREATE INDEX IF NOT EXISTS ix_actors_name_id '
+               'ON actors (name, id)')
+
+    # Trigram indexes let substring (ILIKE '%term%') searches use an index
+    # instead of scanning the table. Databases without the pg_trgm
+    # extension are left with the B-tree indexes only, and searches
+    # still work, just without the trigram index
+    available = op.get_bind().execute(sa.text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).scalar()
+    if not available:
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute('CREATE INDEX IF NOT EXISTS ix_movies_name_trgm '
+               'ON movies USING gin (name gin_trgm_ops)')
+    op.execute('CREATE INDEX IF NOT EXISTS ix_actors_name_trgm '
+               'ON actors USING gin (name gin_trgm_ops)')
+
+
+def downgrade():
+    op.execute('DROP INDEX IF EXISTS ix_actors_name_trgm')
+    op.execute('DROP INDEX IF EXISTS ix_movies_name_trgm')
+    op.execute('DROP INDEX IF EXISTS ix_actors_name_id')
+    op.execute('DROP INDEX IF EXISTS ix_movies_name_id')
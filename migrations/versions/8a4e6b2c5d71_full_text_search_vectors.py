@@ -0,0 +1,33 @@
+"""Generated tsvector columns for ranked full-text search
+
+Revision ID: 8a4e6b2c5d71
+Revises: 3f1c2a7d9b10
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4e6b2c5d71'
+down_revision = '3f1c2a7d9b10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The expression must match the Computed() columns in models.py,
+    # and the text search configuration must match search.SEARCH_CONFIG
+    for table in ('movies', 'actors'):
+        op.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS '
+                   'search_vector tsvector GENERATED ALWAYS AS '
+                   "(to_tsvector('simple', coalesce(name, ''))) STORED")
+        op.execute(f'CREATE INDEX IF NOT EXISTS ix_{table}_search_vector '
+                   f'ON {table} USING gin (search_vector)')
+
+
+def downgrade():
+    for table in ('movies', 'actors'):
+        op.execute(f'DROP INDEX IF EXISTS ix_{table}_search_vector')
+        op.execute(f'ALTER TABLE {table} DROP COLUMN IF EXISTS search_vector')
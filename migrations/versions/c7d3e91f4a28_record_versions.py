@@ -0,0 +1,27 @@
+"""Version numbers for movies and actors, used to build ETags
+
+Revision ID: c7d3e91f4a28
+Revises: 8a4e6b2c5d71
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d3e91f4a28'
+down_revision = '8a4e6b2c5d71'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('movies', 'actors'):
+        op.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS '
+                   'version integer NOT NULL DEFAULT 1')
+
+
+def downgrade():
+    for table in ('movies', 'actors'):
+        op.execute(f'ALTER TABLE {table} DROP COLUMN IF EXISTS version')
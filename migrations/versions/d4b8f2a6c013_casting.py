@@ -0,0 +1,31 @@
+"""Casting of actors in movies
+
+Revision ID: d4b8f2a6c013
+Revises: c7d3e91f4a28
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4b8f2a6c013'
+down_revision = 'c7d3e91f4a28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE TABLE IF NOT EXISTS casting ('
+               'movie_id integer NOT NULL '
+               'REFERENCES movies (id) ON DELETE CASCADE, '
+               'actor_id integer NOT NULL '
+               'REFERENCES actors (id) ON DELETE CASCADE, '
+               'PRIMARY KEY (movie_id, actor_id))')
+    op.execute('CREATE INDEX IF NOT EXISTS ix_casting_actor_id_movie_id '
+               'ON casting (actor_id, movie_id)')
+
+
+def downgrade():
+    op.execute('DROP TABLE IF EXISTS casting')
@@ -1,7 +1,14 @@
-from sqlalchemy import Column, String, Integer, DateTime
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, String, Integer, DateTime, Index, Computed, \
+    ForeignKey, Table, event
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import deferred, relationship
+from sqlalchemy.pool import NullPool, QueuePool
+from replicas import RoutingSQLAlchemy, setup_replica_routing
 import os
 import datetime
+import threading
+import time
 
 # Get the database path from an environment variable
 # Heroku automatically generates a DATABASE_URL beginning with
@@ -11,31 +18,219 @@ import datetime
 #  the scheme of Heroku's URL
 database_path = os.environ.get('DATABASE_URL').replace("s://", "sql://", 1)
 
-db = SQLAlchemy()
+# Connection pool settings. Each worker process has its own pool, so the
+# most connections the app can open is the number of workers multiplied by
+# (DB_POOL_SIZE + DB_MAX_OVERFLOW), which must stay below the server's
+# max_connections. DB_POOL_TIMEOUT is how long a request waits for a free
+# connection, DB_POOL_RECYCLE replaces connections older than this many
+# seconds (-1 to never), and DB_POOL_PRE_PING tests connections before use
+DB_POOL_SIZE = int(os.environ.get('CAPSTONE_DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('CAPSTONE_DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('CAPSTONE_DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('CAPSTONE_DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = int(os.environ.get('CAPSTONE_DB_POOL_PRE_PING', 0)) == 1
+# When connecting through PgBouncer (in transaction pooling mode) the app
+# should not keep its own pool: connections are opened per checkout and
+# PgBouncer does the pooling. psycopg2 never uses server-side prepared
+# statements, and server-side cursors (used by exports) only live within
+# a transaction, so nothing else needs to change
+DB_PGBOUNCER = int(os.environ.get('CAPSTONE_DB_PGBOUNCER', 0)) == 1
+
+# Reads for requests to get:* routes may be sent to replicas (see replicas.py)
+db = RoutingSQLAlchemy()
+
+# Generated column holding the words of a record's name for full-text search
+# Deferred so that it's only loaded when a query refers to it
+search_vector_expression = "to_tsvector('simple', coalesce(name, ''))"
+
+
+# Counters describing connection pool use in this process
+class PoolMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record_wait(self, seconds, timed_out=False):
+        with self._lock:
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+pool_metrics = PoolMetrics()
+
+
+# Queue pool that records how long each checkout waits for a connection
+class TimedQueuePool(QueuePool):
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_metrics.record_wait(time.perf_counter() - started, True)
+            raise
+        pool_metrics.record_wait(time.perf_counter() - started)
+        return connection
+
+
+# Pool that opens a new connection for each checkout, for use with
+# PgBouncer, whose use is counted like that of TimedQueuePool
+class CountedNullPool(NullPool):
+    pass
+
+
+# Only the primary database's pools are counted, so that the figures
+# can be compared with its max_connections; replicas get plain pools
+def count_connect(dbapi_connection, connection_record):
+    pool_metrics.count('connects')
+
+
+def count_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_metrics.count('checkouts')
+
+
+def count_checkin(dbapi_connection, connection_record):
+    pool_metrics.count('checkins')
+
+
+for counted_pool in (TimedQueuePool, CountedNullPool):
+    event.listen(counted_pool, 'connect', count_connect)
+    event.listen(counted_pool, 'checkout', count_checkout)
+    event.listen(counted_pool, 'checkin', count_checkin)
+
+
+# Options for the engine, from the connection pool settings above
+# Replicas' engines (primary=False) share the settings but not the counts
+def engine_options(primary=True):
+    if DB_PGBOUNCER:
+        return {'poolclass': CountedNullPool if primary else NullPool,
+                'pool_pre_ping': DB_POOL_PRE_PING}
+    return {
+        'poolclass': TimedQueuePool if primary else QueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
+
+
+# Current state of the connection pool along with the counters above
+def pool_stats():
+    stats = {
+        'connects': pool_metrics.connects,
+        'checkouts': pool_metrics.checkouts,
+        'checkins': pool_metrics.checkins,
+        'timeouts': pool_metrics.timeouts,
+        'wait_seconds_total': pool_metrics.wait_seconds_total,
+        'wait_seconds_max': pool_metrics.wait_seconds_max
+    }
+    pool = db.engine.pool
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow()
+        })
+    return stats
+
+
+# Replace the engine's connection pool in a newly forked process, so that it
+# never uses connections opened by its parent. Unlike dispose(), this
+# doesn't close the parent's connections, which the two processes share
+def reset_pool_after_fork():
+    db.engine.pool = db.engine.pool.recreate()
 
 
 # setup_db(app)
 # binds a flask application and a SQLAlchemy service
+# This is the only SQLAlchemy instance, so there is one engine
+# (and one connection pool) per worker process
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options()
+    setup_replica_routing(app, engine_options(primary=False))
     db.app = app
     db.init_app(app)
     db.create_all()
 
 
+# Which actors appear in which movies. Rows go when either record is
+# deleted. The primary key finds a movie's cast, and the index an actor's
+# movies, each without visiting the table
+casting = Table(
+    'casting', db.metadata,
+    Column('movie_id', Integer,
+           ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', Integer,
+           ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True),
+    Index('ix_casting_actor_id_movie_id', 'actor_id', 'movie_id')
+)
+
+
 class Movie(db.Model):
     __tablename__ = 'movies'
+    __table_args__ = (
+        Index('ix_movies_name_id', 'name', 'id'),
+        Index('ix_movies_search_vector', 'search_vector',
+              postgresql_using='gin'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     release_date = Column(DateTime)
+    # increased on every edit, so that clients can tell when it changes
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    search_vector = deferred(Column(
+        TSVECTOR, Computed(search_vector_expression, persisted=True)))
+    # never loaded on access, which would take a query per movie; load
+    # with selectinload, or see casting.py for a limited number per movie
+    cast = relationship('Actor', secondary=casting, back_populates='movies',
+                        lazy='raise', passive_deletes=True)
+
+    def format(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'release_date': self.release_date
+        }
 
 
 class Actor(db.Model):
     __tablename__ = 'actors'
+    __table_args__ = (
+        Index('ix_actors_name_id', 'name', 'id'),
+        Index('ix_actors_search_vector', 'search_vector',
+              postgresql_using='gin'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     age = Column(Integer)
     gender = Column(String)
+    # increased on every edit, so that clients can tell when it changes
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    search_vector = deferred(Column(
+        TSVECTOR, Computed(search_vector_expression, persisted=True)))
+    # as Movie.cast
+    movies = relationship('Movie', secondary=casting, back_populates='cast',
+                          lazy='raise', passive_deletes=True)
+
+    def format(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'age': self.age,
+            'gender': self.gender
+        }
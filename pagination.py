@@ -0,0 +1,67 @@
+import base64
+import json
+from flask import abort
+from sqlalchemy import tuple_
+
+# Number of results returned by search endpoints when no limit is given,
+# and the largest number that can be asked for
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+# Cursors are opaque to clients, but are simply the (name, id)
+# of the last result on the previous page
+def encode_cursor(name, id):
+    data = json.dumps([name, id]).encode('utf-8')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor):
+    padding = '=' * (-len(cursor) % 4)
+    name, id = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    if not isinstance(name, str) or not isinstance(id, int):
+        raise ValueError('Malformed cursor')
+    return name, id
+
+
+# Retrieve the page size and cursor from a request body,
+# aborting with a 400 error if either is invalid
+def get_page_params(body):
+    limit = body.get('limit', DEFAULT_PAGE_SIZE)
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+        abort(400)
+    limit = min(limit, MAX_PAGE_SIZE)
+    after = body.get('after')
+    if after is not None:
+        if not isinstance(after, str):
+            abort(400)
+        try:
+            after = decode_cursor(after)
+        except (ValueError, TypeError):
+            abort(400)
+    return limit, after
+
+
+# Restrict the query (or select statement) to one page of results,
+# ordered by (name, id), plus one more to tell if there is a next page
+# Filtering on the (name, id) of the last result rather than using an
+# offset keeps every page equally cheap however deep it is
+def page_by_name(query, model, limit, after=None):
+    if after is not None:
+        query = query.filter(tuple_(model.name, model.id) > tuple_(*after))
+    return query.order_by(model.name, model.id).limit(limit + 1)
+
+
+# Split the results of page_by_name into the page itself and the cursor
+# for the next page (None if this is the last page)
+def split_page(items, limit):
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1].name, items[-1].id)
+    return items, next_cursor
+
+
+# Return one page of results from the query along with the next cursor
+def paginate_by_name(query, model, limit, after=None):
+    return split_page(page_by_name(query, model, limit, after).all(), limit)
@@ -0,0 +1,139 @@
+# Opt-in profiling of the SQL issued by each request
+# With CAPSTONE_SQL_PROFILE=1, every request counts its queries and the
+# time they took, and reports them to the client in a Server-Timing header
+# (e.g. 'db;dur=3.2;desc="2 queries"'), which browsers' developer tools
+# show alongside the request. Statements slower than CAPSTONE_SLOW_QUERY_MS
+# are logged with the route that issued them, and a sample of the slow
+# SELECTs are run again under EXPLAIN (ANALYZE, BUFFERS) to log their plans.
+# Statements issued more than once with the same parameters in a request
+# are logged too, as they can usually be avoided
+
+import logging
+import os
+import random
+from flask import current_app, g, has_request_context, request
+from metrics import query_observers
+
+logger = logging.getLogger(__name__)
+
+SQL_PROFILE = int(os.environ.get('CAPSTONE_SQL_PROFILE', 0)) == 1
+# Statements taking at least this many milliseconds are logged
+SLOW_QUERY_MS = float(os.environ.get('CAPSTONE_SLOW_QUERY_MS', 100))
+# Fraction of slow SELECTs whose plans are logged, between 0 and 1.
+# EXPLAIN ANALYZE runs the statement again, so this adds to the time
+# of the requests sampled
+EXPLAIN_SAMPLE_RATE = float(
+    os.environ.get('CAPSTONE_EXPLAIN_SAMPLE_RATE', 0))
+
+# Longest statement text included in logs
+MAX_STATEMENT_LOG = 1000
+
+
+def shorten(statement):
+    statement = ' '.join(statement.split())
+    if len(statement) > MAX_STATEMENT_LOG:
+        return statement[:MAX_STATEMENT_LOG] + '...'
+    return statement
+
+
+def route_name():
+    return f'{request.method} {request.path} ({request.endpoint})'
+
+
+class SQLProfiler:
+    def __init__(self, slow_query_ms=SLOW_QUERY_MS,
+                 explain_sample_rate=EXPLAIN_SAMPLE_RATE):
+        self.slow_query_seconds = slow_query_ms / 1000
+        self.explain_sample_rate = explain_sample_rate
+
+    def start_request(self):
+        g.sql_queries = 0
+        g.sql_seconds = 0.0
+        g.sql_statements = {}
+
+    def record(self, conn, cursor, statement, parameters, context,
+               executemany, elapsed):
+        g.sql_queries += 1
+        g.sql_seconds += elapsed
+        key = (statement, repr(parameters))
+        g.sql_statements[key] = g.sql_statements.get(key, 0) + 1
+        if elapsed < self.slow_query_seconds:
+            return
+        logger.warning('Slow query (%.1f ms) in %s: %s', elapsed * 1000,
+                       route_name(), shorten(statement))
+        if not executemany and \
+                not getattr(context, 'is_server_side', False) and \
+                statement.lstrip()[:6].upper() == 'SELECT' and \
+                random.random() < self.explain_sample_rate:
+            self.explain(conn, statement, parameters)
+
+    # Log the plan of a statement, running it again in a savepoint so
+    # that an error can't spoil the request's transaction. This uses a
+    # separate cursor, leaving the statement's own results to be fetched
+    def explain(self, conn, statement, parameters):
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute('SAVEPOINT capstone_explain')
+            try:
+                cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + statement,
+                               parameters)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+            except Exception:
+                cursor.execute('ROLLBACK TO SAVEPOINT capstone_explain')
+                raise
+            finally:
+                cursor.execute('RELEASE SAVEPOINT capstone_explain')
+        except Exception:
+            logger.exception('Unable to explain query in %s', route_name())
+            return
+        finally:
+            cursor.close()
+        logger.warning('Plan of slow query in %s:\n%s', route_name(), plan)
+
+    # Report the request's queries in the Server-Timing header. The
+    # queries of streamed responses (such as exports) that run after the
+    # headers are sent aren't included
+    def add_server_timing(self, response):
+        description = f'{g.sql_queries} ' + \
+            ('query' if g.sql_queries == 1 else 'queries')
+        timing = f'db;dur={g.sql_seconds * 1000:.1f};desc="{description}"'
+        existing = response.headers.get('Server-Timing')
+        response.headers['Server-Timing'] = \
+            f'{existing}, {timing}' if existing else timing
+        return response
+
+    def log_repeated(self, exc):
+        if 'sql_statements' not in g:
+            return
+        for (statement, parameters), count in g.sql_statements.items():
+            if count > 1:
+                logger.warning('Query repeated %d times in %s: %s', count,
+                               route_name(), shorten(statement))
+
+
+def profiler_for_request():
+    if not has_request_context() or 'sql_queries' not in g:
+        return None
+    return current_app.extensions.get('sql_profiler')
+
+
+def record_query(conn, cursor, statement, parameters, context,
+                 executemany, elapsed):
+    profiler = profiler_for_request()
+    if profiler is not None:
+        profiler.record(conn, cursor, statement, parameters, context,
+                        executemany, elapsed)
+
+
+# Start profiling the requests of an app. Queries are timed by the
+# metrics' timer (see metrics.py), which is only asked to report them
+# once an app is profiled, so that this costs nothing otherwise
+def setup_profiler(app, profiler=None):
+    if profiler is None:
+        profiler = SQLProfiler()
+    app.extensions['sql_profiler'] = profiler
+    if record_query not in query_observers:
+        query_observers.append(record_query)
+    app.before_request(profiler.start_request)
+    app.after_request(profiler.add_server_timing)
+    app.teardown_request(profiler.log_repeated)
@@ -0,0 +1,241 @@
+# Routing of read-only requests to read replicas
+# Requests to routes guarded by a get:* permission read from one of the
+# replicas listed in DATABASE_REPLICA_URLS, taken in turn, while all other
+# requests use the primary database. Once a request writes anything, the
+# rest of it uses the primary too, so it always reads its own writes
+
+import itertools
+import os
+import threading
+import time
+from flask import current_app, g, has_app_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm, text
+from sqlalchemy.exc import SQLAlchemyError
+
+# Comma separated replica URLs, converted from "postgres://" in the same
+# way as DATABASE_URL (see models.py)
+REPLICA_URLS = [url.strip().replace("s://", "sql://", 1) for url in
+                os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+                if url.strip()]
+# Seconds between checks that a replica is still reachable. A replica
+# that fails a check is skipped until it passes the next one
+REPLICA_CHECK_INTERVAL = float(
+    os.environ.get('CAPSTONE_DB_REPLICA_CHECK_INTERVAL', 5))
+# Seconds to wait when connecting to a replica before giving up on it
+REPLICA_CONNECT_TIMEOUT = int(
+    os.environ.get('CAPSTONE_DB_REPLICA_CONNECT_TIMEOUT', 2))
+# Replicas further behind the primary than this many seconds are skipped
+# (default 0, never). Note that a replica of an idle primary also appears
+# to fall behind, as no new transactions are replayed
+REPLICA_MAX_LAG = float(os.environ.get('CAPSTONE_DB_REPLICA_MAX_LAG', 0))
+
+# Seconds since the last transaction replayed from the primary,
+# or NULL when the server isn't a replica
+LAG_QUERY = text('SELECT extract(epoch FROM now() - '
+                 'pg_last_xact_replay_timestamp())')
+
+
+class Replica:
+    def __init__(self, url):
+        self.url = url
+        self.engine = None
+        self.healthy = True
+        self.checked_at = None
+        self.selected = 0
+        self.failures = 0
+
+    def stats(self):
+        return {
+            # the URL's repr hides the password
+            'url': repr(self.engine.url),
+            'healthy': self.healthy,
+            'selected': self.selected,
+            'failures': self.failures
+        }
+
+
+# Chooses which replica serves each read-only request
+class ReplicaRouter:
+    def __init__(self, check_interval=REPLICA_CHECK_INTERVAL,
+                 max_lag=REPLICA_MAX_LAG, clock=time.monotonic):
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.clock = clock
+        self.fallbacks = 0
+        self._urls = []
+        self._options = {}
+        self._replicas = []
+        self._pid = None
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    # Use the given replica URLs, creating their engines with the same
+    # options as the primary's. An empty list turns routing off
+    def configure(self, urls, options=None):
+        self.dispose()
+        with self._lock:
+            self._urls = list(urls)
+            self._options = dict(options or {})
+            self._replicas = []
+            self._pid = None
+            self.fallbacks = 0
+
+    @property
+    def enabled(self):
+        return bool(self._urls)
+
+    # Engines are created on first use in each process, so that worker
+    # processes never share connections opened before they were forked
+    def replicas(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._replicas = [self._create_replica(url)
+                                      for url in self._urls]
+                    self._pid = pid
+        return self._replicas
+
+    def _create_replica(self, url):
+        replica = Replica(url)
+        options = dict(self._options)
+        connect_args = dict(options.get('connect_args', {}))
+        connect_args.setdefault('connect_timeout', REPLICA_CONNECT_TIMEOUT)
+        options['connect_args'] = connect_args
+        replica.engine = create_engine(url, **options)
+
+        # Stop using a replica as soon as its connections are lost,
+        # rather than waiting for the next check
+        @event.listens_for(replica.engine, 'handle_error')
+        def mark_disconnected(context):
+            if context.is_disconnect:
+                replica.healthy = False
+                with self._lock:
+                    replica.failures += 1
+
+        return replica
+
+    # Return the engine of the next healthy replica,
+    # or None if there are none and the primary should be used instead
+    def choose(self):
+        replicas = self.replicas()
+        for _ in range(len(replicas)):
+            replica = replicas[next(self._next) % len(replicas)]
+            if self._is_available(replica):
+                with self._lock:
+                    replica.selected += 1
+                return replica.engine
+        with self._lock:
+            self.fallbacks += 1
+        return None
+
+    def _is_available(self, replica):
+        now = self.clock()
+        with self._lock:
+            due = replica.checked_at is None or \
+                now - replica.checked_at >= self.check_interval
+            # other requests carry on with the last result
+            # while this one checks
+            if due:
+                replica.checked_at = now
+        if due:
+            self.check(replica)
+        return replica.healthy
+
+    # Check that the replica answers queries and isn't too far behind
+    def check(self, replica):
+        try:
+            with replica.engine.connect() as connection:
+                lag = connection.execute(LAG_QUERY).scalar()
+        except SQLAlchemyError:
+            healthy = False
+        else:
+            healthy = not (self.max_lag and lag is not None and
+                           lag > self.max_lag)
+        replica.healthy = healthy
+        if not healthy:
+            with self._lock:
+                replica.failures += 1
+
+    def stats(self):
+        return {
+            'replicas': [replica.stats() for replica in self._replicas],
+            'fallbacks': self.fallbacks
+        }
+
+    def dispose(self):
+        # connections inherited from another process are left alone
+        if self._pid == os.getpid():
+            for replica in self._replicas:
+                replica.engine.dispose()
+
+
+replica_router = ReplicaRouter()
+
+
+# Called before each request: reads go to a replica only
+# if the route requires a get:* permission
+def start_request():
+    view = current_app.view_functions.get(request.endpoint)
+    permission = getattr(view, 'required_permission', '')
+    g.db_read_only = permission.startswith('get:')
+    g.db_wrote = False
+    g.db_replica = None
+
+
+# Record that the current request has written to the database,
+# so that everything else it does uses the primary
+def mark_write():
+    if has_app_context():
+        g.db_wrote = True
+
+
+def reads_from_replica():
+    return has_app_context() and g.get('db_read_only', False) and \
+        not g.get('db_wrote', False)
+
+
+# Whether the current request has read from a replica. What it read may
+# be behind the primary, so mustn't be cached beyond the request
+def read_from_replica():
+    return has_app_context() and bool(g.get('db_replica'))
+
+
+# Session that reads from a replica when the request allows it
+# The same replica is used for the whole request, so that its reads
+# are consistent with each other
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return bind
+        if replica_router.enabled and not self._flushing and \
+                not getattr(clause, 'is_dml', False) and \
+                reads_from_replica():
+            if g.db_replica is None:
+                g.db_replica = replica_router.choose() or False
+            if g.db_replica:
+                return g.db_replica
+        return super().get_bind(mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def flush_is_write(session, flush_context, instances):
+    mark_write()
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def execute_is_write(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or \
+            orm_execute_state.is_delete:
+        mark_write()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def setup_replica_routing(app, options=None, urls=REPLICA_URLS):
+    replica_router.configure(urls, options)
+    app.before_request(start_request)
@@ -1,6 +1,45 @@
 from models import Actor
-from flask import abort, jsonify, request
+from flask import abort, request
+from sqlalchemy import delete, update
 from auth import requires_auth
+from batch import bulk_insert, get_requested_ids
+from cache import entity_cache
+from casting import format_embedded, get_embed_params, load_embedded
+from etags import collection_etag, embedded_etag, entity_etag, \
+    not_modified, wants_representation
+from exporter import export_response
+from importer import ImportFailed, format_for_mimetype, import_records
+from json_provider import jsonify
+from pagination import get_page_params, paginate_by_name
+from replicas import read_from_replica
+from search import name_contains, ranked_search
+
+
+# Columns set when creating an actor, in the order used for imports
+ACTOR_COLUMNS = ('name', 'age', 'gender')
+
+# Range of ages the database can store
+MIN_AGE = -2 ** 31
+MAX_AGE = 2 ** 31 - 1
+
+
+# Check that the data describes a valid actor, returning
+# the fields to store if it does and None if it doesn't
+def get_actor_fields(data):
+    if not isinstance(data, dict):
+        return None
+    # check the data actually specifies the fields needed
+    if not {'name', 'age', 'gender'} <= set(data):
+        return None
+    name = data['name']
+    age = data['age']
+    gender = data['gender']
+    if not isinstance(name, str) or not isinstance(age, int) or \
+            isinstance(age, bool) or not isinstance(gender, str):
+        return None
+    if not MIN_AGE <= age <= MAX_AGE:
+        return None
+    return {'name': name, 'age': age, 'gender': gender}
 
 
 def setup_actor_routes(app, db):
@@ -8,19 +47,64 @@ def setup_actor_routes(app, db):
     @requires_auth('get:actors')
     def show_actor(actor_id):
         # shows the artist page with the given artist_id
-        actor = Actor.query.filter_by(id=actor_id).first()
-        if actor is None:
-            abort(404)
-        actor_data = {
-            'id': actor.id,
-            'name': actor.name,
-            'age': actor.age,
-            'gender': actor.gender
-        }
-        return jsonify({
+        cached = entity_cache.get('actors', actor_id)
+        if cached is None:
+            actor = Actor.query.filter_by(id=actor_id).first()
+            if actor is None:
+                abort(404)
+            cached = (actor.format(), actor.version)
+            # a replica may not have replayed the latest edit yet, which
+            # would then be served from the cache long after it catches up
+            if not read_from_replica():
+                entity_cache.set('actors', actor_id, cached)
+        actor_data, version = cached
+        etag = entity_etag('actors', actor_id, version)
+        embed, limit = get_embed_params('actors')
+        if embed is not None:
+            related, total = load_embedded(
+                db.session, 'actors', embed, [actor_id], limit).get(
+                actor_id, ([], 0))
+            etag = embedded_etag(etag, embed, related, total)
+            actor_data = dict(actor_data)
+            actor_data[embed] = format_embedded(related, total)
+        unchanged = not_modified(etag)
+        if unchanged is not None:
+            return unchanged
+        response = jsonify({
             'success': True,
             'actor_data': actor_data
         })
+        response.set_etag(etag)
+        return response
+
+    @app.route('/actors')
+    @requires_auth('get:actors')
+    def show_actors():
+        # shows all the actors with the given ids, using a single query
+        # (and one more for any related records embedded)
+        ids = get_requested_ids()
+        embed, limit = get_embed_params('actors')
+        actors = Actor.query.filter(Actor.id.in_(ids)).all()
+        found = {actor.id: actor.format() for actor in actors}
+        if embed is not None and found:
+            embedded = load_embedded(db.session, 'actors', embed,
+                                     list(found), limit)
+            for id, data in found.items():
+                data[embed] = format_embedded(*embedded.get(id, ([], 0)))
+        return jsonify({
+            'success': True,
+            'actor_data': {
+                'data': {str(id): found[id]
+                         for id in ids if id in found},
+                'missing': [id for id in ids if id not in found]
+            }
+        })
+
+    @app.route('/actors/export')
+    @requires_auth('get:actors')
+    def export_actors():
+        # streams every actor as newline-delimited JSON
+        return export_response(db, Actor)
 
     @app.route('/actors/search', methods=['POST'])
     @requires_auth('get:actors')
@@ -32,40 +116,44 @@ def setup_actor_routes(app, db):
         search_term = request.get_json()['search_term']
         if not isinstance(search_term, str):
             abort(400)
-        # Case-insenstive search with any characters
-        # before or after the search term
-        actors = Actor.query.filter(Actor.name.ilike(f'%{search_term}%')).all()
+        limit, after = get_page_params(request.get_json())
+        mode = request.get_json().get('mode', 'substring')
+        if mode == 'substring':
+            # Case-insenstive search with any characters
+            # before or after the search term
+            query = Actor.query.filter(name_contains(Actor, search_term))
+            actors, next_cursor = \
+                paginate_by_name(query, Actor, limit, after)
+        elif mode == 'fulltext' and after is None:
+            # Search for words in the name, most relevant first
+            actors = ranked_search(Actor.query, Actor, search_term, limit)
+            next_cursor = None
+        else:
+            abort(400)
+        etag = collection_etag('actors', request.get_json(), actors,
+                               next_cursor)
+        unchanged = not_modified(etag)
+        if unchanged is not None:
+            return unchanged
         actor_data = {
             'count': len(actors),
-            'data': []
+            'data': [actor.format() for actor in actors],
+            'next_cursor': next_cursor
         }
-        for actor in actors:
-            actor_data['data'].append({
-                'id': actor.id,
-                'name': actor.name,
-                'age': actor.age,
-                'gender': actor.gender
-            })
-        return jsonify({
+        response = jsonify({
             'success': True,
             'actor_data': actor_data
         })
+        response.set_etag(etag)
+        return response
 
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
     def add_actor():
-        if request.get_json() is None:
-            abort(400)
-        # check the request actually specifies the data needed
-        if not {'name', 'age', 'gender'} <= set(request.get_json()):
-            abort(400)
-        name = request.get_json()['name']
-        age = request.get_json()['age']
-        gender = request.get_json()['gender']
-        if not isinstance(name, str) or not isinstance(age, int) or \
-                not isinstance(gender, str):
+        fields = get_actor_fields(request.get_json())
+        if fields is None:
             abort(400)
-        new_actor = Actor(name=name, age=age, gender=gender)
+        new_actor = Actor(**fields)
         db.session.add(new_actor)
         db.session.commit()
         return jsonify({
@@ -73,42 +161,74 @@ def setup_actor_routes(app, db):
             'id': new_actor.id
         })
 
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    def add_actors():
+        return bulk_insert(db, Actor, 'actors', get_actor_fields)
+
+    @app.route('/actors/import', methods=['POST'])
+    @requires_auth('post:actors')
+    def import_actors():
+        # stream NDJSON or CSV in the request body into the database
+        data_format = format_for_mimetype(request.mimetype)
+        if data_format is None:
+            abort(400)
+        try:
+            result = import_records(db, 'actors', ACTOR_COLUMNS,
+                                    get_actor_fields, request.stream,
+                                    data_format)
+        except ImportFailed:
+            abort(422)
+        db.session.commit()
+        return jsonify({
+            'success': True,
+            **result
+        })
+
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actors')
     def edit_actor(actor_id):
-        if request.get_json() is None:
-            abort(400)
-        # check the request actually specifies the data needed
-        if not {'name', 'age', 'gender'} <= set(request.get_json()):
-            abort(400)
-        name = request.get_json()['name']
-        age = request.get_json()['age']
-        gender = request.get_json()['gender']
-        if not isinstance(name, str) or not isinstance(age, int) or \
-                not isinstance(gender, str):
+        fields = get_actor_fields(request.get_json())
+        if fields is None:
             abort(400)
-        # Check there is a actor with requested id
-        actor = Actor.query.filter_by(id=actor_id).first()
+        # Update and check there is an actor with requested id in one statement
+        actor = db.session.execute(
+            update(Actor.__table__).
+            where(Actor.id == actor_id).
+            values(version=Actor.version + 1, **fields).
+            returning(Actor.id, Actor.name, Actor.age, Actor.gender,
+                      Actor.version)
+        ).first()
         if actor is None:
             abort(404)
-        db.session.query(Actor).\
-            filter(Actor.id == actor_id).\
-            update({'name': name, 'age': age, 'gender': gender})
         db.session.commit()
-        return jsonify({
-            'success': True
+        entity_cache.invalidate('actors', actor_id)
+        if not wants_representation():
+            return jsonify({
+                'success': True
+            })
+        actor_data = dict(actor._mapping)
+        etag = entity_etag('actors', actor_id, actor_data.pop('version'))
+        response = jsonify({
+            'success': True,
+            'actor_data': actor_data
         })
+        response.set_etag(etag)
+        return response
 
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actors')
     def delete_actor(actor_id):
-        # Check there is a actor with requested id
-        actor = Actor.query.filter_by(id=actor_id).first()
+        # Delete and check there is an actor with requested id in one statement
+        actor = db.session.execute(
+            delete(Actor.__table__).
+            where(Actor.id == actor_id).
+            returning(Actor.id)
+        ).first()
         if actor is None:
             abort(404)
-        db.session.query(Actor).\
-            filter(Actor.id == actor_id).delete()
         db.session.commit()
+        entity_cache.invalidate('actors', actor_id)
         return jsonify({
             'success': True
         })
@@ -1,6 +1,61 @@
-from models import Movie
-from flask import abort, jsonify, request
+import datetime
+from models import Actor, Movie, casting
+from flask import abort, request
+from sqlalchemy import delete, literal, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from werkzeug.http import parse_date
 from auth import requires_auth
+from batch import bulk_insert, get_requested_ids
+from cache import entity_cache
+from casting import format_embedded, get_actor_ids, get_embed_params, \
+    load_embedded
+from etags import collection_etag, embedded_etag, entity_etag, \
+    not_modified, wants_representation
+from exporter import export_response
+from importer import ImportFailed, format_for_mimetype, import_records
+from json_provider import jsonify
+from pagination import get_page_params, paginate_by_name
+from replicas import read_from_replica
+from search import name_contains, ranked_search
+
+
+# Columns set when creating a movie, in the order used for imports
+MOVIE_COLUMNS = ('name', 'release_date')
+
+
+# Check that the data describes a valid movie, returning
+# the fields to store if it does and None if it doesn't
+def get_movie_fields(data):
+    if not isinstance(data, dict):
+        return None
+    # check the data actually specifies the fields needed
+    if not {'name', 'release_date'} <= set(data):
+        return None
+    name = data['name']
+    if not isinstance(name, str):
+        return None
+    release_date = parse_release_date(data['release_date'])
+    if release_date is None:
+        return None
+    return {'name': name, 'release_date': release_date}
+
+
+# Convert a release date in ISO format (e.g. "2022-01-01") or the HTTP
+# format movies are sent in (e.g. "Sat, 01 Jan 2022 00:00:00 GMT") to the
+# ISO format stored, or None if it isn't a valid date in either, so that
+# bulk requests and imports report it rather than the database rejecting
+# the whole batch
+def parse_release_date(value):
+    if not isinstance(value, str):
+        return None
+    try:
+        date = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        date = parse_date(value)
+        if date is None:
+            return None
+    # as the database does for columns without a time zone
+    return date.replace(tzinfo=None).isoformat()
 
 
 def setup_movie_routes(app, db):
@@ -8,18 +63,64 @@ def setup_movie_routes(app, db):
     @requires_auth('get:movies')
     def show_movie(movie_id):
         # shows the artist page with the given artist_id
-        movie = Movie.query.filter_by(id=movie_id).first()
-        if movie is None:
-            abort(404)
-        movie_data = {
-            'id': movie.id,
-            'name': movie.name,
-            'release_date': movie.release_date
-        }
-        return jsonify({
+        cached = entity_cache.get('movies', movie_id)
+        if cached is None:
+            movie = Movie.query.filter_by(id=movie_id).first()
+            if movie is None:
+                abort(404)
+            cached = (movie.format(), movie.version)
+            # a replica may not have replayed the latest edit yet, which
+            # would then be served from the cache long after it catches up
+            if not read_from_replica():
+                entity_cache.set('movies', movie_id, cached)
+        movie_data, version = cached
+        etag = entity_etag('movies', movie_id, version)
+        embed, limit = get_embed_params('movies')
+        if embed is not None:
+            related, total = load_embedded(
+                db.session, 'movies', embed, [movie_id], limit).get(
+                movie_id, ([], 0))
+            etag = embedded_etag(etag, embed, related, total)
+            movie_data = dict(movie_data)
+            movie_data[embed] = format_embedded(related, total)
+        unchanged = not_modified(etag)
+        if unchanged is not None:
+            return unchanged
+        response = jsonify({
             'success': True,
             'movie_data': movie_data
         })
+        response.set_etag(etag)
+        return response
+
+    @app.route('/movies')
+    @requires_auth('get:movies')
+    def show_movies():
+        # shows all the movies with the given ids, using a single query
+        # (and one more for any related records embedded)
+        ids = get_requested_ids()
+        embed, limit = get_embed_params('movies')
+        movies = Movie.query.filter(Movie.id.in_(ids)).all()
+        found = {movie.id: movie.format() for movie in movies}
+        if embed is not None and found:
+            embedded = load_embedded(db.session, 'movies', embed,
+                                     list(found), limit)
+            for id, data in found.items():
+                data[embed] = format_embedded(*embedded.get(id, ([], 0)))
+        return jsonify({
+            'success': True,
+            'movie_data': {
+                'data': {str(id): found[id]
+                         for id in ids if id in found},
+                'missing': [id for id in ids if id not in found]
+            }
+        })
+
+    @app.route('/movies/export')
+    @requires_auth('get:movies')
+    def export_movies():
+        # streams every movie as newline-delimited JSON
+        return export_response(db, Movie)
 
     @app.route('/movies/search', methods=['POST'])
     @requires_auth('get:movies')
@@ -31,39 +132,44 @@ def setup_movie_routes(app, db):
         search_term = request.get_json()['search_term']
         if not isinstance(search_term, str):
             abort(400)
-        # Case-insenstive search with any characters
-        # before or after the search term
-        movies = Movie.query.filter(Movie.name.ilike(f'%{search_term}%')).all()
+        limit, after = get_page_params(request.get_json())
+        mode = request.get_json().get('mode', 'substring')
+        if mode == 'substring':
+            # Case-insenstive search with any characters
+            # before or after the search term
+            query = Movie.query.filter(name_contains(Movie, search_term))
+            movies, next_cursor = \
+                paginate_by_name(query, Movie, limit, after)
+        elif mode == 'fulltext' and after is None:
+            # Search for words in the name, most relevant first
+            movies = ranked_search(Movie.query, Movie, search_term, limit)
+            next_cursor = None
+        else:
+            abort(400)
+        etag = collection_etag('movies', request.get_json(), movies,
+                               next_cursor)
+        unchanged = not_modified(etag)
+        if unchanged is not None:
+            return unchanged
         movie_data = {
             'count': len(movies),
-            'data': []
+            'data': [movie.format() for movie in movies],
+            'next_cursor': next_cursor
         }
-        for movie in movies:
-            movie_data['data'].append({
-                'id': movie.id,
-                'name': movie.name,
-                'release_date': movie.release_date,
-            })
-        return jsonify({
+        response = jsonify({
             'success': True,
             'movie_data': movie_data
         })
+        response.set_etag(etag)
+        return response
 
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
     def add_movie():
-        if request.get_json() is None:
+        fields = get_movie_fields(request.get_json())
+        if fields is None:
             abort(400)
-        # check the request actually specifies the data needed
-        if not {'name', 'release_date'} <= set(request.get_json()):
-            abort(400)
-        name = request.get_json()['name']
-        if not isinstance(name, str):
-            abort(400)
-        release_date = request.get_json()['release_date']
-        if not (isinstance(release_date, str)):
-            abort(400)
-        new_movie = Movie(name=name, release_date=release_date)
+        new_movie = Movie(**fields)
         db.session.add(new_movie)
         db.session.commit()
         return jsonify({
@@ -71,43 +177,123 @@ def setup_movie_routes(app, db):
             'id': new_movie.id
         })
 
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    def add_movies():
+        return bulk_insert(db, Movie, 'movies', get_movie_fields)
+
+    @app.route('/movies/import', methods=['POST'])
+    @requires_auth('post:movies')
+    def import_movies():
+        # stream NDJSON or CSV in the request body into the database
+        data_format = format_for_mimetype(request.mimetype)
+        if data_format is None:
+            abort(400)
+        try:
+            result = import_records(db, 'movies', MOVIE_COLUMNS,
+                                    get_movie_fields, request.stream,
+                                    data_format)
+        except ImportFailed:
+            abort(422)
+        db.session.commit()
+        return jsonify({
+            'success': True,
+            **result
+        })
+
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch:movies')
     def edit_movie(movie_id):
-        if request.get_json() is None:
-            abort(400)
-        # check the request actually specifies the data needed
-        if not {'name', 'release_date'} <= set(request.get_json()):
+        fields = get_movie_fields(request.get_json())
+        if fields is None:
             abort(400)
-        movie = Movie.query.filter_by(id=movie_id).first()
-        name = request.get_json()['name']
-        if not isinstance(name, str):
-            abort(400)
-        release_date = request.get_json()['release_date']
-        if not (isinstance(release_date, str)):
-            abort(400)
-        # Check there is a movie with requested id
-        movie = Movie.query.filter_by(id=movie_id).first()
+        # Update and check there is a movie with requested id in one statement
+        movie = db.session.execute(
+            update(Movie.__table__).
+            where(Movie.id == movie_id).
+            values(version=Movie.version + 1, **fields).
+            returning(Movie.id, Movie.name, Movie.release_date, Movie.version)
+        ).first()
         if movie is None:
             abort(404)
-        db.session.query(Movie).\
-            filter(Movie.id == movie_id).\
-            update({'name': name, 'release_date': release_date})
         db.session.commit()
-        return jsonify({
-            'success': True
+        entity_cache.invalidate('movies', movie_id)
+        if not wants_representation():
+            return jsonify({
+                'success': True
+            })
+        movie_data = dict(movie._mapping)
+        etag = entity_etag('movies', movie_id, movie_data.pop('version'))
+        response = jsonify({
+            'success': True,
+            'movie_data': movie_data
         })
+        response.set_etag(etag)
+        return response
 
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth('delete:movies')
     def delete_movie(movie_id):
-        # Check there is a movie with requested id
-        movie = Movie.query.filter_by(id=movie_id).first()
+        # Delete and check there is a movie with requested id in one statement
+        movie = db.session.execute(
+            delete(Movie.__table__).
+            where(Movie.id == movie_id).
+            returning(Movie.id)
+        ).first()
         if movie is None:
             abort(404)
-        db.session.query(Movie).\
-            filter(Movie.id == movie_id).delete()
         db.session.commit()
+        entity_cache.invalidate('movies', movie_id)
         return jsonify({
             'success': True
         })
+
+    @app.route('/movies/<int:movie_id>/cast', methods=['POST'])
+    @requires_auth('patch:movies')
+    def add_cast(movie_id):
+        # casts every existing actor in the body's "actor_ids" in the movie,
+        # with one INSERT ... SELECT, listing those newly cast and the ids
+        # without an actor
+        ids = get_actor_ids(request.get_json())
+        # locking the movie's key keeps it from being deleted meanwhile
+        if Movie.query.with_entities(Movie.id).filter_by(id=movie_id).\
+                with_for_update(key_share=True).first() is None:
+            abort(404)
+        found = db.session.execute(
+            select(Actor.id).where(Actor.id.in_(ids))).scalars().all()
+        added = db.session.execute(
+            pg_insert(casting).
+            from_select(['movie_id', 'actor_id'],
+                        select(literal(movie_id), Actor.id).
+                        where(Actor.id.in_(ids))).
+            on_conflict_do_nothing().
+            returning(casting.c.actor_id)
+        ).scalars().all()
+        db.session.commit()
+        found = set(found)
+        return jsonify({
+            'success': True,
+            'added': sorted(added),
+            'missing': [id for id in ids if id not in found]
+        })
+
+    @app.route('/movies/<int:movie_id>/cast', methods=['DELETE'])
+    @requires_auth('patch:movies')
+    def remove_cast(movie_id):
+        # removes the actors in the body's "actor_ids" from the movie's cast
+        # with one statement, listing those that were in it
+        ids = get_actor_ids(request.get_json())
+        if Movie.query.with_entities(Movie.id).\
+                filter_by(id=movie_id).first() is None:
+            abort(404)
+        removed = db.session.execute(
+            delete(casting).
+            where(casting.c.movie_id == movie_id,
+                  casting.c.actor_id.in_(ids)).
+            returning(casting.c.actor_id)
+        ).scalars().all()
+        db.session.commit()
+        return jsonify({
+            'success': True,
+            'removed': sorted(removed)
+        })
@@ -0,0 +1,43 @@
+from sqlalchemy import func, literal_column, true
+
+
+# Escape the characters that ILIKE treats as wildcards,
+# so that the search term is matched literally
+def escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+# Case-insensitive filter for names containing the search term
+# With the pg_trgm extension installed (see the name search migration) the
+# planner can answer this from the trigram index on the name column;
+# without it the same query falls back to scanning the table. An empty
+# search term matches everything, so no filter is applied at all and
+# pages can be read straight from the (name, id) index
+def name_contains(model, term):
+    if term == '':
+        return true()
+    return model.name.ilike(f'%{escape_like(term)}%', escape='\\')
+
+
+# Text search configuration used by the generated search_vector columns
+# ('simple' neither stems words nor drops stop words, which suits names)
+SEARCH_CONFIG = 'simple'
+
+
+# Restrict the query (or select statement) to up to "limit" records whose
+# names match a web-style search (quoted phrases, "or", and -excluded words
+# are understood), best matches first. The match is answered from the GIN
+# index on search_vector
+def ranked_matches(query, model, term, limit):
+    # the configuration name is written into the query, as drivers that
+    # send typed parameters (such as asyncpg) would pass it as a varchar
+    # rather than a regconfig
+    config = literal_column(f"'{SEARCH_CONFIG}'")
+    tsquery = func.websearch_to_tsquery(config, term)
+    rank = func.ts_rank(model.search_vector, tsquery)
+    return query.filter(model.search_vector.op('@@')(tsquery)).\
+        order_by(rank.desc(), model.id).limit(limit)
+
+
+def ranked_search(query, model, term, limit):
+    return ranked_matches(query, model, term, limit).all()
@@ -63,7 +63,9 @@ CREATE TABLE public.actors (
     id integer NOT NULL,
     name character varying NOT NULL,
     age integer,
-    gender character varying
+    gender character varying,
+    search_vector tsvector GENERATED ALWAYS AS (to_tsvector('simple'::regconfig, (COALESCE(name, ''::character varying))::text)) STORED,
+    version integer DEFAULT 1 NOT NULL
 );
 
 
@@ -102,6 +104,18 @@ CREATE TABLE public.alembic_version (
 
 ALTER TABLE public.alembic_version OWNER TO postgres;
 
+--
+-- Name: casting; Type: TABLE; Schema: public; Owner: postgres
+--
+
+CREATE TABLE public.casting (
+    movie_id integer NOT NULL,
+    actor_id integer NOT NULL
+);
+
+
+ALTER TABLE public.casting OWNER TO postgres;
+
 --
 -- Name: movies; Type: TABLE; Schema: public; Owner: postgres
 --
@@ -109,7 +123,9 @@ ALTER TABLE public.alembic_version OWNER TO postgres;
 CREATE TABLE public.movies (
     id integer NOT NULL,
     name character varying NOT NULL,
-    release_date timestamp without time zone
+    release_date timestamp without time zone,
+    search_vector tsvector GENERATED ALWAYS AS (to_tsvector('simple'::regconfig, (COALESCE(name, ''::character varying))::text)) STORED,
+    version integer DEFAULT 1 NOT NULL
 );
 
 
@@ -186,6 +202,18 @@ COPY public.alembic_version (version_num) FROM stdin;
 \.
 
 
+--
+-- Data for Name: casting; Type: TABLE DATA; Schema: public; Owner: postgres
+--
+
+COPY public.casting (movie_id, actor_id) FROM stdin;
+1	1
+1	2
+2	1
+3	4
+\.
+
+
 --
 -- Data for Name: movies; Type: TABLE DATA; Schema: public; Owner: postgres
 --
@@ -242,6 +270,14 @@ ALTER TABLE ONLY public.alembic_version
     ADD CONSTRAINT alembic_version_pkc PRIMARY KEY (version_num);
 
 
+--
+-- Name: casting casting_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.casting
+    ADD CONSTRAINT casting_pkey PRIMARY KEY (movie_id, actor_id);
+
+
 --
 -- Name: movies movies_pkey; Type: CONSTRAINT; Schema: public; Owner: postgres
 --
@@ -250,6 +286,57 @@ ALTER TABLE ONLY public.movies
     ADD CONSTRAINT movies_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: ix_actors_name_id; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_actors_name_id ON public.actors USING btree (name, id);
+
+
+--
+-- Name: ix_actors_search_vector; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_actors_search_vector ON public.actors USING gin (search_vector);
+
+
+--
+-- Name: ix_casting_actor_id_movie_id; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_casting_actor_id_movie_id ON public.casting USING btree (actor_id, movie_id);
+
+
+--
+-- Name: ix_movies_name_id; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_movies_name_id ON public.movies USING btree (name, id);
+
+
+--
+-- Name: ix_movies_search_vector; Type: INDEX; Schema: public; Owner: postgres
+--
+
+CREATE INDEX ix_movies_search_vector ON public.movies USING gin (search_vector);
+
+
+--
+-- Name: casting casting_actor_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.casting
+    ADD CONSTRAINT casting_actor_id_fkey FOREIGN KEY (actor_id) REFERENCES public.actors(id) ON DELETE CASCADE;
+
+
+--
+-- Name: casting casting_movie_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: postgres
+--
+
+ALTER TABLE ONLY public.casting
+    ADD CONSTRAINT casting_movie_id_fkey FOREIGN KEY (movie_id) REFERENCES public.movies(id) ON DELETE CASCADE;
+
+
 --
 -- PostgreSQL database dump complete
 --
@@ -9,6 +9,14 @@ from models import database_path
 from tests_misc import *
 from tests_movies import *
 from tests_actors import *
+from tests_auth import *
+from tests_cache import *
+from tests_json import *
+from tests_compress import *
+from tests_db import *
+from tests_asgi import *
+from tests_metrics import *
+from tests_benchmark import *
 
 # Get the database path from an environment variable
 # Heroku automatically generates a DATABASE_URL beginning with
@@ -40,27 +48,75 @@ class TriviaTestCase(unittest.TestCase):
     def test_get_movie(self):
         test_get_movie(self)
 
+    def test_get_movie_cached(self):
+        test_get_movie_cached(self)
+
+    def test_get_movie_etag(self):
+        test_get_movie_etag(self)
+
     def test_get_movie_fail(self):
         test_get_movie_fail(self)
 
+    def test_get_movies(self):
+        test_get_movies(self)
+
+    def test_get_movies_fail(self):
+        test_get_movies_fail(self)
+
+    def test_get_movies_cast(self):
+        test_get_movies_cast(self)
+
+    def test_export_movies(self):
+        test_export_movies(self)
+
+    def test_import_movies(self):
+        test_import_movies(self)
+
+    def test_import_movies_fail(self):
+        test_import_movies_fail(self)
+
     def test_search_movie(self):
         test_search_movie(self)
 
     def test_search_movie_fail(self):
         test_search_movie_fail(self)
 
+    def test_search_movie_pages(self):
+        test_search_movie_pages(self)
+
+    def test_search_movie_page_etag(self):
+        test_search_movie_page_etag(self)
+
+    def test_search_movie_ranked(self):
+        test_search_movie_ranked(self)
+
     def test_add_movie(self):
         test_add_movie(self)
 
     def test_add_movie_fail(self):
         test_add_movie_fail(self)
 
+    def test_add_movies(self):
+        test_add_movies(self)
+
+    def test_add_movies_fail(self):
+        test_add_movies_fail(self)
+
     def test_edit_movie(self):
         test_edit_movie(self)
 
     def test_edit_movie_fail(self):
         test_edit_movie_fail(self)
 
+    def test_edit_movie_representation(self):
+        test_edit_movie_representation(self)
+
+    def test_edit_movie_cast(self):
+        test_edit_movie_cast(self)
+
+    def test_edit_movie_cast_fail(self):
+        test_edit_movie_cast_fail(self)
+
     def test_delete_movie(self):
         test_delete_movie(self)
 
@@ -70,33 +126,159 @@ class TriviaTestCase(unittest.TestCase):
     def test_get_actor(self):
         test_get_actor(self)
 
+    def test_get_actor_cached(self):
+        test_get_actor_cached(self)
+
+    def test_get_actor_etag(self):
+        test_get_actor_etag(self)
+
     def test_get_actor_fail(self):
         test_get_actor_fail(self)
 
+    def test_get_actors(self):
+        test_get_actors(self)
+
+    def test_get_actors_fail(self):
+        test_get_actors_fail(self)
+
+    def test_get_actor_movies(self):
+        test_get_actor_movies(self)
+
+    def test_export_actors(self):
+        test_export_actors(self)
+
+    def test_import_actors(self):
+        test_import_actors(self)
+
+    def test_import_actors_fail(self):
+        test_import_actors_fail(self)
+
     def test_search_actor(self):
         test_search_actor(self)
 
     def test_search_actor_fail(self):
         test_search_actor_fail(self)
 
+    def test_search_actor_pages(self):
+        test_search_actor_pages(self)
+
+    def test_search_actor_ranked(self):
+        test_search_actor_ranked(self)
+
     def test_add_actor(self):
         test_add_actor(self)
 
     def test_add_actor_fail(self):
         test_add_actor_fail(self)
 
+    def test_add_actors(self):
+        test_add_actors(self)
+
+    def test_add_actors_fail(self):
+        test_add_actors_fail(self)
+
     def test_edit_actor(self):
         test_edit_actor(self)
 
     def test_edit_actor_fail(self):
         test_edit_actor_fail(self)
 
+    def test_edit_actor_representation(self):
+        test_edit_actor_representation(self)
+
     def test_delete_actor(self):
         test_delete_actor(self)
 
     def test_delete_actor_fail(self):
         test_delete_actor_fail(self)
 
+    def test_jwks_store_caches_keys(self):
+        test_jwks_store_caches_keys(self)
+
+    def test_jwks_store_unknown_kid(self):
+        test_jwks_store_unknown_kid(self)
+
+    def test_jwks_store_fetch_failure(self):
+        test_jwks_store_fetch_failure(self)
+
+    def test_jwks_store_one_refresher(self):
+        test_jwks_store_one_refresher(self)
+
+    def test_token_cache_expiry(self):
+        test_token_cache_expiry(self)
+
+    def test_token_cache_eviction(self):
+        test_token_cache_eviction(self)
+
+    def test_local_key_verification(self):
+        test_local_key_verification(self)
+
+    def test_local_key_file_reload(self):
+        test_local_key_file_reload(self)
+
+    def test_rbac_local_keys(self):
+        test_rbac_local_keys(self)
+
+    def test_cache_backends(self):
+        test_cache_backends(self)
+
+    def test_json_providers(self):
+        test_json_providers(self)
+
+    def test_compress_responses(self):
+        test_compress_responses(self)
+
+    def test_compress_export(self):
+        test_compress_export(self)
+
+    def test_compress_cache_query_string(self):
+        test_compress_cache_query_string(self)
+
+    def test_pool_stats(self):
+        test_pool_stats(self)
+
+    def test_replica_routing(self):
+        test_replica_routing(self)
+
+    def test_replica_read_your_writes(self):
+        test_replica_read_your_writes(self)
+
+    def test_replica_not_cached(self):
+        test_replica_not_cached(self)
+
+    def test_sql_profiler(self):
+        test_sql_profiler(self)
+
+    def test_generate_data(self):
+        test_generate_data(self)
+
+    def test_asgi_movie(self):
+        test_asgi_movie(self)
+
+    def test_asgi_actors(self):
+        test_asgi_actors(self)
+
+    def test_asgi_rbac(self):
+        test_asgi_rbac(self)
+
+    def test_metrics_endpoint(self):
+        test_metrics_endpoint(self)
+
+    def test_metrics_aggregation(self):
+        test_metrics_aggregation(self)
+
+    def test_metrics_exited_workers(self):
+        test_metrics_exited_workers(self)
+
+    def test_benchmark_scenarios(self):
+        test_benchmark_scenarios(self)
+
+    def test_benchmark_run(self):
+        test_benchmark_run(self)
+
+    def test_auth_benchmarks(self):
+        test_auth_benchmarks(self)
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
@@ -2,8 +2,10 @@
 # actor endpoints. Note that these will still need to be called
 # from the main test handler.
 
+import gzip
 import json
 from tests_misc import *
+from cache import entity_cache
 
 
 # *****************************************
@@ -47,11 +49,133 @@ def test_get_actor(test_obj):
     test_is_valid_actor(test_obj, data['actor_data'])
 
 
+# Test that reading an actor again is served from the cache,
+# and that editing the actor replaces the cached version
+def test_get_actor_cached(test_obj):
+    submission_data = json.dumps(dict(name='cached actor', age=30,
+                                      gender='gender'))
+    res_submission = test_obj.client().post('/actors',
+                                            data=submission_data,
+                                            content_type='application/json')
+    actor_id = json.loads(res_submission.get_data(as_text=True))['id']
+    hits, misses = entity_cache.hits, entity_cache.misses
+    test_obj.client().get(f'/actors/{actor_id}')
+    res_cached = test_obj.client().get(f'/actors/{actor_id}')
+    data = json.loads(res_cached.get_data(as_text=True))
+    test_is_success_response(test_obj, res_cached, data)
+    test_obj.assertEqual(data['actor_data']['name'], 'cached actor')
+    test_obj.assertEqual(entity_cache.misses, misses + 1)
+    test_obj.assertEqual(entity_cache.hits, hits + 1)
+
+    patch_data = json.dumps(dict(name='cached actor is edited', age=30,
+                                 gender='gender'))
+    test_obj.client().patch(f'/actors/{actor_id}',
+                            data=patch_data,
+                            content_type='application/json')
+    res_edited = test_obj.client().get(f'/actors/{actor_id}')
+    data = json.loads(res_edited.get_data(as_text=True))
+    test_is_success_response(test_obj, res_edited, data)
+    test_obj.assertEqual(data['actor_data']['name'],
+                         'cached actor is edited')
+
+    test_obj.client().delete(f'/actors/{actor_id}')
+    res_deleted = test_obj.client().get(f'/actors/{actor_id}')
+    test_error_format(test_obj, res_deleted, 404)
+
+
+# Test that a actor and a search for it can be revalidated with
+# If-None-Match, and that editing the actor changes both their tags
+def test_get_actor_etag(test_obj):
+    submission_data = json.dumps(dict(name='etag actor', age=30,
+                                      gender='gender'))
+    res_submission = test_obj.client().post('/actors',
+                                            data=submission_data,
+                                            content_type='application/json')
+    actor_id = json.loads(res_submission.get_data(as_text=True))['id']
+    search_data = json.dumps(dict(search_term='etag actor'))
+    res = test_obj.client().get(f'/actors/{actor_id}')
+    res_search = test_obj.client().post('/actors/search',
+                                        data=search_data,
+                                        content_type='application/json')
+    etag = res.headers['ETag']
+    search_etag = res_search.headers['ETag']
+
+    res_unchanged = test_obj.client().get(f'/actors/{actor_id}',
+                                          headers={'If-None-Match': etag})
+    test_obj.assertEqual(res_unchanged.status_code, 304)
+    test_obj.assertEqual(res_unchanged.get_data(), b'')
+    res_search_unchanged = test_obj.client().post(
+        '/actors/search', data=search_data, content_type='application/json',
+        headers={'If-None-Match': search_etag})
+    test_obj.assertEqual(res_search_unchanged.status_code, 304)
+
+    patch_data = json.dumps(dict(name='etag actor', age=31,
+                                 gender='gender'))
+    test_obj.client().patch(f'/actors/{actor_id}',
+                            data=patch_data,
+                            content_type='application/json')
+    res_changed = test_obj.client().get(f'/actors/{actor_id}',
+                                        headers={'If-None-Match': etag})
+    test_is_success_response(test_obj, res_changed)
+    test_obj.assertNotEqual(res_changed.headers['ETag'], etag)
+    res_search_changed = test_obj.client().post(
+        '/actors/search', data=search_data, content_type='application/json',
+        headers={'If-None-Match': search_etag})
+    test_is_success_response(test_obj, res_search_changed)
+    test_obj.assertNotEqual(res_search_changed.headers['ETag'], search_etag)
+
+
 def test_get_actor_fail(test_obj):
     res = test_obj.client().get('/actors/100000')
     test_error_format(test_obj, res, 404)
 
 
+# Test, when reading several actors at once, that the existing actors
+# are returned by id and the ids without a actor are listed as missing
+def test_get_actors(test_obj):
+    res = test_obj.client().get('/actors?ids=1,100000,1')
+    data = json.loads(res.get_data(as_text=True))
+    test_is_success_response(test_obj, res, data)
+    test_obj.assertEqual(list(data['actor_data']['data']), ['1'])
+    test_is_valid_actor(test_obj, data['actor_data']['data']['1'])
+    test_obj.assertEqual(data['actor_data']['missing'], [100000])
+
+
+def test_get_actors_fail(test_obj):
+    # should fail if no ids are given
+    res_no_ids = test_obj.client().get('/actors')
+    test_error_format(test_obj, res_no_ids, 400)
+    # should fail if an id is not an integer
+    res_bad_id = test_obj.client().get('/actors?ids=1,a')
+    test_error_format(test_obj, res_bad_id, 400)
+    # should fail if too many ids are requested
+    too_many_ids = ','.join(str(id) for id in range(1, 1000))
+    res_too_many = test_obj.client().get(f'/actors?ids={too_many_ids}')
+    test_error_format(test_obj, res_too_many, 400)
+
+
+# Test exporting every actor as NDJSON, both plain and gzipped
+def test_export_actors(test_obj):
+    res = test_obj.client().get('/actors/export')
+    test_obj.assertEqual(res.status_code, 200)
+    test_obj.assertEqual(res.mimetype, 'application/x-ndjson')
+    actors = [json.loads(line)
+              for line in res.get_data(as_text=True).splitlines()]
+    test_obj.assertGreaterEqual(len(actors), 1)
+    for actor in actors:
+        test_is_valid_actor(test_obj, actor)
+    ids = [actor['id'] for actor in actors]
+    test_obj.assertEqual(ids, sorted(ids))
+
+    res_gzip = test_obj.client().get('/actors/export',
+                                     headers={'Accept-Encoding': 'gzip'})
+    test_obj.assertEqual(res_gzip.status_code, 200)
+    test_obj.assertEqual(res_gzip.headers['Content-Encoding'], 'gzip')
+    data = gzip.decompress(res_gzip.get_data()).decode('utf-8')
+    test_obj.assertEqual([json.loads(line) for line in data.splitlines()],
+                         actors)
+
+
 # Test, when reading a actor, that the response is successful
 # and contains a valid list of actor data
 def test_search_actor(test_obj):
@@ -63,6 +187,14 @@ def test_search_actor(test_obj):
     data = json.loads(res.get_data(as_text=True))
     test_is_success_response(test_obj, res, data)
     test_is_valid_actor_collection(test_obj, data['actor_data'])
+    # wildcard characters in the search term should be matched literally
+    submission_data = json.dumps(dict(search_term='%'))
+    res_wildcard = test_obj.client().post('/actors/search',
+                                          data=submission_data,
+                                          content_type='application/json')
+    data = json.loads(res_wildcard.get_data(as_text=True))
+    test_is_success_response(test_obj, res_wildcard, data)
+    test_obj.assertEqual(data['actor_data']['count'], 0)
 
 
 def test_search_actor_fail(test_obj):
@@ -81,6 +213,56 @@ def test_search_actor_fail(test_obj):
     # should fail if there is no data provided
     res_no_data = test_obj.client().post('/actors/search')
     test_error_format(test_obj, res_no_data, 400)
+    # should fail if the page size is invalid
+    submission_data = json.dumps(dict(search_term='actor', limit=0))
+    res_bad_limit = test_obj.client().post('/actors/search',
+                                           data=submission_data,
+                                           content_type='application/json')
+    test_error_format(test_obj, res_bad_limit, 400)
+    # should fail if the cursor is not one given out by the server
+    submission_data = json.dumps(dict(search_term='actor', after='bad'))
+    res_bad_cursor = test_obj.client().post('/actors/search',
+                                            data=submission_data,
+                                            content_type='application/json')
+    test_error_format(test_obj, res_bad_cursor, 400)
+    # should fail if the search mode is unknown
+    submission_data = json.dumps(dict(search_term='actor', mode='unknown'))
+    res_bad_mode = test_obj.client().post('/actors/search',
+                                          data=submission_data,
+                                          content_type='application/json')
+    test_error_format(test_obj, res_bad_mode, 400)
+
+
+# Test that following the cursors of a paginated search visits
+# every matching actor exactly once, in name order
+def test_search_actor_pages(test_obj):
+    submission_data = json.dumps(dict(search_term='actor'))
+    res = test_obj.client().post('/actors/search',
+                                 data=submission_data,
+                                 content_type='application/json')
+    data = json.loads(res.get_data(as_text=True))
+    test_is_success_response(test_obj, res, data)
+    test_obj.assertIsNone(data['actor_data']['next_cursor'])
+    expected = [(item['name'], item['id'])
+                for item in data['actor_data']['data']]
+    test_obj.assertGreaterEqual(len(expected), 2)
+    test_obj.assertEqual(expected, sorted(expected))
+
+    found = []
+    page_data = dict(search_term='actor', limit=1)
+    while True:
+        res_page = test_obj.client().post('/actors/search',
+                                          data=json.dumps(page_data),
+                                          content_type='application/json')
+        data = json.loads(res_page.get_data(as_text=True))
+        test_is_success_response(test_obj, res_page, data)
+        test_obj.assertEqual(data['actor_data']['count'], 1)
+        found += [(item['name'], item['id'])
+                  for item in data['actor_data']['data']]
+        if data['actor_data']['next_cursor'] is None:
+            break
+        page_data['after'] = data['actor_data']['next_cursor']
+    test_obj.assertEqual(found, expected)
 
 
 # Test adding a actor, and check that searching back for it retrieves it
@@ -123,6 +305,127 @@ def test_add_actor_fail(test_obj):
     test_error_format(test_obj, res_wrong_type, 400)
 
 
+# Test adding several actors at once, checking that the valid ones are
+# created in order and the invalid one is reported without stopping them
+def test_add_actors(test_obj):
+    submission_data = json.dumps(dict(actors=[
+        dict(name='bulk actor 1', age=30, gender='gender'),
+        dict(name='bulk actor 3', age='50', gender='gender'),
+        dict(name='bulk actor 2', age=40, gender='gender')]))
+    res_submission = test_obj.client().post('/actors/bulk',
+                                            data=submission_data,
+                                            content_type='application/json')
+    data = json.loads(res_submission.get_data(as_text=True))
+    test_is_success_response(test_obj, res_submission, data)
+    test_obj.assertEqual(data['created'], 2)
+    test_obj.assertEqual(len(data['ids']), 3)
+    test_obj.assertIsNone(data['ids'][1])
+    test_obj.assertEqual(data['errors'][0]['index'], 1)
+    first_id, second_id = data['ids'][0], data['ids'][2]
+    test_obj.assertGreater(second_id, first_id)
+    res_retrieval = test_obj.client().get(
+        f'/actors?ids={first_id},{second_id}')
+    data = json.loads(res_retrieval.get_data(as_text=True))
+    test_is_success_response(test_obj, res_retrieval, data)
+    test_obj.assertEqual(data['actor_data']['data'][str(first_id)]['name'],
+                         'bulk actor 1')
+    test_obj.assertEqual(data['actor_data']['data'][str(second_id)]['name'],
+                         'bulk actor 2')
+    # ages the database can't store are reported by index rather than
+    # rejecting the whole batch
+    submission_data = json.dumps(dict(actors=[
+        dict(name='bulk aged actor 1', age=True, gender='gender'),
+        dict(name='bulk aged actor 2', age=2 ** 31, gender='gender'),
+        dict(name='bulk aged actor 3', age=50, gender='gender')]))
+    res_submission = test_obj.client().post('/actors/bulk',
+                                            data=submission_data,
+                                            content_type='application/json')
+    data = json.loads(res_submission.get_data(as_text=True))
+    test_is_success_response(test_obj, res_submission, data)
+    test_obj.assertEqual(data['created'], 1)
+    test_obj.assertEqual([error['index'] for error in data['errors']],
+                         [0, 1])
+
+
+def test_add_actors_fail(test_obj):
+    # should fail if there is no data passed at all
+    res_no_data = test_obj.client().post('/actors/bulk')
+    test_error_format(test_obj, res_no_data, 400)
+    # should fail if the actors are not given as a list
+    not_list_data = json.dumps(dict(actors=dict(name='bulk actor 1', age=30,
+                                                gender='gender')))
+    res_not_list = test_obj.client().post('/actors/bulk',
+                                          data=not_list_data,
+                                          content_type='application/json')
+    test_error_format(test_obj, res_not_list, 400)
+    # should fail, creating nothing, if an atomic request has an invalid actor
+    atomic_data = json.dumps(dict(atomic=True, actors=[
+        dict(name='bulk atomic actor', age=30, gender='gender'),
+        dict(name='bulk actor 3', age='50', gender='gender')]))
+    res_atomic = test_obj.client().post('/actors/bulk',
+                                        data=atomic_data,
+                                        content_type='application/json')
+    test_error_format(test_obj, res_atomic, 422)
+    retrieval_data = json.dumps(dict(search_term='bulk atomic actor'))
+    res_retrieval = test_obj.client().post('/actors/search',
+                                           data=retrieval_data,
+                                           content_type='application/json')
+    data = json.loads(res_retrieval.get_data(as_text=True))
+    test_obj.assertEqual(data['actor_data']['count'], 0)
+
+
+# Test importing actors from CSV, checking that valid records are
+# imported and invalid ones are skipped and reported by line
+def test_import_actors(test_obj):
+    import_data = '\n'.join([
+        'name,age,gender',
+        'imported actor 1,thirty,gender',
+        'imported actor 2,30',
+        'imported actor 3,30,gender',
+        '"imported actor, 4",40,gender',
+        'imported actor 5,99999999999,gender',
+        ''])
+    res_import = test_obj.client().post('/actors/import',
+                                        data=import_data,
+                                        content_type='text/csv')
+    data = json.loads(res_import.get_data(as_text=True))
+    test_is_success_response(test_obj, res_import, data)
+    test_obj.assertEqual(data['imported'], 2)
+    test_obj.assertEqual(data['skipped'], 3)
+    test_obj.assertEqual([error['line'] for error in data['errors']],
+                         [2, 3, 6])
+    retrieval_data = json.dumps(dict(search_term='imported actor'))
+    res_retrieval = test_obj.client().post('/actors/search',
+                                           data=retrieval_data,
+                                           content_type='application/json')
+    data = json.loads(res_retrieval.get_data(as_text=True))
+    test_is_success_response(test_obj, res_retrieval, data)
+    test_obj.assertEqual(data['actor_data']['count'], 2)
+
+
+def test_import_actors_fail(test_obj):
+    # should fail if the data is not in a format that can be imported
+    res_bad_format = test_obj.client().post('/actors/import',
+                                            data='{}',
+                                            content_type='application/json')
+    test_error_format(test_obj, res_bad_format, 400)
+    # should fail, importing nothing, if the database rejects a value
+    import_data = '\n'.join([
+        'name,age,gender',
+        'rejected actor,30,gender',
+        'rejected\x00actor,30,gender'])
+    res_rejected = test_obj.client().post('/actors/import',
+                                          data=import_data,
+                                          content_type='text/csv')
+    test_error_format(test_obj, res_rejected, 422)
+    retrieval_data = json.dumps(dict(search_term='rejected actor'))
+    res_retrieval = test_obj.client().post('/actors/search',
+                                           data=retrieval_data,
+                                           content_type='application/json')
+    data = json.loads(res_retrieval.get_data(as_text=True))
+    test_obj.assertEqual(data['actor_data']['count'], 0)
+
+
 # Test adding a actor, editing it, and check that
 # searching back for the edited actor retrieves it
 def test_edit_actor(test_obj):
@@ -159,6 +462,33 @@ def test_edit_actor(test_obj):
     test_obj.assertEqual(len(data['actor_data']['data']), 0)
 
 
+# Test that editing an actor with "Prefer: return=representation"
+# returns the edited actor, tagged to match later reads of it
+def test_edit_actor_representation(test_obj):
+    submission_data = json.dumps(dict(name='represented actor', age=30,
+                                      gender='gender'))
+    res_submission = test_obj.client().post('/actors',
+                                            data=submission_data,
+                                            content_type='application/json')
+    actor_id = json.loads(res_submission.get_data(as_text=True))['id']
+    patch_data = json.dumps(dict(name='represented actor is edited', age=30,
+                                 gender='gender'))
+    res_patch = test_obj.client().patch(
+        f'/actors/{actor_id}', data=patch_data,
+        content_type='application/json',
+        headers={'Prefer': 'return=representation'})
+    data = json.loads(res_patch.get_data(as_text=True))
+    test_is_success_response(test_obj, res_patch, data)
+    test_is_valid_actor(test_obj, data['actor_data'])
+    test_obj.assertEqual(data['actor_data']['id'], actor_id)
+    test_obj.assertEqual(data['actor_data']['name'],
+                         'represented actor is edited')
+    res_unchanged = test_obj.client().get(
+        f'/actors/{actor_id}',
+        headers={'If-None-Match': res_patch.headers['ETag']})
+    test_obj.assertEqual(res_unchanged.status_code, 304)
+
+
 def test_edit_actor_fail(test_obj):
     # should fail if there is no data passed at all
     res_no_data = test_obj.client().patch('/actors/1')
@@ -210,3 +540,48 @@ def test_delete_actor_fail(test_obj):
     # should fail if no item with the given id is present
     res_wrong_type = test_obj.client().delete('/actors/100000')
     test_error_format(test_obj, res_wrong_type, 404)
+
+
+# Test that a full-text search finds actors by the words in their names,
+# regardless of word order, and excludes words marked with "-"
+def test_search_actor_ranked(test_obj):
+    submission_data = json.dumps(dict(search_term='viewing actor',
+                                      mode='fulltext'))
+    res = test_obj.client().post('/actors/search',
+                                 data=submission_data,
+                                 content_type='application/json')
+    data = json.loads(res.get_data(as_text=True))
+    test_is_success_response(test_obj, res, data)
+    test_is_valid_actor_collection(test_obj, data['actor_data'])
+    test_obj.assertEqual(data['actor_data']['data'][0]['name'],
+                         'actor for viewing')
+    test_obj.assertIsNone(data['actor_data']['next_cursor'])
+
+    submission_data = json.dumps(dict(search_term='actor -viewing',
+                                      mode='fulltext'))
+    res_excluded = test_obj.client().post('/actors/search',
+                                          data=submission_data,
+                                          content_type='application/json')
+    data = json.loads(res_excluded.get_data(as_text=True))
+    test_is_success_response(test_obj, res_excluded, data)
+    for item in data['actor_data']['data']:
+        test_obj.assertNotIn('viewing', item['name'])
+
+
+# Test reading an actor with the movies they are cast in embedded
+def test_get_actor_movies(test_obj):
+    res = test_obj.client().get('/actors/1?embed=movies')
+    data = json.loads(res.get_data(as_text=True))
+    test_is_success_response(test_obj, res, data)
+    movies = data['actor_data']['movies']
+    test_obj.assertEqual(movies['total'], 2)
+    test_obj.assertEqual({movie['id'] for movie in movies['data']}, {1, 2})
+    res = test_obj.client().get('/actors?ids=1,2&embed=movies&embed_limit=1')
+    data = json.loads(res.get_data(as_text=True))
+    test_is_success_response(test_obj, res, data)
+    movies = data['actor_data']['data']['1']['movies']
+    test_obj.assertEqual((movies['count'], movies['total']), (1, 2))
+    test_obj.assertEqual(
+        data['actor_data']['data']['2']['movies']['data'][0]['id'], 1)
+    res_bad = test_obj.client().get('/actors/1?embed=cast')
+    test_error_format(test_obj, res_bad, 400)
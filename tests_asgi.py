@@ -0,0 +1,128 @@
+# This file contains code for tests specifically relating to
+# the ASGI entry point. Note that these will still need to be called
+# from the main test handler.
+
+import json
+from starlette.testclient import TestClient
+import asgi
+import auth
+from local_auth import mint_token
+from tests_auth import get_local_key_pair, make_local_key_store
+
+
+# *****************************************
+# ASGI-specific helper functions
+# *****************************************
+
+# Client for an ASGI app using the same database as the Flask app under test
+# Use it in a "with" block, so that every request runs on one event loop
+def asgi_client(test_obj):
+    database_path = test_obj.app.config['SQLALCHEMY_DATABASE_URI']
+    return TestClient(asgi.create_app({'database_path': database_path}))
+
+
+# *****************************************
+# Top-level tests
+# *****************************************
+
+# Test adding, viewing, editing and deleting a movie through the ASGI app,
+# and that it responds exactly as the Flask app does
+def test_asgi_movie(test_obj):
+    with asgi_client(test_obj) as client:
+        res_add = client.post('/movies', json={
+            'name': 'asgi movie', 'release_date': '2022-01-01'})
+        test_obj.assertEqual(res_add.status_code, 200)
+        movie_id = res_add.json()['id']
+
+        res_show = client.get(f'/movies/{movie_id}')
+        flask_res_show = test_obj.client().get(f'/movies/{movie_id}')
+        test_obj.assertEqual(res_show.status_code, 200)
+        test_obj.assertEqual(res_show.content, flask_res_show.get_data())
+        test_obj.assertEqual(res_show.headers['ETag'],
+                             flask_res_show.headers['ETag'])
+        res_unchanged = client.get(
+            f'/movies/{movie_id}',
+            headers={'If-None-Match': res_show.headers['ETag']})
+        test_obj.assertEqual(res_unchanged.status_code, 304)
+
+        res_edit = client.patch(
+            f'/movies/{movie_id}',
+            json={'name': 'asgi movie', 'release_date': '2022-02-02'},
+            headers={'Prefer': 'return=representation'})
+        test_obj.assertEqual(res_edit.status_code, 200)
+        test_obj.assertEqual(res_edit.json()['movie_data']['release_date'],
+                             'Wed, 02 Feb 2022 00:00:00 GMT')
+
+        res_delete = client.delete(f'/movies/{movie_id}')
+        test_obj.assertEqual(res_delete.json(), {'success': True})
+        res_missing = client.get(f'/movies/{movie_id}')
+        flask_res_missing = test_obj.client().get(f'/movies/{movie_id}')
+        test_obj.assertEqual(res_missing.status_code, 404)
+        test_obj.assertEqual(res_missing.content,
+                             flask_res_missing.get_data())
+
+
+# Test searching, batch lookups and bulk creation of actors
+# through the ASGI app, including the error responses
+def test_asgi_actors(test_obj):
+    with asgi_client(test_obj) as client:
+        res_bulk = client.post('/actors/bulk', json={'actors': [
+            {'name': 'asgi actor 1', 'age': 30, 'gender': 'gender'},
+            {'name': 'asgi actor 2', 'age': 'thirty', 'gender': 'gender'},
+            {'name': 'asgi actor 3', 'age': 40, 'gender': 'gender'}
+        ]})
+        bulk_data = res_bulk.json()
+        test_obj.assertEqual(bulk_data['created'], 2)
+        test_obj.assertIsNone(bulk_data['ids'][1])
+
+        search = {'search_term': 'asgi actor', 'limit': 1}
+        res_page = client.post('/actors/search', json=search)
+        flask_res_page = test_obj.client().post(
+            '/actors/search', data=json.dumps(search),
+            content_type='application/json')
+        test_obj.assertEqual(res_page.content, flask_res_page.get_data())
+        page_data = res_page.json()['actor_data']
+        test_obj.assertEqual(page_data['data'][0]['id'], bulk_data['ids'][0])
+        res_next = client.post('/actors/search', json=dict(
+            search, after=page_data['next_cursor']))
+        test_obj.assertEqual(res_next.json()['actor_data']['data'][0]['id'],
+                             bulk_data['ids'][2])
+
+        ids = ','.join(str(id) for id in bulk_data['ids'] if id is not None)
+        res_batch = client.get(f'/actors?ids={ids},100000')
+        test_obj.assertEqual(res_batch.json()['actor_data']['missing'],
+                             [100000])
+
+        # should fail for bodies and parameters the Flask app rejects
+        res_no_term = client.post('/actors/search', json={})
+        test_obj.assertEqual(res_no_term.status_code, 400)
+        test_obj.assertEqual(res_no_term.json()['message'], 'Bad Request')
+        res_bad_limit = client.post('/actors/search', json=dict(
+            search, limit=0))
+        test_obj.assertEqual(res_bad_limit.status_code, 400)
+        res_no_ids = client.get('/actors')
+        test_obj.assertEqual(res_no_ids.status_code, 400)
+
+
+# Test role-based access through the ASGI app using locally minted tokens
+def test_asgi_rbac(test_obj):
+    private_pem, jwks = get_local_key_pair()
+    saved_auth_master, saved_jwks_store = auth.auth_master, auth.jwks_store
+    auth.auth_master = True
+    auth.jwks_store = make_local_key_store(jwks)
+    try:
+        with asgi_client(test_obj) as client:
+            res_no_token = client.get('/movies/1')
+            test_obj.assertEqual(res_no_token.status_code, 401)
+            test_obj.assertEqual(res_no_token.json()['message']['code'],
+                                 'missing_header')
+            token = mint_token(private_pem, ['get:actors'])
+            res_forbidden = client.get(
+                '/movies/1', headers={'Authorization': f'Bearer {token}'})
+            test_obj.assertEqual(res_forbidden.status_code, 403)
+            token = mint_token(private_pem, ['get:movies'])
+            res_allowed = client.get(
+                '/movies/1', headers={'Authorization': f'Bearer {token}'})
+            test_obj.assertEqual(res_allowed.status_code, 200)
+    finally:
+        auth.auth_master, auth.jwks_store = saved_auth_master, saved_jwks_store
@@ -0,0 +1,261 @@
+# This file contains code for tests specifically relating to
+# the authentication helpers. Note that these will still need to be called
+# from the main test handler.
+
+import json
+import os
+import tempfile
+import threading
+import auth
+from auth import AuthError, JWKSKeyStore, LocalJWKSFile, VerifiedTokenCache, \
+    parse_local_jwks, verify_decode_jwt
+from local_auth import generate_key_pair, mint_token
+
+
+# *****************************************
+# Auth-specific helper functions
+# *****************************************
+
+# A clock that only moves when told to, so expiry can be tested directly
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+# A stand-in for the Auth0 JWKS endpoint that counts how often it is called
+# and can be made to fail
+class FakeJWKSSource:
+    def __init__(self, kids):
+        self.kids = kids
+        self.calls = 0
+        self.failing = False
+
+    def __call__(self):
+        self.calls += 1
+        if self.failing:
+            raise OSError('Auth0 is unreachable')
+        return {'keys': [{
+            'kty': 'RSA',
+            'kid': kid,
+            'use': 'sig',
+            'n': 'modulus',
+            'e': 'AQAB'
+        } for kid in self.kids]}
+
+
+def make_key_store(source, clock):
+    return JWKSKeyStore(source, ttl=600, min_refetch_interval=30,
+                        background=False, clock=clock)
+
+
+# Generating keys is slow, so the same local key pair is shared by all tests
+local_key_pair = None
+
+
+def get_local_key_pair():
+    global local_key_pair
+    if local_key_pair is None:
+        local_key_pair = generate_key_pair(bits=1024)
+    return local_key_pair
+
+
+def make_local_key_store(jwks):
+    return JWKSKeyStore(lambda: jwks, ttl=float('inf'), background=False)
+
+
+# Test that verifying a token raises an AuthError with the given code
+def test_auth_error(test_obj, token, key_store, code, status_code):
+    with test_obj.assertRaises(AuthError) as context:
+        verify_decode_jwt(token, key_store)
+    test_obj.assertEqual(context.exception.error['code'], code)
+    test_obj.assertEqual(context.exception.status_code, status_code)
+
+
+# *****************************************
+# Top-level tests
+# *****************************************
+
+# Test that keys are only fetched once while they remain fresh,
+# and are fetched again once the TTL has passed
+def test_jwks_store_caches_keys(test_obj):
+    source = FakeJWKSSource(['key-1'])
+    clock = FakeClock()
+    store = make_key_store(source, clock)
+    test_obj.assertEqual(store.get_key('key-1')['kid'], 'key-1')
+    test_obj.assertEqual(store.get_key('key-1')['kid'], 'key-1')
+    test_obj.assertEqual(source.calls, 1)
+    clock.advance(600)
+    test_obj.assertEqual(store.get_key('key-1')['kid'], 'key-1')
+    test_obj.assertEqual(source.calls, 2)
+
+
+# Test that unknown key ids trigger a refetch, but no more than once
+# per refetch interval, and that rotated keys are then picked up
+def test_jwks_store_unknown_kid(test_obj):
+    source = FakeJWKSSource(['key-1'])
+    clock = FakeClock()
+    store = make_key_store(source, clock)
+    test_obj.assertIsNone(store.get_key('bogus'))
+    test_obj.assertEqual(source.calls, 2)
+    clock.advance(1)
+    test_obj.assertIsNone(store.get_key('bogus'))
+    test_obj.assertIsNone(store.get_key('other-bogus'))
+    test_obj.assertEqual(source.calls, 2)
+    source.kids = ['key-1', 'key-2']
+    clock.advance(30)
+    test_obj.assertEqual(store.get_key('key-2')['kid'], 'key-2')
+    test_obj.assertEqual(source.calls, 3)
+
+
+# Test that when fetching the keys fails after they have been loaded, the
+# old keys are kept and requests only retry once per refetch interval,
+# or not at all while a refresher is running, and that there is a 503
+# error while there are no keys at all
+def test_jwks_store_fetch_failure(test_obj):
+    source = FakeJWKSSource(['key-1'])
+    clock = FakeClock()
+    store = make_key_store(source, clock)
+    store.get_key('key-1')
+    source.failing = True
+    clock.advance(600)
+    test_obj.assertEqual(store.get_key('key-1')['kid'], 'key-1')
+    test_obj.assertEqual(store.get_key('key-1')['kid'], 'key-1')
+    test_obj.assertIsNone(store.get_key('bogus'))
+    test_obj.assertEqual(source.calls, 2)
+    clock.advance(30)
+    test_obj.assertEqual(store.get_key('key-1')['kid'], 'key-1')
+    test_obj.assertEqual(source.calls, 3)
+
+    # as if this process's refresher were running
+    store.background = True
+    store._refresher_pid = os.getpid()
+    clock.advance(30)
+    test_obj.assertEqual(store.get_key('key-1')['kid'], 'key-1')
+    test_obj.assertEqual(source.calls, 3)
+
+    store = make_key_store(source, clock)
+    for _ in range(2):
+        with test_obj.assertRaises(AuthError) as context:
+            store.get_key('key-1')
+        test_obj.assertEqual(context.exception.status_code, 503)
+    test_obj.assertEqual(source.calls, 4)
+    source.failing = False
+    clock.advance(30)
+    test_obj.assertEqual(store.get_key('key-1')['kid'], 'key-1')
+
+
+# Test that requests starting at the same time only start one refresher
+def test_jwks_store_one_refresher(test_obj):
+    store = JWKSKeyStore(FakeJWKSSource(['key-1']), refresh_interval=3600)
+
+    def refreshers():
+        return [thread for thread in threading.enumerate()
+                if thread.name == 'jwks-refresher']
+
+    started = len(refreshers())
+    threads = [threading.Thread(target=store.get_key, args=('key-1',))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    test_obj.assertEqual(len(refreshers()), started + 1)
+    # stop the refresher after its sleep
+    store._refresher_pid = None
+
+
+# Test that verified payloads are returned until the token expires,
+# with their permissions ready for checking
+def test_token_cache_expiry(test_obj):
+    clock = FakeClock()
+    cache = VerifiedTokenCache(max_size=10, clock=clock)
+    payload = {'exp': 1010, 'permissions': ['get:movies']}
+    test_obj.assertIsNone(cache.get('token'))
+    stored = cache.put('token', payload)
+    test_obj.assertEqual(stored['permissions'], frozenset(['get:movies']))
+    test_obj.assertIs(cache.get('token'), stored)
+    clock.advance(10.9)
+    test_obj.assertIs(cache.get('token'), stored)
+    clock.advance(0.1)
+    test_obj.assertIsNone(cache.get('token'))
+    # tokens without an expiry are never cached
+    cache.put('no-exp', {'permissions': []})
+    test_obj.assertIsNone(cache.get('no-exp'))
+
+
+# Test that the least recently used token is evicted when the cache is full
+def test_token_cache_eviction(test_obj):
+    cache = VerifiedTokenCache(max_size=2, clock=FakeClock())
+    cache.put('token-1', {'exp': 2000})
+    cache.put('token-2', {'exp': 2000})
+    cache.get('token-1')
+    cache.put('token-3', {'exp': 2000})
+    test_obj.assertIsNotNone(cache.get('token-1'))
+    test_obj.assertIsNone(cache.get('token-2'))
+    test_obj.assertIsNotNone(cache.get('token-3'))
+
+
+# Test verifying tokens against a locally generated key pair
+def test_local_key_verification(test_obj):
+    private_pem, jwks = get_local_key_pair()
+    key_store = make_local_key_store(parse_local_jwks(json.dumps(jwks)))
+    token = mint_token(private_pem, ['get:movies'])
+    payload = verify_decode_jwt(token, key_store)
+    test_obj.assertEqual(payload['permissions'], ['get:movies'])
+    # should fail if the token has expired
+    expired_token = mint_token(private_pem, ['get:movies'], expires_in=-60)
+    test_auth_error(test_obj, expired_token, key_store, 'token_expired', 401)
+    # should fail if the token was signed with a key the store doesn't have
+    wrong_kid_token = mint_token(private_pem, ['get:movies'], kid='other')
+    test_auth_error(test_obj, wrong_kid_token, key_store,
+                    'invalid_header', 400)
+
+
+# Test that a pinned key file is picked up again when it changes
+def test_local_key_file_reload(test_obj):
+    private_pem, jwks = get_local_key_pair()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'jwks.json')
+        with open(path, 'w') as jwks_file:
+            json.dump({'keys': []}, jwks_file)
+        key_store = JWKSKeyStore(LocalJWKSFile(path), ttl=float('inf'),
+                                 min_refetch_interval=0, background=False)
+        test_obj.assertIsNone(key_store.get_key('local'))
+        with open(path, 'w') as jwks_file:
+            json.dump(jwks, jwks_file)
+        # make sure the modification time differs on coarse filesystems
+        os.utime(path, ns=(0, 0))
+        key_store.refresh()
+        token = mint_token(private_pem, ['get:movies'])
+        payload = verify_decode_jwt(token, key_store)
+        test_obj.assertEqual(payload['permissions'], ['get:movies'])
+
+
+# Test role-based access to an endpoint using locally minted tokens
+def test_rbac_local_keys(test_obj):
+    private_pem, jwks = get_local_key_pair()
+    saved_auth_master, saved_jwks_store = auth.auth_master, auth.jwks_store
+    auth.auth_master = True
+    auth.jwks_store = make_local_key_store(jwks)
+    try:
+        # should fail if no token is given
+        res_no_token = test_obj.client().get('/movies/1')
+        test_obj.assertEqual(res_no_token.status_code, 401)
+        # should fail if the token lacks the required permission
+        token = mint_token(private_pem, ['get:actors'])
+        res_forbidden = test_obj.client().get(
+            '/movies/1', headers={'Authorization': f'Bearer {token}'})
+        test_obj.assertEqual(res_forbidden.status_code, 403)
+        # should succeed with the required permission
+        token = mint_token(private_pem, ['get:movies'])
+        res_allowed = test_obj.client().get(
+            '/movies/1', headers={'Authorization': f'Bearer {token}'})
+        test_obj.assertEqual(res_allowed.status_code, 200)
+    finally:
+        auth.auth_master, auth.jwks_store = saved_auth_master, saved_jwks_store
@@ -0,0 +1,117 @@
+# This file contains code for tests specifically relating to
+# the benchmarks. Note that these will still need to be called
+# from the main test handler.
+
+import auth
+import benchmark
+import benchmark_auth
+from benchmark import Benchmark, compare, load_scenarios, parse_weights
+from tests_auth import get_local_key_pair
+
+
+# *****************************************
+# Benchmark-specific helper functions
+# *****************************************
+
+# Sends the benchmark's requests to the app under test
+class TestAppClient:
+    def __init__(self, test_obj):
+        self.client = test_obj.client()
+
+    def request(self, method, path, body=None, headers=None):
+        res = self.client.open(path, method=method, data=body,
+                               headers=headers)
+        return res.status_code, res.get_data()
+
+    def close(self):
+        pass
+
+
+# *****************************************
+# Top-level tests
+# *****************************************
+
+# Test that the requests of both collections are read, by role
+def test_benchmark_scenarios(test_obj):
+    roles = list(benchmark.ROLE_FOLDERS)
+    for path in ('udacity-fsnd-capstone-local.postman_collection.json',
+                 'udacity-fsnd-capstone-remote.postman_collection.json'):
+        scenarios = load_scenarios(path, roles)
+        test_obj.assertEqual(len(scenarios), 40)
+        by_role = {(s.role, s.method, s.path): s for s in scenarios}
+        show = by_role[('Executive Producer', 'GET', '/movies/1')]
+        test_obj.assertEqual(show.endpoint,
+                             'Executive Producer: GET /movies/<id>')
+        # refused requests are reported apart from allowed ones
+        test_obj.assertNotEqual(
+            by_role[('Public', 'GET', '/movies/1')].endpoint, show.endpoint)
+        test_obj.assertEqual(show.expected_status, 200)
+        delete = by_role[('Executive Producer', 'DELETE', '/movies/3')]
+        test_obj.assertTrue(delete.deletes_created)
+        test_obj.assertEqual(
+            by_role[('Casting Director', 'POST', '/movies')].expected_status,
+            403)
+        test_obj.assertEqual(
+            by_role[('Public', 'POST', '/actors/search')].expected_status,
+            401)
+
+    scenarios = load_scenarios(
+        'udacity-fsnd-capstone-local.postman_collection.json',
+        ['Casting Assistant'], parse_weights('get=0,search=5'))
+    test_obj.assertEqual({s.name.split('-')[0] for s in scenarios},
+                         {'search', 'post', 'patch', 'delete'})
+    test_obj.assertEqual(scenarios[0].weight, 5)
+
+
+# Test a short run against the app under test, and comparing its
+# results with a baseline
+def test_benchmark_run(test_obj):
+    scenarios = load_scenarios(
+        'udacity-fsnd-capstone-local.postman_collection.json',
+        ['Executive Producer'])
+    run = Benchmark(scenarios, lambda: TestAppClient(test_obj),
+                    concurrency=2, seed=1)
+    results = run.run(duration=0.5)
+    # remove the records the run created and didn't delete, which other
+    # tests (such as paged searches) would otherwise find
+    client = test_obj.client()
+    for path, ids in run.created.items():
+        for id in ids:
+            client.delete(f'{path}/{id}')
+    total = results['total']
+    test_obj.assertGreater(total['requests'], 0)
+    # deletions use records created by the benchmark, so all succeed
+    test_obj.assertEqual(total['errors'], 0)
+    test_obj.assertLessEqual(total['p50_ms'], total['p95_ms'])
+    test_obj.assertLessEqual(total['p95_ms'], total['p99_ms'])
+    test_obj.assertEqual(sum(summary['requests'] for summary
+                             in results['endpoints'].values()),
+                         total['requests'])
+
+    endpoint = next(iter(results['endpoints']))
+    slower = {'endpoints': {endpoint: dict(
+        results['endpoints'][endpoint],
+        p95_ms=results['endpoints'][endpoint]['p95_ms'] * 2)}}
+    changes, regressions = compare(results, slower, max_regression=50)
+    test_obj.assertAlmostEqual(changes[endpoint]['p95_ms'], 100)
+    test_obj.assertEqual(regressions, [endpoint])
+    changes, regressions = compare(slower, results, max_regression=50)
+    test_obj.assertEqual(regressions, [])
+
+
+# Test that every auth microbenchmark behaves as its name says, and
+# that auth's own settings are left as they were
+def test_auth_benchmarks(test_obj):
+    saved_auth_master, saved_jwks_store = auth.auth_master, auth.jwks_store
+    private_pem, jwks = get_local_key_pair()
+    results = benchmark_auth.run(private_pem, jwks, repeat=1, number=10)
+    test_obj.assertEqual(len(results), 17)
+    test_obj.assertTrue(all(time > 0 for time in results.values()))
+    test_obj.assertLess(results['decorator: warm'],
+                        results['decorator: cold'])
+    test_obj.assertEqual(auth.auth_master, saved_auth_master)
+    test_obj.assertIs(auth.jwks_store, saved_jwks_store)
+    results = benchmark_auth.run(private_pem, jwks, 'header', repeat=1,
+                                 number=10)
+    test_obj.assertEqual(set(results), {
+        'header: valid', 'header: missing', 'header: malformed'})
@@ -0,0 +1,62 @@
+# This file contains code for tests specifically relating to
+# the record cache. Note that these will still need to be called
+# from the main test handler.
+
+import threading
+from cache import CacheBackend, EntityCache, LocalLRUBackend, \
+    LocalSharedBackend
+from tests_auth import FakeClock
+
+
+# *****************************************
+# Top-level tests
+# *****************************************
+
+# Test that both local backends expire entries after their TTL and evict
+# the least recently used entry when full, and that the shared stand-in
+# hands back copies of what was stored. Also test that a backend lacking
+# an operation can't be created, and that the hits and misses of lookups
+# made by several threads at once are all counted
+def test_cache_backends(test_obj):
+    for backend_class in (LocalLRUBackend, LocalSharedBackend):
+        clock = FakeClock()
+        backend = backend_class(max_size=2, clock=clock)
+        value = {'id': 1, 'name': 'cached'}
+        backend.set('movies:1', value, 10)
+        test_obj.assertEqual(backend.get('movies:1'), value)
+        clock.advance(10)
+        test_obj.assertIsNone(backend.get('movies:1'))
+
+        backend.set('movies:1', value, 10)
+        backend.set('movies:2', value, 10)
+        backend.get('movies:1')
+        backend.set('movies:3', value, 10)
+        test_obj.assertIsNone(backend.get('movies:2'))
+        test_obj.assertEqual(backend.get('movies:1'), value)
+        backend.delete('movies:1')
+        test_obj.assertIsNone(backend.get('movies:1'))
+
+    backend = LocalSharedBackend()
+    backend.set('movies:1', value, 10)
+    test_obj.assertIsNot(backend.get('movies:1'), value)
+
+    class IncompleteBackend(CacheBackend):
+        def get(self, key):
+            return None
+
+    with test_obj.assertRaises(TypeError):
+        IncompleteBackend()
+
+    cache = EntityCache(LocalLRUBackend())
+    cache.set('movies', 1, value)
+
+    def look_up():
+        for id in range(1000):
+            cache.get('movies', id % 2)
+
+    threads = [threading.Thread(target=look_up) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    test_obj.assertEqual(cache.stats(), {'hits': 4000, 'misses': 4000})
@@ -0,0 +1,124 @@
+# This file contains code for tests specifically relating to
+# response compression. Note that these will still need to be called
+# from the main test handler.
+
+import gzip
+import json
+from flask import request
+from compress import COMPRESS_MIN_SIZE, brotli, compressed_cache, \
+    encodings, zstd
+
+
+# *****************************************
+# Compression-specific helper functions
+# *****************************************
+
+def decompress(encoding, data):
+    if encoding == 'br':
+        return brotli.decompress(data)
+    if encoding == 'zstd':
+        return zstd.decompress(data)
+    return gzip.decompress(data)
+
+
+# Search for the given term with the given Accept-Encoding header
+def search_movies(test_obj, search_term, accept_encoding=None):
+    headers = {}
+    if accept_encoding is not None:
+        headers['Accept-Encoding'] = accept_encoding
+    return test_obj.client().post(
+        '/movies/search', data=json.dumps(dict(search_term=search_term)),
+        content_type='application/json', headers=headers)
+
+
+# *****************************************
+# Top-level tests
+# *****************************************
+
+# Test that large responses are compressed with the client's preferred
+# encoding, that compressed responses with an ETag are reused, and that
+# small responses are sent as they are
+def test_compress_responses(test_obj):
+    records = [dict(name=f'compressed movie {number:04d}',
+                    release_date='2022-01-01') for number in range(40)]
+    test_obj.client().post('/movies/bulk',
+                           data=json.dumps(dict(movies=records)),
+                           content_type='application/json')
+    res_plain = search_movies(test_obj, 'compressed movie')
+    test_obj.assertNotIn('Content-Encoding', res_plain.headers)
+    test_obj.assertGreaterEqual(len(res_plain.get_data()), COMPRESS_MIN_SIZE)
+    etag = res_plain.headers['ETag']
+
+    for encoding in encodings:
+        res = search_movies(test_obj, 'compressed movie',
+                            f'{encoding}, *;q=0.5')
+        test_obj.assertEqual(res.headers['Content-Encoding'], encoding)
+        test_obj.assertIn('Accept-Encoding', res.headers['Vary'])
+        # compressed bodies have a strong tag of their own
+        test_obj.assertEqual(res.headers['ETag'],
+                             f'{etag[:-1]}-{encoding}"')
+        test_obj.assertEqual(decompress(encoding, res.get_data()),
+                             res_plain.get_data())
+        # should be taken from the cache the second time
+        hits = compressed_cache.hits
+        res_again = search_movies(test_obj, 'compressed movie', encoding)
+        test_obj.assertEqual(res_again.get_data(), res.get_data())
+        test_obj.assertEqual(compressed_cache.hits, hits + 1)
+        # should recognise the tag of the compressed body, and of the
+        # uncompressed one, whatever the encoding asked for now
+        res_unchanged = test_obj.client().post(
+            '/movies/search', content_type='application/json',
+            data=json.dumps(dict(search_term='compressed movie')),
+            headers={'Accept-Encoding': encoding,
+                     'If-None-Match': res.headers['ETag']})
+        test_obj.assertEqual(res_unchanged.status_code, 304)
+        test_obj.assertEqual(res_unchanged.headers['ETag'],
+                             res.headers['ETag'])
+        res_unchanged = test_obj.client().post(
+            '/movies/search', content_type='application/json',
+            data=json.dumps(dict(search_term='compressed movie')),
+            headers={'Accept-Encoding': 'identity',
+                     'If-None-Match': f'"other", {res.headers["ETag"]}'})
+        test_obj.assertEqual(res_unchanged.status_code, 304)
+
+    # should not compress if the client doesn't accept any encoding offered
+    res_identity = search_movies(test_obj, 'compressed movie', 'identity')
+    test_obj.assertNotIn('Content-Encoding', res_identity.headers)
+    # should not compress small responses
+    res_small = search_movies(test_obj, 'compressed movie 0001', 'gzip')
+    test_obj.assertNotIn('Content-Encoding', res_small.headers)
+    # and should leave their tags strong
+    test_obj.assertFalse(res_small.headers['ETag'].startswith('W/'))
+    test_obj.assertEqual(
+        res_small.headers['ETag'],
+        search_movies(test_obj, 'compressed movie 0001').headers['ETag'])
+
+
+# Test that compressed bodies are remembered by the whole URL, so that
+# a route whose tag ignores a query parameter isn't sent another's body
+def test_compress_cache_query_string(test_obj):
+    @test_obj.app.route('/compress-test')
+    def compress_test():
+        response = test_obj.app.response_class(
+            request.args['word'] * COMPRESS_MIN_SIZE,
+            mimetype='text/plain')
+        response.set_etag('same for every word')
+        return response
+    for word in ('a', 'b'):
+        res = test_obj.client().get(f'/compress-test?word={word}',
+                                    headers={'Accept-Encoding': 'gzip'})
+        test_obj.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        test_obj.assertEqual(gzip.decompress(res.get_data()),
+                             word.encode('ascii') * COMPRESS_MIN_SIZE)
+
+
+# Test that streamed exports are compressed with every encoding offered
+def test_compress_export(test_obj):
+    res_plain = test_obj.client().get('/movies/export')
+    for encoding in encodings:
+        res = test_obj.client().get('/movies/export',
+                                    headers={'Accept-Encoding': encoding})
+        test_obj.assertEqual(res.headers['Content-Encoding'], encoding)
+        test_obj.assertNotIn('Content-Length', res.headers)
+        test_obj.assertEqual(decompress(encoding, res.get_data()),
+                             res_plain.get_data())
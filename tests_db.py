@@ -0,0 +1,250 @@
+# This file contains code for tests specifically relating to
+# the database connection. Note that these will still need to be called
+# from the main test handler.
+
+import json
+import random
+import tempfile
+from sqlalchemy import false, select, text, update
+from sqlalchemy.exc import DBAPIError
+from app import create_app
+from cache import entity_cache
+from datagen import engine_dsn, generate_table, movie_rows, restore, \
+    secondary_indexes, snapshot
+from models import DB_PGBOUNCER, DB_POOL_SIZE, db, engine_options, \
+    pool_stats, Movie
+from metrics import query_observers
+from profiler import SQLProfiler, record_query, setup_profiler
+from replicas import replica_router
+
+
+# *****************************************
+# Database-specific helper functions
+# *****************************************
+
+# A replica URL that can never be connected to
+UNREACHABLE_REPLICA = 'postgresql://postgres@127.0.0.1:1/capstone_test_db'
+
+
+# *****************************************
+# Top-level tests
+# *****************************************
+
+# Test that requests check connections out of the one shared pool
+# and return them afterwards
+def test_pool_stats(test_obj):
+    with test_obj.app.app_context():
+        before = pool_stats()
+    test_obj.client().get('/movies/100000')
+    with test_obj.app.app_context():
+        after = pool_stats()
+    test_obj.assertGreater(after['checkouts'], before['checkouts'])
+    test_obj.assertEqual(after['checkouts'] - before['checkouts'],
+                         after['checkins'] - before['checkins'])
+    test_obj.assertGreaterEqual(after['wait_seconds_total'], 0)
+    # without PgBouncer, connections are kept in a pool of the chosen size
+    if not DB_PGBOUNCER:
+        test_obj.assertEqual(after['size'], DB_POOL_SIZE)
+        test_obj.assertEqual(after['checked_out'], 0)
+
+
+# Test that get:* routes read from healthy replicas, skipping unreachable
+# ones, while other routes only use the primary
+# The test database stands in for a replica of itself
+def test_replica_routing(test_obj):
+    with test_obj.app.app_context():
+        primary_url = str(db.engine.url)
+    replica_router.configure([primary_url, UNREACHABLE_REPLICA],
+                             engine_options(primary=False))
+    try:
+        for _ in range(3):
+            res = test_obj.client().get('/movies/100000')
+            test_obj.assertEqual(res.status_code, 404)
+        replica, unreachable = replica_router.stats()['replicas']
+        test_obj.assertEqual(replica['selected'], 3)
+        test_obj.assertTrue(replica['healthy'])
+        test_obj.assertEqual(unreachable['selected'], 0)
+        test_obj.assertFalse(unreachable['healthy'])
+        # the replica's connections aren't counted as the primary's
+        with test_obj.app.app_context():
+            before = pool_stats()
+        test_obj.client().get('/movies/100000')
+        with test_obj.app.app_context():
+            after = pool_stats()
+        test_obj.assertEqual(after['checkouts'], before['checkouts'])
+        test_obj.assertEqual(after['wait_seconds_total'],
+                             before['wait_seconds_total'])
+        replica = replica_router.stats()['replicas'][0]
+        # writes go to the primary
+        res = test_obj.client().delete('/movies/100000')
+        test_obj.assertEqual(res.status_code, 404)
+        test_obj.assertEqual(replica_router.stats()['replicas'][0],
+                             replica)
+    finally:
+        replica_router.configure([])
+
+
+# Test that a read-only request uses the primary once it has written,
+# and the primary is used when there is no healthy replica
+def test_replica_read_your_writes(test_obj):
+    replica_router.configure([UNREACHABLE_REPLICA],
+                             engine_options(primary=False))
+    try:
+        with test_obj.app.test_request_context('/movies/1'):
+            test_obj.app.preprocess_request()
+            test_obj.assertIs(db.session.get_bind(), db.engine)
+            test_obj.assertEqual(replica_router.stats()['fallbacks'], 1)
+            db.session.remove()
+        with test_obj.app.app_context():
+            primary_url = str(db.engine.url)
+        replica_router.configure([primary_url],
+                                 engine_options(primary=False))
+        with test_obj.app.test_request_context('/movies/1'):
+            test_obj.app.preprocess_request()
+            replica_engine = db.session.get_bind()
+            test_obj.assertIsNot(replica_engine, db.engine)
+            db.session.execute(update(Movie.__table__).where(false()).
+                               values(name='unchanged'))
+            test_obj.assertIs(db.session.get_bind(), db.engine)
+            db.session.rollback()
+            db.session.remove()
+    finally:
+        replica_router.configure([])
+
+
+# Test that a record read from a replica that hasn't caught up with an
+# edit isn't cached, so the edit is seen as soon as the primary is read
+# The lagging replica is the test database, reading from a schema with
+# a copy of the movie taken before the edit
+def test_replica_not_cached(test_obj):
+    with test_obj.app.app_context():
+        primary_url = str(db.engine.url)
+        movie = Movie(name='replica movie', release_date='2022-01-01')
+        db.session.add(movie)
+        db.session.commit()
+        movie_id = movie.id
+        db.session.execute(text('CREATE SCHEMA lagging'))
+        db.session.execute(
+            text('CREATE TABLE lagging.movies AS SELECT id, name, '
+                 'release_date, version FROM movies WHERE id = :id'),
+            {'id': movie_id})
+        db.session.commit()
+        db.session.remove()
+    try:
+        patch_data = json.dumps(dict(name='replica movie is edited',
+                                     release_date='2022-01-01'))
+        test_obj.client().patch(f'/movies/{movie_id}', data=patch_data,
+                                content_type='application/json')
+        replica_router.configure([primary_url], dict(
+            engine_options(primary=False),
+            execution_options={'schema_translate_map': {None: 'lagging'}}))
+        res = test_obj.client().get(f'/movies/{movie_id}')
+        data = json.loads(res.get_data(as_text=True))
+        test_obj.assertEqual(data['movie_data']['name'], 'replica movie')
+        test_obj.assertIsNone(entity_cache.get('movies', movie_id))
+        replica_router.configure([])
+        res = test_obj.client().get(f'/movies/{movie_id}')
+        data = json.loads(res.get_data(as_text=True))
+        test_obj.assertEqual(data['movie_data']['name'],
+                             'replica movie is edited')
+    finally:
+        replica_router.configure([])
+        with test_obj.app.app_context():
+            db.session.execute(text('DROP SCHEMA lagging CASCADE'))
+            db.session.commit()
+            db.session.remove()
+        test_obj.client().delete(f'/movies/{movie_id}')
+
+
+# Test that profiled requests report their queries, log slow ones with
+# their plans, and log queries repeated within a request
+def test_sql_profiler(test_obj):
+    database_path = test_obj.app.config['SQLALCHEMY_DATABASE_URI']
+    app = create_app({'database_path': database_path})
+    profiler = SQLProfiler(slow_query_ms=0, explain_sample_rate=1)
+    setup_profiler(app, profiler)
+    with test_obj.assertLogs('profiler', 'WARNING') as logs:
+        res = app.test_client().post(
+            '/movies/search', data=json.dumps({'search_term': 'movie'}),
+            content_type='application/json')
+    test_obj.assertEqual(res.status_code, 200)
+    test_obj.assertRegex(res.headers['Server-Timing'],
+                         r'^db;dur=[0-9.]+;desc="[0-9]+ quer(y|ies)"$')
+    output = '\n'.join(logs.output)
+    test_obj.assertIn('Slow query', output)
+    test_obj.assertIn('POST /movies/search (search_movies)', output)
+    test_obj.assertIn('actual time', output)
+
+    with app.test_request_context('/movies/1'):
+        app.preprocess_request()
+        with test_obj.assertLogs('profiler', 'WARNING') as logs:
+            for _ in range(2):
+                db.session.execute(
+                    select(Movie.id).where(Movie.id == 1)).all()
+            profiler.log_repeated(None)
+        test_obj.assertIn('Query repeated 2 times in GET /movies/1',
+                          logs.output[-1])
+        db.session.remove()
+
+    # requests to apps that aren't profiled are left alone
+    res = test_obj.client().post(
+        '/movies/search', data=json.dumps({'search_term': 'movie'}),
+        content_type='application/json')
+    test_obj.assertNotIn('Server-Timing', res.headers)
+
+    # statements are timed once, by the timer the metrics use, and
+    # failing statements leave nothing behind on their connection
+    setup_profiler(app, profiler)
+    test_obj.assertEqual(query_observers.count(record_query), 1)
+    with test_obj.app.app_context():
+        with db.engine.connect() as connection:
+            with test_obj.assertRaises(DBAPIError):
+                connection.execute(text('SELECT 1 / 0'))
+            test_obj.assertEqual(
+                [key for key, value in connection.info.items()
+                 if isinstance(value, list)], [])
+
+
+# Test that generated rows depend only on the seed and chunk, and that
+# a snapshot taken before generating them restores the tables
+def test_generate_data(test_obj):
+    def rows(seed, chunk):
+        rng = random.Random(f'{seed}:movies:{chunk}')
+        return list(movie_rows(rng, 1, 5, 2022))
+    test_obj.assertEqual(rows(0, 0), rows(0, 0))
+    test_obj.assertNotEqual(rows(0, 0), rows(0, 1))
+    test_obj.assertNotEqual(rows(0, 0), rows(1, 0))
+
+    with test_obj.app.app_context():
+        db.session.remove()
+        dsn = engine_dsn(db.engine)
+
+        def count():
+            return db.session.query(Movie).count()
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot(dsn, db.metadata.sorted_tables, directory)
+            before = count()
+            db.session.remove()
+            with db.engine.connect() as connection:
+                cursor = connection.connection.cursor()
+                indexes = secondary_indexes(cursor, 'movies')
+                cursor.close()
+            test_obj.assertEqual(
+                generate_table(dsn, 'movies', 25, seed=1, chunk_rows=10,
+                               workers=2, last_year=2022), 25)
+            test_obj.assertEqual(count(), before + 25)
+            last_id = db.session.query(db.func.max(Movie.id)).scalar()
+            generated = db.session.get(Movie, last_id)
+            # the last of the three chunks holds the last five rows
+            test_obj.assertEqual(
+                generated.name, rows(1, 2)[-1].split('\t')[1])
+            db.session.remove()
+            with db.engine.connect() as connection:
+                cursor = connection.connection.cursor()
+                test_obj.assertEqual(
+                    secondary_indexes(cursor, 'movies'), indexes)
+                cursor.close()
+
+            restore(dsn, directory)
+            test_obj.assertEqual(count(), before)
+        db.session.remove()
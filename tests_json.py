@@ -0,0 +1,45 @@
+# This file contains code for tests specifically relating to
+# the encoding of JSON responses. Note that these will still need to be
+# called from the main test handler.
+
+import datetime
+from flask import json
+from json_provider import JSONProvider, OrjsonJSONProvider, \
+    StdlibJSONProvider, orjson
+
+
+# *****************************************
+# Top-level tests
+# *****************************************
+
+# Test that every available provider encodes responses exactly as Flask's
+# own jsonify would, and writes dates in ISO format when asked to, and
+# that a provider that can't encode can't be created
+def test_json_providers(test_obj):
+    data = {
+        'success': True,
+        'movie_data': {
+            'count': 2,
+            'data': [{'id': 1, 'name': 'first',
+                      'release_date': datetime.datetime(2022, 1, 1)},
+                     {'id': 2, 'name': 'second', 'release_date': None},
+                     {'id': 3, 'name': 'third',
+                      'release_date': datetime.date(1999, 12, 31)}],
+            'next_cursor': None
+        }
+    }
+    with test_obj.app.app_context():
+        expected = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    provider_classes = [StdlibJSONProvider]
+    if orjson is not None:
+        provider_classes.append(OrjsonJSONProvider)
+    for provider_class in provider_classes:
+        test_obj.assertEqual(provider_class().dumps(data), expected)
+        iso_data = provider_class(dates='iso').dumps(data)
+        test_obj.assertIn(b'"release_date":"2022-01-01T00:00:00"', iso_data)
+
+    class IncompleteProvider(JSONProvider):
+        pass
+
+    with test_obj.assertRaises(TypeError):
+        IncompleteProvider()
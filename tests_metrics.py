@@ -0,0 +1,169 @@
+# This file contains code for tests specifically relating to
+# request metrics. Note that these will still need to be called
+# from the main test handler.
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import metrics
+from metrics import MetricsRegistry, format_labels
+
+
+# *****************************************
+# Metrics-specific helper functions
+# *****************************************
+
+# Read the samples of /metrics into a dict of values by name and labels
+def get_metrics(test_obj):
+    res = test_obj.client().get('/metrics')
+    test_obj.assertEqual(res.status_code, 200)
+    test_obj.assertTrue(res.content_type.startswith('text/plain'))
+    samples = {}
+    for line in res.get_data(as_text=True).splitlines():
+        if line.startswith('#'):
+            continue
+        sample, value = line.rsplit(' ', 1)
+        samples[sample] = float(value)
+    return samples
+
+
+# ID of a process that has exited
+def exited_pid():
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return process.pid
+
+
+# *****************************************
+# Top-level tests
+# *****************************************
+
+# Test that requests are counted and timed by endpoint
+def test_metrics_endpoint(test_obj):
+    labels = format_labels(endpoint='show_movie', method='GET')
+    before = get_metrics(test_obj)
+    test_obj.client().get('/movies/1')
+    test_obj.client().get('/movies/100000')
+    test_obj.client().get('/no-such-route')
+    after = get_metrics(test_obj)
+
+    def added(sample):
+        return after.get(sample, 0) - before.get(sample, 0)
+
+    test_obj.assertEqual(added('capstone_http_requests_total{%s}' % (
+        format_labels(endpoint='show_movie', method='GET', status=200))), 1)
+    test_obj.assertEqual(added('capstone_http_requests_total{%s}' % (
+        format_labels(endpoint='show_movie', method='GET', status=404))), 1)
+    test_obj.assertEqual(added('capstone_http_requests_total{%s}' % (
+        format_labels(endpoint='none', method='GET', status=404))), 1)
+    test_obj.assertEqual(added(
+        'capstone_http_request_duration_seconds_count{%s}' % labels), 2)
+    test_obj.assertEqual(added(
+        'capstone_http_request_duration_seconds_bucket{%s,le="+Inf"}'
+        % labels), 2)
+    test_obj.assertEqual(added(
+        'capstone_db_duration_seconds_count{%s}' % labels), 2)
+    test_obj.assertGreater(added(
+        'capstone_db_duration_seconds_sum{%s}' % labels), 0)
+    # only the request for /metrics itself is still being handled
+    test_obj.assertEqual(after['capstone_http_requests_in_flight'], 1)
+    test_obj.assertIn(
+        'capstone_db_pool_events_total{event="checkouts"}', after)
+
+
+# Test that the metrics of several processes are added up, leaving out
+# the gauges of processes that have exited
+def test_metrics_aggregation(test_obj):
+    labels = format_labels(endpoint='show_movie', method='GET')
+    with tempfile.TemporaryDirectory() as directory:
+        registry = MetricsRegistry(directory)
+        registry.inc('capstone_http_requests_total', labels, 2)
+        registry.add_gauge('capstone_http_requests_in_flight')
+        registry.observe('capstone_http_request_duration_seconds',
+                         labels, 0.02)
+        with test_obj.app.app_context():
+            registry.flush()
+        test_obj.assertTrue(os.path.exists(
+            os.path.join(directory, f'metrics-{os.getpid()}.json')))
+
+        # files written by another worker that is still running (this
+        # process's parent) and by one that has exited
+        for pid in (os.getppid(), exited_pid()):
+            other = MetricsRegistry()
+            other.inc('capstone_http_requests_total', labels, 3)
+            other.add_gauge('capstone_http_requests_in_flight', amount=2)
+            other.observe('capstone_http_request_duration_seconds',
+                          labels, 3)
+            snapshot = dict(other.snapshot(), pid=pid)
+            path = os.path.join(directory, f'metrics-{pid}.json')
+            with open(path, 'w') as metrics_file:
+                json.dump(snapshot, metrics_file)
+
+        with test_obj.app.app_context():
+            merged = metrics.merge_snapshots(
+                metrics.read_snapshots(registry))
+        test_obj.assertEqual(
+            merged['counters']['capstone_http_requests_total'][labels], 8)
+        test_obj.assertEqual(
+            merged['gauges']['capstone_http_requests_in_flight'][''], 3)
+        counts = merged['histograms'][
+            'capstone_http_request_duration_seconds'][labels]
+        test_obj.assertEqual(counts[-1], 3)
+        test_obj.assertAlmostEqual(counts[-2], 6.02)
+
+        text = metrics.render(merged)
+        test_obj.assertIn(
+            'capstone_http_request_duration_seconds_bucket{%s,le="0.025"} 1'
+            % labels, text)
+        test_obj.assertIn(
+            'capstone_http_request_duration_seconds_bucket{%s,le="5"} 3'
+            % labels, text)
+        test_obj.assertIn('# TYPE capstone_http_requests_total counter', text)
+
+
+# Test that the files of workers that have exited are folded into one,
+# keeping their counters and histograms but not their gauges
+def test_metrics_exited_workers(test_obj):
+    labels = format_labels(endpoint='show_movie', method='GET')
+    with tempfile.TemporaryDirectory() as directory:
+        registry = MetricsRegistry(directory)
+        pids = [exited_pid(), exited_pid()]
+        for pid in pids:
+            other = MetricsRegistry()
+            other.inc('capstone_http_requests_total', labels, 3)
+            other.add_gauge('capstone_http_requests_in_flight')
+            other.observe('capstone_http_request_duration_seconds',
+                          labels, 3)
+            metrics.write_snapshot(metrics.snapshot_path(directory, pid),
+                                   dict(other.snapshot(), pid=pid))
+        for pid in pids:
+            metrics.fold_exited(directory, pid)
+        # a worker that never wrote its metrics is left alone
+        metrics.fold_exited(directory, exited_pid())
+        test_obj.assertEqual(os.listdir(directory), [metrics.EXITED_FILE])
+
+        with test_obj.app.app_context():
+            merged = metrics.merge_snapshots(
+                metrics.read_snapshots(registry))
+        test_obj.assertEqual(
+            merged['counters']['capstone_http_requests_total'][labels], 6)
+        test_obj.assertEqual(merged['histograms'][
+            'capstone_http_request_duration_seconds'][labels][-1], 2)
+        test_obj.assertNotIn('capstone_http_requests_in_flight',
+                             merged['gauges'])
+
+        # while a folded worker's file is being removed, it isn't
+        # counted again
+        exited_path = os.path.join(directory, metrics.EXITED_FILE)
+        with open(exited_path) as exited_file:
+            exited = json.load(exited_file)
+        metrics.write_snapshot(exited_path, dict(exited, folded=pids[:1]))
+        metrics.write_snapshot(metrics.snapshot_path(directory, pids[0]),
+                               dict(other.snapshot(), pid=pids[0]))
+        with test_obj.app.app_context():
+            merged = metrics.merge_snapshots(
+                metrics.read_snapshots(registry))
+        test_obj.assertEqual(
+            merged['counters']['capstone_http_requests_total'][labels], 6)
@@ -2,8 +2,16 @@
 # movie endpoints. Note that these will still need to be called
 # from the main test handler.
 
+import gzip
 import json
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from tests_misc import *
+from tests_actors import test_is_valid_actor
+from cache import entity_cache
+from importer import ImportFailed, import_records
+from models import db
+from routes_movies import MOVIE_COLUMNS, get_movie_fields
 
 
 # *****************************************
@@ -45,11 +53,133 @@ def test_get_movie(test_obj):
     test_is_valid_movie(test_obj, data['movie_data'])
 
 
+# Test that reading a movie again is served from the cache,
+# and that editing the movie replaces the cached version
+def test_get_movie_cached(test_obj):
+    submission_data = json.dumps(dict(name='cached movie',
+                                      release_date='2022-01-01'))
+    res_submission = test_obj.client().post('/movies',
+                                            data=submission_data,
+                                            content_type='application/json')
+    movie_id = json.loads(res_submission.get_data(as_text=True))['id']
+    hits, misses = entity_cache.hits, entity_cache.misses
+    test_obj.client().get(f'/movies/{movie_id}')
+    res_cached = test_obj.client().get(f'/movies/{movie_id}')
+    data = json.loads(res_cached.get_data(as_text=True))
+    test_is_success_response(test_obj, res_cached, data)
+    test_obj.assertEqual(data['movie_data']['name'], 'cached movie')
+    test_obj.assertEqual(entity_cache.misses, misses + 1)
+    test_obj.assertEqual(entity_cache.hits, hits + 1)
+
+    patch_data = json.dumps(dict(name='cached movie is edited',
+                                 release_date='2022-01-01'))
+    test_obj.client().patch(f'/movies/{movie_id}',
+                            data=patch_data,
+                            content_type='application/json')
+    res_edited = test_obj.client().get(f'/movies/{movie_id}')
+    data = json.loads(res_edited.get_data(as_text=True))
+    test_is_success_response(test_obj, res_edited, data)
+    test_obj.assertEqual(data['movie_data']['name'],
+                         'cached movie is edited')
+
+    test_obj.client().delete(f'/movies/{movie_id}')
+    res_deleted = test_obj.client().get(f'/movies/{movie_id}')
+    test_error_format(test_obj, res_deleted, 404)
+
+
+# Test that a movie and a search for it can be revalidated with
+# If-None-Match, and that editing the movie changes both their tags
+def test_get_movie_etag(test_obj):
+    submission_data = json.dumps(dict(name='etag movie',
+                                      release_date='2022-01-01'))
+    res_submission = test_obj.client().post('/movies',
+                                            data=submission_data,
+                                            content_type='application/json')
+    movie_id = json.loads(res_submission.get_data(as_text=True))['id']
+    search_data = json.dumps(dict(search_term='etag movie'))
+    res = test_obj.client().get(f'/movies/{movie_id}')
+    res_search = test_obj.client().post('/movies/search',
+                                        data=search_data,
+                                        content_type='application/json')
+    etag = res.headers['ETag']
+    search_etag = res_search.headers['ETag']
+
+    res_unchanged = test_obj.client().get(f'/movies/{movie_id}',
+                                          headers={'If-None-Match': etag})
+    test_obj.assertEqual(res_unchanged.status_code, 304)
+    test_obj.assertEqual(res_unchanged.get_data(), b'')
+    res_search_unchanged = test_obj.client().post(
+        '/movies/search', data=search_data, content_type='application/json',
+        headers={'If-None-Match': search_etag})
+    test_obj.assertEqual(res_search_unchanged.status_code, 304)
+
+    patch_data = json.dumps(dict(name='etag movie',
+                                 release_date='2022-02-02'))
+    test_obj.client().patch(f'/movies/{movie_id}',
+                            data=patch_data,
+                            content_type='application/json')
+    res_changed = test_obj.client().get(f'/movies/{movie_id}',
+                                        headers={'If-None-Match': etag})
+    test_is_success_response(test_obj, res_changed)
+    test_obj.assertNotEqual(res_changed.headers['ETag'], etag)
+    res_search_changed = test_obj.client().post(
+        '/movies/search', data=search_data, content_type='application/json',
+        headers={'If-None-Match': search_etag})
+    test_is_success_response(test_obj, res_search_changed)
+    test_obj.assertNotEqual(res_search_changed.headers['ETag'], search_etag)
+
+
 def test_get_movie_fail(test_obj):
     res = test_obj.client().get('/movies/100000')
     test_error_format(test_obj, res, 404)
 
 
+# Test, when reading several movies at once, that the existing movies
+# are returned by id and the ids without a movie are listed as missing
+def test_get_movies(test_obj):
+    res = test_obj.client().get('/movies?ids=1,100000,1')
+    data = json.loads(res.get_data(as_text=True))
+    test_is_success_response(test_obj, res, data)
+    test_obj.assertEqual(list(data['movie_data']['data']), ['1'])
+    test_is_valid_movie(test_obj, data['movie_data']['data']['1'])
+    test_obj.assertEqual(data['movie_data']['missing'], [100000])
+
+
+def test_get_movies_fail(test_obj):
+    # should fail if no ids are given
+    res_no_ids = test_obj.client().get('/movies')
+    test_error_format(test_obj, res_no_ids, 400)
+    # should fail if an id is not an integer
+    res_bad_id = test_obj.client().get('/movies?ids=1,a')
+    test_error_format(test_obj, res_bad_id, 400)
+    # should fail if too many ids are requested
+    too_many_ids = ','.join(str(id) for id in range(1, 1000))
+    res_too_many = test_obj.client().get(f'/movies?ids={too_many_ids}')
+    test_error_format(test_obj, res_too_many, 400)
+
+
+# Test exporting every movie as NDJSON, both plain and gzipped
+def test_export_movies(test_obj):
+    res = test_obj.client().get('/movies/export')
+    test_obj.assertEqual(res.status_code, 200)
+    test_obj.assertEqual(res.mimetype, 'application/x-ndjson')
+    movies = [json.loads(line)
+              for line in res.get_data(as_text=True).splitlines()]
+    test_obj.assertGreaterEqual(len(movies), 1)
+    for movie in movies:
+        test_is_valid_movie(test_obj, movie)
+    ids = [movie['id'] for movie in movies]
+    test_obj.assertEqual(ids, sorted(ids))
+
+    res_gzip = test_obj.client().get('/movies/export',
+                                     headers={'Accept-Encoding': 'gzip'})
+    test_obj.assertEqual(res_gzip.status_code, 200)
+    test_obj.assertEqual(res_gzip.headers['Content-Encoding'], 'gzip')
+    data = gzip.decompress(res_gzip.get_data()).decode('utf-8')
+    test_obj.assertEqual([json.loads(line) for line in data.splitlines()],
+                         movies)
+
+
 # Test, when reading a movie, that the response is successful
 # and contains a valid list of movie data
 def test_search_movie(test_obj):
@@ -61,6 +191,14 @@ def test_search_movie(test_obj):
     data = json.loads(res.get_data(as_text=True))
     test_is_success_response(test_obj, res, data)
     test_is_valid_movie_collection(test_obj, data['movie_data'])
+    # wildcard characters in the search term should be matched literally
+    submission_data = json.dumps(dict(search_term='%'))
+    res_wildcard = test_obj.client().post('/movies/search',
+                                          data=submission_data,
+                                          content_type='application/json')
+    data = json.loads(res_wildcard.get_data(as_text=True))
+    test_is_success_response(test_obj, res_wildcard, data)
+    test_obj.assertEqual(data['movie_data']['count'], 0)
 
 
 def test_search_movie_fail(test_obj):
@@ -79,6 +217,93 @@ def test_search_movie_fail(test_obj):
     # should fail if there is no data provided
     res_no_data = test_obj.client().post('/movies/search')
     test_error_format(test_obj, res_no_data, 400)
+    # should fail if the page size is invalid
+    submission_data = json.dumps(dict(search_term='movie', limit=0))
+    res_bad_limit = test_obj.client().post('/movies/search',
+                                           data=submission_data,
+                                           content_type='application/json')
+    test_error_format(test_obj, res_bad_limit, 400)
+    # should fail if the cursor is not one given out by the server
+    submission_data = json.dumps(dict(search_term='movie', after='bad'))
+    res_bad_cursor = test_obj.client().post('/movies/search',
+                                            data=submission_data,
+                                            content_type='application/json')
+    test_error_format(test_obj, res_bad_cursor, 400)
+    # should fail if the search mode is unknown
+    submission_data = json.dumps(dict(search_term='movie', mode='unknown'))
+    res_bad_mode = test_obj.client().post('/movies/search',
+                                          data=submission_data,
+                                          content_type='application/json')
+    test_error_format(test_obj, res_bad_mode, 400)
+
+
+# Test that following the cursors of a paginated search visits
+# every matching movie exactly once, in name order
+def test_search_movie_pages(test_obj):
+    submission_data = json.dumps(dict(search_term='movie'))
+    res = test_obj.client().post('/movies/search',
+                                 data=submission_data,
+                                 content_type='application/json')
+    data = json.loads(res.get_data(as_text=True))
+    test_is_success_response(test_obj, res, data)
+    test_obj.assertIsNone(data['movie_data']['next_cursor'])
+    expected = [(item['name'], item['id'])
+                for item in data['movie_data']['data']]
+    test_obj.assertGreaterEqual(len(expected), 2)
+    test_obj.assertEqual(expected, sorted(expected))
+
+    found = []
+    page_data = dict(search_term='movie', limit=1)
+    while True:
+        res_page = test_obj.client().post('/movies/search',
+                                          data=json.dumps(page_data),
+                                          content_type='application/json')
+        data = json.loads(res_page.get_data(as_text=True))
+        test_is_success_response(test_obj, res_page, data)
+        test_obj.assertEqual(data['movie_data']['count'], 1)
+        found += [(item['name'], item['id'])
+                  for item in data['movie_data']['data']]
+        if data['movie_data']['next_cursor'] is None:
+            break
+        page_data['after'] = data['movie_data']['next_cursor']
+    test_obj.assertEqual(found, expected)
+
+
+# Test that the tag of a full last page of search results changes when
+# a matching movie is added after it, as the page then has a next page
+def test_search_movie_page_etag(test_obj):
+    submission_data = json.dumps(dict(name='page tag movie a',
+                                      release_date='2022-01-01'))
+    res_submission = test_obj.client().post('/movies',
+                                            data=submission_data,
+                                            content_type='application/json')
+    first_id = json.loads(res_submission.get_data(as_text=True))['id']
+    search_data = json.dumps(dict(search_term='page tag movie', limit=1))
+    res = test_obj.client().post('/movies/search',
+                                 data=search_data,
+                                 content_type='application/json')
+    data = json.loads(res.get_data(as_text=True))
+    test_is_success_response(test_obj, res, data)
+    test_obj.assertIsNone(data['movie_data']['next_cursor'])
+    etag = res.headers['ETag']
+
+    submission_data = json.dumps(dict(name='page tag movie b',
+                                      release_date='2022-01-01'))
+    res_submission = test_obj.client().post('/movies',
+                                            data=submission_data,
+                                            content_type='application/json')
+    second_id = json.loads(res_submission.get_data(as_text=True))['id']
+    res_changed = test_obj.client().post(
+        '/movies/search', data=search_data, content_type='application/json',
+        headers={'If-None-Match': etag})
+    data = json.loads(res_changed.get_data(as_text=True))
+    test_is_success_response(test_obj, res_changed, data)
+    test_obj.assertEqual(data['movie_data']['data'][0]['id'], first_id)
+    test_obj.assertIsNotNone(data['movie_data']['next_cursor'])
+    test_obj.assertNotEqual(res_changed.headers['ETag'], etag)
+
+    test_obj.client().delete(f'/movies/{first_id}')
+    test_obj.client().delete(f'/movies/{second_id}')
 
 
 # Test adding a movie, and check that searching back for it retrieves it
@@ -128,6 +353,142 @@ def test_add_movie_fail(test_obj):
     test_error_format(test_obj, res_wrong_type_release_date, 400)
 
 
+# Test adding several movies at once, checking that the valid ones are
+# created in order and the invalid one is reported without stopping them
+def test_add_movies(test_obj):
+    submission_data = json.dumps(dict(movies=[
+        dict(name='bulk movie 1', release_date='2022-01-01'),
+        dict(name=3, release_date='2022-03-01'),
+        dict(name='bulk movie 2', release_date='2022-02-01')]))
+    res_submission = test_obj.client().post('/movies/bulk',
+                                            data=submission_data,
+                                            content_type='application/json')
+    data = json.loads(res_submission.get_data(as_text=True))
+    test_is_success_response(test_obj, res_submission, data)
+    test_obj.assertEqual(data['created'], 2)
+    test_obj.assertEqual(len(data['ids']), 3)
+    test_obj.assertIsNone(data['ids'][1])
+    test_obj.assertEqual(data['errors'][0]['index'], 1)
+    first_id, second_id = data['ids'][0], data['ids'][2]
+    test_obj.assertGreater(second_id, first_id)
+    res_retrieval = test_obj.client().get(
+        f'/movies?ids={first_id},{second_id}')
+    data = json.loads(res_retrieval.get_data(as_text=True))
+    test_is_success_response(test_obj, res_retrieval, data)
+    test_obj.assertEqual(data['movie_data']['data'][str(first_id)]['name'],
+                         'bulk movie 1')
+    test_obj.assertEqual(data['movie_data']['data'][str(second_id)]['name'],
+                         'bulk movie 2')
+    # malformed dates are reported by index rather than the database
+    # rejecting the whole batch, and dates in HTTP format are accepted
+    submission_data = json.dumps(dict(movies=[
+        dict(name='bulk dated movie 1', release_date='not a date'),
+        dict(name='bulk dated movie 2',
+             release_date='Tue, 01 Feb 2022 00:00:00 GMT'),
+        dict(name='bulk dated movie 3', release_date='2022-13-01')]))
+    res_submission = test_obj.client().post('/movies/bulk',
+                                            data=submission_data,
+                                            content_type='application/json')
+    data = json.loads(res_submission.get_data(as_text=True))
+    test_is_success_response(test_obj, res_submission, data)
+    test_obj.assertEqual(data['created'], 1)
+    test_obj.assertEqual([error['index'] for error in data['errors']],
+                         [0, 2])
+    res_retrieval = test_obj.client().get(f'/movies/{data["ids"][1]}')
+    data = json.loads(res_retrieval.get_data(as_text=True))
+    test_obj.assertEqual(data['movie_data']['release_date'],
+                         'Tue, 01 Feb 2022 00:00:00 GMT')
+
+
+def test_add_movies_fail(test_obj):
+    # should fail if there is no data passed at all
+    res_no_data = test_obj.client().post('/movies/bulk')
+    test_error_format(test_obj, res_no_data, 400)
+    # should fail if the movies are not given as a list
+    not_list_data = json.dumps(dict(movies=dict(name='bulk movie 1',
+                                                release_date='2022-01-01')))
+    res_not_list = test_obj.client().post('/movies/bulk',
+                                          data=not_list_data,
+                                          content_type='application/json')
+    test_error_format(test_obj, res_not_list, 400)
+    # should fail, creating nothing, if an atomic request has an invalid movie
+    atomic_data = json.dumps(dict(atomic=True, movies=[
+        dict(name='bulk atomic movie', release_date='2022-01-01'),
+        dict(name=3, release_date='2022-03-01')]))
+    res_atomic = test_obj.client().post('/movies/bulk',
+                                        data=atomic_data,
+                                        content_type='application/json')
+    test_error_format(test_obj, res_atomic, 422)
+    retrieval_data = json.dumps(dict(search_term='bulk atomic movie'))
+    res_retrieval = test_obj.client().post('/movies/search',
+                                           data=retrieval_data,
+                                           content_type='application/json')
+    data = json.loads(res_retrieval.get_data(as_text=True))
+    test_obj.assertEqual(data['movie_data']['count'], 0)
+
+
+# Test importing movies from NDJSON, checking that valid records are
+# imported and invalid ones are skipped and reported by line
+def test_import_movies(test_obj):
+    import_data = '\n'.join([
+        json.dumps(dict(name='imported movie 1', release_date='2022-01-01')),
+        'not json',
+        json.dumps(dict(name='imported movie 2')),
+        json.dumps(dict(name='imported movie 3', release_date='2022-03-01')),
+        json.dumps(dict(name='imported movie 4', release_date='2022-02-30')),
+        ''])
+    res_import = test_obj.client().post('/movies/import',
+                                        data=import_data,
+                                        content_type='application/x-ndjson')
+    data = json.loads(res_import.get_data(as_text=True))
+    test_is_success_response(test_obj, res_import, data)
+    test_obj.assertEqual(data['imported'], 2)
+    test_obj.assertEqual(data['skipped'], 3)
+    test_obj.assertEqual([error['line'] for error in data['errors']],
+                         [2, 3, 5])
+    retrieval_data = json.dumps(dict(search_term='imported movie'))
+    res_retrieval = test_obj.client().post('/movies/search',
+                                           data=retrieval_data,
+                                           content_type='application/json')
+    data = json.loads(res_retrieval.get_data(as_text=True))
+    test_is_success_response(test_obj, res_retrieval, data)
+    test_obj.assertEqual(data['movie_data']['count'], 2)
+
+
+def test_import_movies_fail(test_obj):
+    # should fail if the data is not in a format that can be imported
+    res_bad_format = test_obj.client().post('/movies/import',
+                                            data='{}',
+                                            content_type='application/json')
+    test_error_format(test_obj, res_bad_format, 400)
+    # should fail, importing nothing, if the database rejects a value
+    import_data = '\n'.join([
+        json.dumps(dict(name='rejected movie', release_date='2022-01-01')),
+        json.dumps(dict(name='rejected\u0000movie',
+                        release_date='2022-01-01'))])
+    res_rejected = test_obj.client().post('/movies/import',
+                                          data=import_data,
+                                          content_type='application/x-ndjson')
+    test_error_format(test_obj, res_rejected, 422)
+    retrieval_data = json.dumps(dict(search_term='rejected movie'))
+    res_retrieval = test_obj.client().post('/movies/search',
+                                           data=retrieval_data,
+                                           content_type='application/json')
+    data = json.loads(res_retrieval.get_data(as_text=True))
+    test_obj.assertEqual(data['movie_data']['count'], 0)
+    # the failure gives the input line of the rejected record, not the
+    # line of the chunk copied to the database
+    lines = [json.dumps(dict(name=name, release_date='2022-01-01'))
+             for name in ('rejected movie', 'rejected movie',
+                          'rejected movie', 'rejected\u0000movie')]
+    lines.insert(2, 'not json')
+    with test_obj.app.app_context():
+        with test_obj.assertRaises(ImportFailed) as context:
+            import_records(db, 'movies', MOVIE_COLUMNS, get_movie_fields,
+                           lines, 'ndjson', chunk_rows=2)
+    test_obj.assertTrue(str(context.exception).startswith('line 5: '))
+
+
 # Test editing a movie, and check that
 # searching back for the edited movie retrieves it
 def test_edit_movie(test_obj):
@@ -163,6 +524,33 @@ def test_edit_movie(test_obj):
     test_obj.assertEqual(len(data['movie_data']['data']), 0)
 
 
+# Test that editing a movie with "Prefer: return=representation"
+# returns the edited movie, tagged to match later reads of it
+def test_edit_movie_representation(test_obj):
+    submission_data = json.dumps(dict(name='represented movie',
+                                      release_date='2022-01-01'))
+    res_submission = test_obj.client().post('/movies',
+                                            data=submission_data,
+                                            content_type='application/json')
+    movie_id = json.loads(res_submission.get_data(as_text=True))['id']
+    patch_data = json.dumps(dict(name='represented movie is edited',
+                                 release_date='2022-01-01'))
+    res_patch = test_obj.client().patch(
+        f'/movies/{movie_id}', data=patch_data,
+        content_type='application/json',
+        headers={'Prefer': 'return=representation'})
+    data = json.loads(res_patch.get_data(as_text=True))
+    test_is_success_response(test_obj, res_patch, data)
+    test_is_valid_movie(test_obj, data['movie_data'])
+    test_obj.assertEqual(data['movie_data']['id'], movie_id)
+    test_obj.assertEqual(data['movie_data']['name'],
+                         'represented movie is edited')
+    res_unchanged = test_obj.client().get(
+        f'/movies/{movie_id}',
+        headers={'If-None-Match': res_patch.headers['ETag']})
+    test_obj.assertEqual(res_unchanged.status_code, 304)
+
+
 def test_edit_movie_fail(test_obj):
     # should fail if there is no data passed at all
     res_no_data = test_obj.client().patch('/movies/1')
@@ -220,3 +608,146 @@ def test_delete_movie_fail(test_obj):
     # should fail if no item with the given id is present
     res_wrong_type = test_obj.client().delete('/movies/100000')
     test_error_format(test_obj, res_wrong_type, 404)
+
+
+# Test that a full-text search finds movies by the words in their names,
+# regardless of word order, and excludes words marked with "-"
+def test_search_movie_ranked(test_obj):
+    submission_data = json.dumps(dict(search_term='viewing movie',
+                                      mode='fulltext'))
+    res = test_obj.client().post('/movies/search',
+                                 data=submission_data,
+                                 content_type='application/json')
+    data = json.loads(res.get_data(as_text=True))
+    test_is_success_response(test_obj, res, data)
+    test_is_valid_movie_collection(test_obj, data['movie_data'])
+    test_obj.assertEqual(data['movie_data']['data'][0]['name'],
+                         'movie for viewing')
+    test_obj.assertIsNone(data['movie_data']['next_cursor'])
+
+    submission_data = json.dumps(dict(search_term='movie -viewing',
+                                      mode='fulltext'))
+    res_excluded = test_obj.client().post('/movies/search',
+                                          data=submission_data,
+                                          content_type='application/json')
+    data = json.loads(res_excluded.get_data(as_text=True))
+    test_is_success_response(test_obj, res_excluded, data)
+    for item in data['movie_data']['data']:
+        test_obj.assertNotIn('viewing', item['name'])
+
+
+# Test casting actors in a movie and removing them, reading the movie
+# with its cast embedded in between
+def test_edit_movie_cast(test_obj):
+    submission_data = json.dumps(dict(name='cast movie',
+                                      release_date='2022-01-01'))
+    res_submission = test_obj.client().post('/movies',
+                                            data=submission_data,
+                                            content_type='application/json')
+    movie_id = json.loads(res_submission.get_data(as_text=True))['id']
+    res_add = test_obj.client().post(
+        f'/movies/{movie_id}/cast',
+        data=json.dumps(dict(actor_ids=[2, 1, 100000, 2])),
+        content_type='application/json')
+    data = json.loads(res_add.get_data(as_text=True))
+    test_is_success_response(test_obj, res_add, data)
+    test_obj.assertEqual(data['added'], [1, 2])
+    test_obj.assertEqual(data['missing'], [100000])
+    # casting an actor again changes nothing
+    res_again = test_obj.client().post(
+        f'/movies/{movie_id}/cast', data=json.dumps(dict(actor_ids=[1])),
+        content_type='application/json')
+    test_obj.assertEqual(
+        json.loads(res_again.get_data(as_text=True))['added'], [])
+
+    res = test_obj.client().get(f'/movies/{movie_id}?embed=cast')
+    data = json.loads(res.get_data(as_text=True))
+    test_is_success_response(test_obj, res, data)
+    cast = data['movie_data']['cast']
+    test_obj.assertEqual((cast['count'], cast['total']), (2, 2))
+    test_obj.assertEqual({actor['id'] for actor in cast['data']}, {1, 2})
+    test_is_valid_actor(test_obj, cast['data'][0])
+    etag = res.headers['ETag']
+    test_obj.assertNotEqual(
+        test_obj.client().get(f'/movies/{movie_id}').headers['ETag'], etag)
+    res_unchanged = test_obj.client().get(f'/movies/{movie_id}?embed=cast',
+                                          headers={'If-None-Match': etag})
+    test_obj.assertEqual(res_unchanged.status_code, 304)
+
+    res_remove = test_obj.client().delete(
+        f'/movies/{movie_id}/cast', data=json.dumps(dict(actor_ids=[2, 3])),
+        content_type='application/json')
+    data = json.loads(res_remove.get_data(as_text=True))
+    test_is_success_response(test_obj, res_remove, data)
+    test_obj.assertEqual(data['removed'], [2])
+    # removing an actor from the cast changes the tag
+    res_changed = test_obj.client().get(f'/movies/{movie_id}?embed=cast',
+                                        headers={'If-None-Match': etag})
+    data = json.loads(res_changed.get_data(as_text=True))
+    test_is_success_response(test_obj, res_changed, data)
+    test_obj.assertEqual(data['movie_data']['cast']['total'], 1)
+    test_obj.assertNotEqual(res_changed.headers['ETag'], etag)
+    # deleting the movie deletes its casting too
+    test_obj.client().delete(f'/movies/{movie_id}')
+    res_deleted = test_obj.client().post(
+        f'/movies/{movie_id}/cast', data=json.dumps(dict(actor_ids=[1])),
+        content_type='application/json')
+    test_error_format(test_obj, res_deleted, 404)
+
+
+def test_edit_movie_cast_fail(test_obj):
+    # should fail if the actor ids are missing or malformed
+    for body in ({}, dict(actor_ids=[]), dict(actor_ids=1),
+                 dict(actor_ids=['1']), dict(actor_ids=[True])):
+        for method in ('POST', 'DELETE'):
+            res = test_obj.client().open('/movies/1/cast', method=method,
+                                         data=json.dumps(body),
+                                         content_type='application/json')
+            test_error_format(test_obj, res, 400)
+    # should fail if no item with the given id is present
+    res_no_movie = test_obj.client().delete(
+        '/movies/100000/cast', data=json.dumps(dict(actor_ids=[1])),
+        content_type='application/json')
+    test_error_format(test_obj, res_no_movie, 404)
+
+
+# Test reading several movies with their casts embedded, limited to a
+# number per movie, and that this takes the same number of queries
+# however many movies there are
+def test_get_movies_cast(test_obj):
+    statements = []
+
+    def count_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+    res = test_obj.client().get('/movies?ids=1,2,100000&embed=cast'
+                                '&embed_limit=1')
+    data = json.loads(res.get_data(as_text=True))
+    test_is_success_response(test_obj, res, data)
+    movies = data['movie_data']['data']
+    test_obj.assertEqual(set(movies), {'1', '2'})
+    test_obj.assertEqual((movies['1']['cast']['count'],
+                          movies['1']['cast']['total']), (1, 2))
+    test_is_valid_actor(test_obj, movies['1']['cast']['data'][0])
+    test_obj.assertEqual(movies['2']['cast']['total'], 1)
+
+    event.listen(Engine, 'before_cursor_execute', count_statement)
+    try:
+        for ids in ('1', '1,2,3,100000'):
+            del statements[:]
+            res = test_obj.client().get(f'/movies?ids={ids}&embed=cast')
+            test_is_success_response(test_obj, res)
+            test_obj.assertEqual(len(statements), 2)
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count_statement)
+
+    res = test_obj.client().get('/movies/1?embed=cast&embed_limit=1000')
+    data = json.loads(res.get_data(as_text=True))
+    test_is_success_response(test_obj, res, data)
+    test_obj.assertEqual(data['movie_data']['cast']['total'], 2)
+    # should fail if asked to embed something unknown, or a bad limit
+    for query in ('embed=movies', 'embed=cast&embed_limit=0',
+                  'embed=cast&embed_limit=a'):
+        res_bad = test_obj.client().get(f'/movies/1?{query}')
+        test_error_format(test_obj, res_bad, 400)
+        res_bad = test_obj.client().get(f'/movies?ids=1&{query}')
+        test_error_format(test_obj, res_bad, 400)